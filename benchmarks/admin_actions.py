@@ -0,0 +1,118 @@
+"""
+Benchmarks the subscriber admin bulk actions against a large subscriber list.
+
+Fills the database with subscribers, then prints the time taken by the
+subscribe, unsubscribe, add to mailing list and remove from mailing list
+actions of the subscriber admin, for increasing numbers of selected
+subscribers. For comparison, the per-object loops that the actions used to
+run are timed for the smaller selections. Run it against a throwaway
+database, with the subscribers migrations applied:
+
+    DJANGO_SETTINGS_MODULE=benchmark_settings python benchmarks/admin_actions.py --subscribers=200000
+
+Existing subscribers data in the database will be deleted.
+"""
+
+import time
+from optparse import OptionParser
+
+from django.contrib import admin
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.db import transaction
+from django.test.client import RequestFactory
+
+from subscribers.admin import SubscriberAdmin
+from subscribers.models import Subscriber, MailingList
+
+
+# The number of rows to insert per query.
+INSERT_CHUNK_SIZE = 10000
+
+
+def populate(subscriber_count):
+    """Fills the database with the given number of subscribers, and an empty mailing list."""
+    Subscriber.objects.all().delete()
+    MailingList.objects.all().delete()
+    with transaction.commit_on_success():
+        Subscriber.objects.bulk_create([
+            Subscriber(email="subscriber{index}@example{domain}.com".format(index=index, domain=index % 100))
+            for index in xrange(subscriber_count)
+        ], batch_size=INSERT_CHUNK_SIZE)
+    return MailingList.objects.create(name="Benchmark list")
+
+
+def timed(func, *args):
+    """Calls the given function, returning the time taken in milliseconds."""
+    start_time = time.time()
+    func(*args)
+    return (time.time() - start_time) * 1000
+
+
+def create_request():
+    """Returns a request that the admin actions can report their messages to."""
+    request = RequestFactory().post("/admin/subscribers/subscriber/")
+    request._messages = CookieStorage(request)
+    return request
+
+
+@transaction.commit_on_success
+def save_subscribed(qs, is_subscribed):
+    """The per-object loop that the subscribe and unsubscribe actions used to run."""
+    for obj in qs.iterator():
+        obj.is_subscribed = is_subscribed
+        obj.save()
+
+
+@transaction.commit_on_success
+def add_each(qs, mailing_list):
+    """The per-object loop that the add to mailing list action used to run."""
+    for subscriber in qs:
+        subscriber.mailing_lists.add(mailing_list)
+
+
+@transaction.commit_on_success
+def remove_each(qs, mailing_list):
+    """The per-object loop that the remove from mailing list action used to run."""
+    for subscriber in qs:
+        subscriber.mailing_lists.remove(mailing_list)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--subscribers", type="int", default=200000, help="The number of subscribers to create.")
+    parser.add_option("--legacy-max", type="int", default=10000, help="The largest selection to time the per-object loops for.")
+    options, args = parser.parse_args()
+    mailing_list = populate(options.subscribers)
+    subscriber_ids = list(Subscriber.objects.order_by("id").values_list("id", flat=True))
+    subscriber_admin = SubscriberAdmin(Subscriber, admin.site)
+    request = create_request()
+    admin_qs = subscriber_admin.queryset(request)
+    # Time increasing selections, up to selecting all subscribers.
+    sizes = []
+    size = 1000
+    while size < options.subscribers:
+        sizes.append(size)
+        size *= 10
+    sizes.append(options.subscribers)
+    print "{0:>12} {1:>12} {2:>12} {3:>12} {4:>12}".format("selected", "unsubscribe", "subscribe", "add", "remove")
+    for size in sizes:
+        qs = admin_qs.filter(id__lte=subscriber_ids[size - 1])
+        durations = (
+            timed(subscriber_admin.unsubscribe_selected, request, qs),
+            timed(subscriber_admin.subscribe_selected, request, qs),
+            timed(subscriber_admin.add_selected_to_mailing_list, request, qs, mailing_list),
+            timed(subscriber_admin.remove_selected_from_mailing_list, request, qs, mailing_list),
+        )
+        print "{0:>12} {1:>10.0f}ms {2:>10.0f}ms {3:>10.0f}ms {4:>10.0f}ms".format(size, *durations)
+        if size <= options.legacy_max:
+            durations = (
+                timed(save_subscribed, qs, False),
+                timed(save_subscribed, qs, True),
+                timed(add_each, qs, mailing_list),
+                timed(remove_each, qs, mailing_list),
+            )
+            print "{0:>12} {1:>10.0f}ms {2:>10.0f}ms {3:>10.0f}ms {4:>10.0f}ms".format("(per-object)", *durations)
+
+
+if __name__ == "__main__":
+    main()
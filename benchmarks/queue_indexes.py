@@ -0,0 +1,135 @@
+"""
+Benchmarks the dispatched email queue queries against a large email history.
+
+Fills the database with a history of sent emails, then prints the query plan
+and timing of the queries used to claim pending emails and to look up the
+emails sent for an object with a string primary key. Run it against a
+throwaway database, with the subscribers migrations applied:
+
+    DJANGO_SETTINGS_MODULE=benchmark_settings python benchmarks/queue_indexes.py --rows=10000000
+
+Existing subscribers data in the database will be deleted.
+"""
+
+import datetime, time
+from optparse import OptionParser
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.db.models import Q
+
+from subscribers.models import get_object_id_hash, Subscriber, DispatchedEmail, STATUS_PENDING, STATUS_SENT, STATUS_SENDING, PRIORITY_NORMAL
+
+
+# The number of rows to insert per query.
+INSERT_CHUNK_SIZE = 10000
+
+
+def get_object_id(index):
+    """Returns the string object id of the mailing with the given index."""
+    return u"mailing-{index}".format(index=index)
+
+
+def populate(rows, subscriber_count, object_count, pending_count):
+    """
+    Fills the database with a history of sent emails for object_count
+    mailings, with pending_count emails still queued for the last mailing.
+    """
+    DispatchedEmail.objects.all().delete()
+    Subscriber.objects.all().delete()
+    content_type = ContentType.objects.get_for_model(Subscriber)
+    with transaction.commit_on_success():
+        Subscriber.objects.bulk_create([
+            Subscriber(email="subscriber{index}@example{domain}.com".format(index=index, domain=index % 100))
+            for index in xrange(subscriber_count)
+        ], batch_size=INSERT_CHUNK_SIZE)
+    subscriber_ids = list(Subscriber.objects.order_by("id").values_list("id", flat=True))
+    now = datetime.datetime.now()
+    for chunk_start in xrange(0, rows, INSERT_CHUNK_SIZE):
+        chunk = []
+        for index in xrange(chunk_start, min(rows, chunk_start + INSERT_CHUNK_SIZE)):
+            object_id = get_object_id(index * object_count // rows)
+            is_pending = index >= rows - pending_count
+            chunk.append(DispatchedEmail(
+                manager_slug = "default",
+                content_type = content_type,
+                object_id = object_id,
+                object_id_hash = get_object_id_hash(object_id),
+                subscriber_id = subscriber_ids[index % subscriber_count],
+                date_to_send = now,
+                date_sent = None if is_pending else now,
+                status = STATUS_PENDING if is_pending else STATUS_SENT,
+            ))
+        with transaction.commit_on_success():
+            DispatchedEmail.objects.bulk_create(chunk)
+    # Update the planner statistics.
+    if connection.vendor in ("postgresql", "sqlite"):
+        connection.cursor().execute("ANALYZE")
+        transaction.commit_unless_managed()
+    return content_type
+
+
+def explain(name, queryset):
+    """Prints the query plan and timing of the given queryset."""
+    sql, params = queryset.query.get_compiler(connection=connection).as_sql()
+    if connection.vendor == "postgresql":
+        explain_sql = "EXPLAIN ANALYZE " + sql
+    elif connection.vendor == "sqlite":
+        explain_sql = "EXPLAIN QUERY PLAN " + sql
+    else:
+        explain_sql = "EXPLAIN " + sql
+    cursor = connection.cursor()
+    cursor.execute(explain_sql, params)
+    plan = cursor.fetchall()
+    start_time = time.time()
+    cursor.execute(sql, params)
+    cursor.fetchall()
+    duration = time.time() - start_time
+    print "{name} ({duration:.2f}ms)".format(
+        name = name,
+        duration = duration * 1000,
+    )
+    for row in plan:
+        print "    " + " ".join(unicode(column) for column in row)
+    print
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--rows", type="int", default=10000000, help="The number of dispatched emails to create.")
+    parser.add_option("--subscribers", type="int", default=100000, help="The number of subscribers to create.")
+    parser.add_option("--objects", type="int", default=100, help="The number of mailings in the history.")
+    parser.add_option("--pending", type="int", default=10000, help="The number of pending emails in the queue.")
+    options, args = parser.parse_args()
+    content_type = populate(options.rows, options.subscribers, options.objects, options.pending)
+    # The pending queue query, as used to claim a page of emails.
+    now = datetime.datetime.now()
+    claimable_emails = DispatchedEmail.objects.filter(
+        Q(status=STATUS_PENDING) | Q(status=STATUS_SENDING, lease_expires__lt=now),
+        Q(date_next_attempt__isnull=True) | Q(date_next_attempt__lte=now),
+        manager_slug = "default",
+        date_to_send__lte = now,
+        priority = PRIORITY_NORMAL,
+        id__gt = 0,
+    )
+    explain("Claim a page of pending emails", claimable_emails.order_by("id").values_list("id", flat=True)[:500])
+    # The object lookups, as used by the unsubscribe views and the admin.
+    object_id = get_object_id(0)
+    object_emails = DispatchedEmail.objects.filter(
+        content_type = content_type,
+        object_id = object_id,
+    )
+    hashed_object_emails = object_emails.filter(
+        object_id_hash = get_object_id_hash(object_id),
+    )
+    subscriber_id = Subscriber.objects.order_by("id").values_list("id", flat=True)[0]
+    explain("Count the recipients of a mailing by object_id", object_emails.values_list("id", flat=True))
+    explain("Count the recipients of a mailing by object_id_hash", hashed_object_emails.values_list("id", flat=True))
+    explain("Check a mailing was sent to a subscriber", hashed_object_emails.filter(subscriber=subscriber_id).values_list("id", flat=True)[:1])
+    explain("Find subscribers who have not received a mailing", Subscriber.objects.filter(is_subscribed=True).exclude(
+        id__in = hashed_object_emails.values("subscriber"),
+    ).values_list("id", flat=True)[:500])
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,10 @@ get_adapter = default_email_manager.get_adapter
 
 # Dispatching email.
 dispatch_email = default_email_manager.dispatch_email
+dispatch_email_bulk = default_email_manager.dispatch_email_bulk
+dispatch_email_job = default_email_manager.dispatch_email_job
+run_dispatch_jobs = default_email_manager.run_dispatch_jobs
+spool_emails = default_email_manager.spool_emails
 send_email_batch_iter = default_email_manager.send_email_batch_iter
 send_email_batch = default_email_manager.send_email_batch
 
@@ -1,18 +1,20 @@
 """Admin integration for subscribers."""
 
-import csv, cStringIO, datetime, time
+import datetime, time
 from functools import partial, wraps
 
 from django.conf import settings
 from django.contrib import admin, messages
 from django.db.models import Count
-from django.db import transaction
+from django.db import connection
 from django.shortcuts import redirect, render, get_object_or_404
 from django.http import HttpResponse, Http404
 from django.utils import formats
 
+from subscribers.exporter import iter_csv_lines
 from subscribers.forms import ImportFromCsvForm
-from subscribers.models import Subscriber, MailingList, has_int_pk
+from subscribers.importer import create_import_job, retry_import_jobs
+from subscribers.models import Subscriber, MailingList, DispatchedEmail, ArchivedEmail, DispatchJob, ImportJob
 from subscribers.registration import default_email_manager
 
 # Try to import the URL functions
@@ -21,6 +23,12 @@ try:
 except ImportError:
     from django.conf.urls import patterns, url
 
+# Stream responses using the streaming response class, if available.
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    StreamingHttpResponse = HttpResponse
+
 
 # Mix in watson search, if available.
 if "watson" in settings.INSTALLED_APPS:
@@ -39,6 +47,20 @@ else:
     VersionAdminBase = AdminBase
 
 
+def get_subscriber_email_count_sql(model):
+    """Returns SQL that counts the emails of the given model sent to each subscriber."""
+    return u"SELECT COUNT(*) FROM {email_table} WHERE {email_table}.{subscriber_column} = {subscriber_table}.{subscriber_pk}".format(
+        email_table = connection.ops.quote_name(model._meta.db_table),
+        subscriber_column = connection.ops.quote_name(model._meta.get_field("subscriber").column),
+        subscriber_table = connection.ops.quote_name(Subscriber._meta.db_table),
+        subscriber_pk = connection.ops.quote_name(Subscriber._meta.pk.column),
+    )
+
+
+# The number of recent import jobs shown on the import page.
+IMPORT_JOBS_SHOWN = 10
+
+
 class SubscriberAdmin(AdminBase):
 
     """Admin integration for subscribers."""
@@ -65,16 +87,25 @@ class SubscriberAdmin(AdminBase):
     )
     
     def queryset(self, request):
-        """Returns the queryset to use for displaying the change list."""
+        """
+        Returns the queryset to use for displaying the change list.
+        
+        The email counts are selected using correlated subqueries, rather than
+        an annotation, so that the queryset can still be exported and updated
+        without joining the email history.
+        """
         qs = super(SubscriberAdmin, self).queryset(request)
-        qs = qs.annotate(
-            email_count = Count("dispatchedemail"),
+        qs = qs.extra(
+            select = {
+                "email_count": get_subscriber_email_count_sql(DispatchedEmail),
+                "archived_email_count": get_subscriber_email_count_sql(ArchivedEmail),
+            },
         )
         return qs
     
     def get_email_count(self, obj):
-        """Returns the number of emails sent to this subscriber."""
-        return obj.email_count
+        """Returns the number of emails sent to this subscriber, including archived emails."""
+        return obj.email_count + obj.archived_email_count
     get_email_count.short_description = "Emails received"
     
     # Custom views.
@@ -88,38 +119,23 @@ class SubscriberAdmin(AdminBase):
         ) + urlpatterns
         return urlpatterns
         
-    @transaction.commit_on_success
     def import_from_csv(self, request):
-        """Allows users to be imported from a CSV file."""
+        """
+        Allows users to be imported from a CSV file.
+        
+        The uploaded file is stored on disk and imported in the background by
+        the importsubscribers management command, so large files do not time
+        out the request. The progress of recent imports is shown on this page.
+        """
         # Process the form.
         if request.method == "POST":
             form = ImportFromCsvForm(request.POST, request.FILES)
             if form.is_valid():
-                cleaned_rows = form.cleaned_data["rows"]
-                invalid_rows = form.cleaned_data["invalid_rows"]
-                # Import all cleaned rows.
-                for data in cleaned_rows:
-                    Subscriber.objects.subscribe(
-                        email = data["email"],
-                        first_name = data["first_name"],
-                        last_name = data["last_name"],
-                        is_subscribed = None,
-                    )
+                create_import_job(form.cleaned_data["file"], form.cleaned_data["mailing_lists"])
                 # Message the user.
-                self.message_user(request, "Successfully imported {count} subscriber{pluralize}.".format(
-                    count = len(cleaned_rows),
-                    pluralize = len(cleaned_rows) != 1 and "s" or "",
-                ))
-                if invalid_rows:
-                    messages.warning(request, "There {were} {count} error{pluralize} in your CSV file. The {first} error was on line {lineno}.".format(
-                        were = len(invalid_rows) != 1 and "were" or "was",
-                        count = len(invalid_rows),
-                        pluralize = len(invalid_rows) != 1 and "s" or "",
-                        lineno = invalid_rows[0][0],
-                        first = len(invalid_rows) != 1 and "first" or "",
-                    ))
+                self.message_user(request, "Your CSV file has been uploaded, and will be imported in the background.")
                 # Redirect.
-                return redirect("{site}:subscribers_subscriber_changelist".format(
+                return redirect("{site}:subscribers_subscriber_import".format(
                     site = self.admin_site.name,
                 ))
         else:
@@ -128,38 +144,25 @@ class SubscriberAdmin(AdminBase):
         return render(request, "admin/subscribers/subscriber/import_from_csv.html", {
             "title": "Import subscribers from CSV",
             "form": form,
+            "import_jobs": ImportJob.objects.prefetch_related("mailing_lists")[:IMPORT_JOBS_SHOWN],
         })
     
     # Custom actions.
     
     def export_selected_to_csv(self, request, qs):
-        """Renders the selected subscribers to CSV."""
-        out = cStringIO.StringIO()
-        # Render the preamble.
-        writer = csv.writer(out)
-        writer.writerow(("email", "first name", "last name", "subscribed",))
-        # Render the CSV.
-        for subscriber in qs:
-            writer.writerow((
-                subscriber.email.encode("utf-8"),
-                subscriber.first_name.encode("utf-8"),
-                subscriber.last_name.encode("utf-8"),
-                str(int(subscriber.is_subscribed)),
-            ))
-        # Render the response.
-        content = out.getvalue()
-        response = HttpResponse(content)
+        """Streams the selected subscribers to CSV."""
+        response = StreamingHttpResponse(iter_csv_lines(qs))
         response["Content-Type"] = "text/csv; charset=utf-8"
         response["Content-Disposition"] = "attachment; filename=subscribers.csv"
-        response["Content-Length"] = str(len(content))
         return response
     export_selected_to_csv.short_description = "Export selected subscribers to CSV"
     
     def subscribe_selected(self, request, qs):
-        """Subscribes the selected subscribers."""
-        for count, obj in enumerate(qs.iterator(), 1):  # HACK: Can't do this in an update, as it borks with the annotate clause in queryset().
-            obj.is_subscribed = True
-            obj.save()
+        """Subscribes the selected subscribers, using a single update."""
+        count = qs.order_by().update(
+            is_subscribed = True,
+            date_modified = datetime.datetime.now(),
+        )
         self.message_user(request, u"{count} {item} marked as subscribed.".format(
             count = count,
             item = count != 1 and "subscribers were" or "subscriber was",
@@ -167,10 +170,11 @@ class SubscriberAdmin(AdminBase):
     subscribe_selected.short_description = "Mark selected subscribers as subscribed"
     
     def unsubscribe_selected(self, request, qs):
-        """Unsubscribes the selected subscribers."""
-        for count, obj in enumerate(qs.iterator(), 1):  # HACK: Can't do this in an update, as it borks with the annotate clause in queryset().
-            obj.is_subscribed = False
-            obj.save()
+        """Unsubscribes the selected subscribers, using a single update."""
+        count = qs.order_by().update(
+            is_subscribed = False,
+            date_modified = datetime.datetime.now(),
+        )
         self.message_user(request, u"{count} {item} marked as unsubscribed.".format(
             count = count,
             item = count != 1 and "subscribers were" or "subscriber was",
@@ -178,10 +182,8 @@ class SubscriberAdmin(AdminBase):
     unsubscribe_selected.short_description = "Mark selected subscribers as unsubscribed"
     
     def add_selected_to_mailing_list(self, request, qs, mailing_list):
-        """Adds the selected subscribers to a mailing list."""
-        for subscriber in qs:
-            subscriber.mailing_lists.add(mailing_list)
-        count = len(qs)
+        """Adds the selected subscribers to a mailing list, skipping existing members."""
+        count = mailing_list.add_subscribers(qs)
         self.message_user(request, u"{count} {item} added to {mailing_list}.".format(
             count = count,
             item = count != 1 and "subscribers were" or "subscriber was",
@@ -190,9 +192,7 @@ class SubscriberAdmin(AdminBase):
             
     def remove_selected_from_mailing_list(self, request, qs, mailing_list):
         """Removes the selected subscribers from a mailing list."""
-        for subscriber in qs:
-            subscriber.mailing_lists.remove(mailing_list)
-        count = len(qs)
+        count = mailing_list.remove_subscribers(qs)
         self.message_user(request, u"{count} {item} removed from {mailing_list}.".format(
             count = count,
             item = count != 1 and "subscribers were" or "subscriber was",
@@ -267,6 +267,86 @@ class MailingListAdmin(AdminBase):
 admin.site.register(MailingList, MailingListAdmin)
 
 
+class DispatchJobAdmin(admin.ModelAdmin):
+
+    """Admin integration for dispatch jobs."""
+    
+    list_display = ("__unicode__", "get_mailing_list", "date_to_send", "status", "get_progress", "date_created", "date_completed",)
+    
+    list_filter = ("status",)
+    
+    readonly_fields = ("content_type", "object_id", "mailing_list", "date_to_send", "status", "subscriber_count", "dispatched_count", "last_subscriber_id", "date_completed",)
+    
+    exclude = ("manager_slug", "object_id_int",)
+    
+    def has_add_permission(self, request):
+        """Dispatch jobs are created by the save and send admin action."""
+        return False
+    
+    def get_mailing_list(self, obj):
+        """Returns the mailing list that this job is sending to."""
+        return obj.mailing_list or u"All subscribers"
+    get_mailing_list.short_description = "Send to"
+    
+    def get_progress(self, obj):
+        """Returns the number of emails dispatched by this job so far."""
+        return u"{dispatched_count} of {subscriber_count}".format(
+            dispatched_count = obj.dispatched_count,
+            subscriber_count = max(obj.subscriber_count, obj.dispatched_count),
+        )
+    get_progress.short_description = "Progress"
+    
+    
+admin.site.register(DispatchJob, DispatchJobAdmin)
+
+
+class ImportJobAdmin(admin.ModelAdmin):
+
+    """Admin integration for import jobs."""
+    
+    list_display = ("__unicode__", "get_status", "get_progress", "invalid_count", "date_created", "date_completed",)
+    
+    list_filter = ("status",)
+    
+    actions = ("retry_selected",)
+    
+    readonly_fields = ("name", "path", "mailing_lists", "status", "status_message", "last_lineno", "row_count", "created_count", "updated_count", "invalid_count", "invalid_linenos", "date_completed",)
+    
+    def has_add_permission(self, request):
+        """Import jobs are created by the import from CSV admin view."""
+        return False
+    
+    def get_progress(self, obj):
+        """Returns the number of subscribers imported by this job so far."""
+        return u"{row_count} subscriber{pluralize} imported".format(
+            row_count = obj.row_count,
+            pluralize = obj.row_count != 1 and "s" or "",
+        )
+    get_progress.short_description = "Progress"
+    
+    def get_status(self, obj):
+        """Returns the status of this job, including the reason for any failure."""
+        if obj.status_message:
+            return u"{status}: {status_message}".format(
+                status = obj.get_status_display(),
+                status_message = obj.status_message,
+            )
+        return obj.get_status_display()
+    get_status.short_description = "Status"
+    
+    def retry_selected(self, request, qs):
+        """Resumes the selected failed import jobs in the background."""
+        count = retry_import_jobs(qs)
+        self.message_user(request, u"{count} failed import {item} will be retried in the background.".format(
+            count = count,
+            item = count != 1 and "jobs" or "job",
+        ))
+    retry_selected.short_description = "Retry selected failed import jobs"
+    
+    
+admin.site.register(ImportJob, ImportJobAdmin)
+
+
 def allow_save_and_send(func):
     """Decorator that enables save and send on an admin view."""
     @wraps(func)
@@ -284,21 +364,16 @@ def allow_save_and_send(func):
                 model = obj.__class__.__name__.lower(),
             ), obj.pk)
         if "_saveandsend" in request.POST:
-            # Get the default list of subscribers.
-            subscribers = Subscriber.objects.filter(
-                is_subscribed = True,
-            )
-            # Try filtering by mailing list.
+            # Get the mailing list to send to.
             send_to = request.POST["_send_to"]
             if send_to == "_nobody":
                 return make_error_redirect(u"Please select a mailing list to send this {model} to.".format(
                     model = obj._meta.verbose_name,
                 ))
             elif send_to == "_all":
-                pass
+                mailing_list = None
             else:
                 mailing_list = MailingList.objects.get(id=send_to)
-                subscribers = subscribers.filter(mailing_lists=mailing_list)
             # Get the send date.
             if request.POST["_send_on_date"]:
                 send_on_date = None
@@ -329,37 +404,14 @@ def allow_save_and_send(func):
                 send_on_time = datetime.datetime.now().time()
             # Get the send datetime.
             send_on_datetime = datetime.datetime.combine(send_on_date, send_on_time)
-            # Calculate potential subscriber count.    
-            potential_subscriber_count = subscribers.count()
-            # Exclude subscribers who have already received the email.
-            if has_int_pk(obj.__class__):
-                subscribers_to_send = subscribers.exclude(
-                    dispatchedemail__object_id_int = obj.pk,
-                )
-            else:
-                subscribers_to_send = subscribers.exclude(
-                    dispatchedemail__object_id = obj.pk,
-                )
-            subscribers_to_send = subscribers_to_send.distinct()
-            # Send the email!
-            subscriber_count = 0
-            for subscriber in subscribers_to_send.iterator():
-                subscriber_count += 1
-                admin_cls.email_manager.dispatch_email(obj, subscriber, send_on_datetime)
+            # Send the email in the background.
+            admin_cls.email_manager.dispatch_email_job(obj, mailing_list, send_on_datetime)
             # Message the user.
-            admin_cls.message_user(request, u"The {model} \"{obj}\" was saved successfully. An email will be sent to {count} subscriber{pluralize}.".format(
+            admin_cls.message_user(request, u"The {model} \"{obj}\" was saved successfully. An email will be sent to {recipients} in the background.".format(
                 model = obj._meta.verbose_name,
                 obj = obj,
-                count = subscriber_count,
-                pluralize = subscriber_count != 1 and "s" or "",
+                recipients = mailing_list and u"the subscribers of {mailing_list}".format(mailing_list=mailing_list) or u"all subscribers",
             ))
-            # Warn about unsent emails.
-            if potential_subscriber_count > subscriber_count:
-                unsent_count = potential_subscriber_count - subscriber_count
-                messages.warning(request, u"{count} subscriber{pluralize} ignored, as they have already received this email.".format(
-                    count = unsent_count,
-                    pluralize = unsent_count != 1 and "s were" or " was",
-                ))
             # Redirect the user.
             return redirect("{site}:{app}_{model}_changelist".format(
                 site = admin_cls.admin_site.name,
@@ -429,8 +481,8 @@ class EmailAdmin(VersionAdminBase):
             self.email_manager.register(self.model)
     
     def get_subscriber_count(self, obj):
-        """Returns the number of subscribers who have received this email."""
-        return obj.dispatchedemail_set.count()
+        """Returns the number of subscribers who have received this email, including archived emails."""
+        return DispatchedEmail.objects.for_object(obj).count() + ArchivedEmail.objects.for_object(obj).count()
     get_subscriber_count.short_description = "Recipients"
     
     @allow_save_and_send
@@ -0,0 +1,64 @@
+"""Streaming export of subscribers to CSV files."""
+
+import csv
+
+
+# The number of subscribers loaded per query.
+EXPORT_CHUNK_SIZE = 1000
+
+# The header row of exported CSV files.
+EXPORT_HEADERS = ("email", "first name", "last name", "subscribed",)
+
+
+def iter_subscriber_rows(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Returns an iterator of (email, first_name, last_name, is_subscribed)
+    tuples for the given subscribers, in email order.
+
+    The rows are loaded in chunks, each starting after the last email address
+    of the previous chunk, so only one chunk is held in memory at a time and
+    no chunk needs an offset.
+    """
+    queryset = queryset.order_by("email").values_list("email", "first_name", "last_name", "is_subscribed")
+    last_email = None
+    while True:
+        chunk = queryset
+        if last_email is not None:
+            chunk = chunk.filter(email__gt=last_email)
+        chunk = list(chunk[:chunk_size])
+        for row in chunk:
+            yield row
+        if len(chunk) < chunk_size:
+            break
+        last_email = chunk[-1][0]
+
+
+class LineBuffer(object):
+
+    """A file-like object that returns each line written to it, rather than storing it."""
+
+    def write(self, value):
+        """Returns the written value."""
+        return value
+
+
+def iter_csv_lines(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """Returns an iterator of the lines of a CSV file of the given subscribers."""
+    writer = csv.writer(LineBuffer())
+    yield writer.writerow(EXPORT_HEADERS)
+    for email, first_name, last_name, is_subscribed in iter_subscriber_rows(queryset, chunk_size):
+        yield writer.writerow((
+            email.encode("utf-8"),
+            first_name.encode("utf-8"),
+            last_name.encode("utf-8"),
+            str(int(is_subscribed)),
+        ))
+
+
+def export_subscribers(queryset, handle, chunk_size=EXPORT_CHUNK_SIZE):
+    """Writes a CSV file of the given subscribers to the given file handle, returning the number of subscribers written."""
+    count = 0
+    # The header row is numbered zero, so the final count is the number of subscribers.
+    for count, line in enumerate(iter_csv_lines(queryset, chunk_size)):
+        handle.write(line)
+    return count
@@ -1,10 +1,11 @@
 """Forms used by django-subscribers."""
 
-import csv, re
+import csv
 
 from django import forms
 
 from subscribers.models import MailingList
+from subscribers.importer import read_csv_headers, CsvImportError
 
 
 class SubscribeForm(forms.Form):
@@ -59,58 +60,33 @@ class SubscribeForm(forms.Form):
         return cleaned_data
 
 
-RE_WHITESPACE = re.compile(u"\s+")
-        
-        
 class ImportFromCsvForm(forms.Form):
 
-    """A form that accepts a CSV file."""
+    """
+    A form that accepts a CSV file.
+    
+    Only the header row is validated. The remaining rows are parsed when the
+    file is imported by a background import job.
+    """
     
     file = forms.FileField()
     
+    mailing_lists = forms.ModelMultipleChoiceField(
+        queryset = MailingList.objects.all(),
+        required = False,
+        help_text = "The imported subscribers will be added to these mailing lists.",
+    )
+    
     def clean_file(self):
-        """Parses the CSV file."""
+        """Parses the header row of the CSV file."""
         file = self.cleaned_data.get("file")
         if file:
+            reader = csv.reader(file)
             try:
-                reader = csv.reader(file)
-                # Parse the header row.
-                try:
-                    header_row = reader.next()
-                except StopIteration:
-                    raise forms.ValidationError("That CSV file is empty.")
-                headers = [
-                    RE_WHITESPACE.sub("_", cell.decode("utf-8", "ignore").lower().strip()).replace("firstname", "first_name").replace("lastname", "last_name")
-                    for cell in header_row
-                ]
-                # Check the required fields.
-                if len(headers) == 0:
-                    raise forms.ValidationError("That CSV file did not contain a valid header line.")
-                if not "email" in headers:
-                    raise forms.ValidationError("Could not find a column labelled 'email' in that CSV file.")
-                # Go through the rest of the CSV file.
-                clean_rows = []
-                invalid_rows = []
-                for lineno, row in enumerate(reader, 2):
-                    row = [cell.decode("utf-8", "ignore").strip() for cell in row]
-                    try:
-                        row_data = dict(zip(headers, row))
-                    except IndexError:
-                        invalid_rows.append((lineno, row_data))
-                    row_form = SubscribeForm(row_data)
-                    if row_form.is_valid():
-                        clean_rows.append(row_form.cleaned_data)
-                    else:
-                        print row_form.errors
-                        invalid_rows.append((lineno, row_data))
+                headers = read_csv_headers(reader)
             except csv.Error:
                 raise forms.ValidationError("Please upload a valid CSV file.")
-            # Check that some rows were parsed.
-            if not clean_rows and not invalid_rows:
-                raise forms.ValidationError("There are no subscribers in that CSV file.")
-            if not clean_rows and invalid_rows:
-                raise forms.ValidationError("No subscribers could be imported, due to errors in that CSV file.")
-            # Store the parsed data.
-            self.cleaned_data["rows"] = clean_rows
-            self.cleaned_data["invalid_rows"] = invalid_rows
-        return file
\ No newline at end of file
+            except CsvImportError as ex:
+                raise forms.ValidationError(unicode(ex))
+            self.cleaned_data["headers"] = headers
+        return file
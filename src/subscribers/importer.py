@@ -0,0 +1,441 @@
+"""Streaming import of subscribers from CSV files."""
+
+import csv, datetime, os, re, tempfile
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction, IntegrityError
+from django.db.models import F
+
+from subscribers.models import Subscriber, MailingList, ImportJob, JOB_STATUS_PENDING, JOB_STATUS_RUNNING, JOB_STATUS_COMPLETE, JOB_STATUS_FAILED
+
+
+# The number of subscribers looked up and saved per transaction.
+IMPORT_CHUNK_SIZE = 1000
+
+# The number of invalid line numbers to remember for reporting.
+MAX_INVALID_LINENOS = 10
+
+# The maximum lengths of the subscriber fields.
+MAX_EMAIL_LENGTH = Subscriber._meta.get_field("email").max_length
+MAX_NAME_LENGTH = Subscriber._meta.get_field("first_name").max_length
+
+
+RE_WHITESPACE = re.compile(u"\s+")
+
+
+class CsvImportError(Exception):
+
+    """The CSV file cannot be imported."""
+
+
+class ImportJobClaimed(Exception):
+
+    """Another process has claimed the next chunk of an import job."""
+
+
+def get_import_dir():
+    """Returns the directory that uploaded CSV files are stored in until they are imported."""
+    return getattr(settings, "SUBSCRIBERS_IMPORT_DIR", os.path.join(tempfile.gettempdir(), "subscribers-imports"))
+
+
+def read_csv_headers(reader):
+    """
+    Reads and normalizes the header row of the given CSV reader.
+    
+    Raises a CsvImportError if the header row is missing or invalid.
+    """
+    try:
+        header_row = reader.next()
+    except StopIteration:
+        raise CsvImportError("That CSV file is empty.")
+    headers = [
+        RE_WHITESPACE.sub("_", cell.decode("utf-8", "ignore").lower().strip()).replace("firstname", "first_name").replace("lastname", "last_name")
+        for cell in header_row
+    ]
+    # Check the required fields.
+    if len(headers) == 0:
+        raise CsvImportError("That CSV file did not contain a valid header line.")
+    if not "email" in headers:
+        raise CsvImportError("Could not find a column labelled 'email' in that CSV file.")
+    return headers
+
+
+def iter_csv_rows(reader, headers):
+    """
+    Parses the rows of the given CSV reader lazily, returning an iterator of
+    (lineno, data) pairs, where data is a dict keyed by the given headers.
+    
+    The line number is that of the first line of the row in the file, which
+    allows for quoted fields that span more than one line.
+    """
+    lineno = reader.line_num + 1
+    for row in reader:
+        yield lineno, dict(zip(headers, (cell.decode("utf-8", "ignore").strip() for cell in row)))
+        lineno = reader.line_num + 1
+
+
+def clean_subscriber_data(data):
+    """
+    Validates the given subscriber data, as accepted by SubscribeForm.
+
+    Returns a tuple of (email, first_name, last_name), or None if the data is
+    invalid.
+    """
+    email = data.get("email", u"").lower()
+    if not email or len(email) > MAX_EMAIL_LENGTH:
+        return None
+    try:
+        validate_email(email)
+    except ValidationError:
+        return None
+    first_name = data.get("first_name", u"")
+    last_name = data.get("last_name", u"")
+    # Parse the name to get the first name and last name.
+    name = data.get("name", u"")
+    if name:
+        name_parts = name.split(" ", 1)
+        first_name = first_name or name_parts[0]
+        last_name = last_name or (len(name_parts) > 1 and name_parts[1] or u"")
+    if len(first_name) > MAX_NAME_LENGTH or len(last_name) > MAX_NAME_LENGTH:
+        return None
+    return email, first_name, last_name
+
+
+class ImportStats(object):
+
+    """
+    Statistics for an import of subscribers.
+
+    The row count is the number of valid rows, and only the line numbers of
+    the first few invalid rows are kept.
+    """
+
+    def __init__(self):
+        """Initializes the import stats."""
+        self.row_count = 0
+        self.created_count = 0
+        self.updated_count = 0
+        self.invalid_count = 0
+        self.invalid_linenos = []
+
+    def add_invalid(self, lineno):
+        """Records an invalid row."""
+        self.invalid_count += 1
+        if len(self.invalid_linenos) < MAX_INVALID_LINENOS:
+            self.invalid_linenos.append(lineno)
+
+
+class SubscriberImporter(object):
+
+    """
+    Imports subscribers in chunks, using a single query to look up the
+    existing subscribers in each chunk, a bulk insert for the new
+    subscribers, and an update for each distinct name change.
+
+    As with SubscriberManager.subscribe(), existing names are only replaced
+    by non-empty names, and the subscription status of existing subscribers
+    is left unchanged. Each chunk is saved in its own transaction.
+
+    Every imported subscriber is added to the given mailing lists, and rows
+    with a mailing_list column are also added to the mailing list with that
+    name. Memberships are added with a set-based insert for each mailing list
+    in a chunk, skipping existing members.
+    """
+
+    def __init__(self, chunk_size=IMPORT_CHUNK_SIZE, stats=None, mailing_lists=()):
+        """Initializes the subscriber importer."""
+        self._chunk_size = chunk_size
+        self._mailing_lists = list(mailing_lists)
+        self._mailing_lists_by_name = None
+        self.stats = stats or ImportStats()
+
+    def import_rows(self, rows):
+        """Imports the given iterable of (lineno, data) pairs, returning the import stats."""
+        chunk = {}
+        memberships = defaultdict(set)
+        lineno = None
+        for lineno, data in rows:
+            cleaned_data = self.clean_row(lineno, data)
+            if cleaned_data is None:
+                self.stats.add_invalid(lineno)
+                continue
+            self.stats.row_count += 1
+            email, first_name, last_name, mailing_list = cleaned_data
+            # Merge repeated email addresses, as if they were imported one after another.
+            if email in chunk:
+                previous_first_name, previous_last_name = chunk[email]
+                first_name = first_name or previous_first_name
+                last_name = last_name or previous_last_name
+            chunk[email] = (first_name, last_name)
+            if mailing_list is not None:
+                memberships[mailing_list].add(email)
+            if len(chunk) >= self._chunk_size:
+                self.import_chunk(chunk, memberships, lineno)
+                chunk = {}
+                memberships = defaultdict(set)
+        if lineno is not None:
+            self.import_chunk(chunk, memberships, lineno)
+        return self.stats
+
+    def get_mailing_list(self, name):
+        """Returns the mailing list with the given name, ignoring case, or None if it does not exist."""
+        if self._mailing_lists_by_name is None:
+            self._mailing_lists_by_name = dict(
+                (mailing_list.name.lower(), mailing_list)
+                for mailing_list in MailingList.objects.all()
+            )
+        return self._mailing_lists_by_name.get(name.lower())
+
+    def clean_row(self, lineno, data):
+        """
+        Returns the cleaned (email, first_name, last_name, mailing_list) for
+        the given row, or None if it is invalid. The mailing list is None if
+        the row does not name one.
+        """
+        cleaned_data = clean_subscriber_data(data)
+        if cleaned_data is None:
+            return None
+        mailing_list = None
+        mailing_list_name = data.get("mailing_list", u"")
+        if mailing_list_name:
+            mailing_list = self.get_mailing_list(mailing_list_name)
+            if mailing_list is None:
+                return None
+        return cleaned_data + (mailing_list,)
+
+    def claim_chunk(self, lineno):
+        """
+        Called in the same transaction as each chunk, before the rows up to
+        and including the given line number are imported.
+        """
+
+    def save_progress(self, lineno):
+        """
+        Called in the same transaction as each chunk, once all rows up to
+        and including the given line number have been imported.
+        """
+
+    def import_chunk(self, chunk, memberships, lineno):
+        """
+        Saves the given dict of names, keyed by email address, and the given
+        dict of email addresses, keyed by mailing list, in a single
+        transaction, along with the progress of the import.
+        """
+        with transaction.commit_on_success():
+            self.claim_chunk(lineno)
+            if chunk:
+                self._import_chunk(chunk, memberships)
+            self.save_progress(lineno)
+
+    def _import_chunk(self, chunk, memberships):
+        """Saves the given dict of names, keyed by email address, and the given mailing list memberships."""
+        sid = transaction.savepoint()
+        try:
+            created_count, updated_count = self._save_chunk(chunk)
+        except IntegrityError:
+            # Another process has created some of the subscribers, so save them one at a time.
+            transaction.savepoint_rollback(sid)
+            existing_count = Subscriber.objects.filter(email__in=chunk.keys()).count()
+            for email, (first_name, last_name) in chunk.iteritems():
+                Subscriber.objects.subscribe(
+                    email = email,
+                    first_name = first_name,
+                    last_name = last_name,
+                    is_subscribed = None,
+                )
+            created_count = len(chunk) - existing_count
+            updated_count = existing_count
+        else:
+            transaction.savepoint_commit(sid)
+        self.stats.created_count += created_count
+        self.stats.updated_count += updated_count
+        # Add the subscribers to the mailing lists.
+        for mailing_list in self._mailing_lists:
+            mailing_list.add_subscribers(Subscriber.objects.filter(email__in=chunk.keys()))
+        for mailing_list, emails in memberships.iteritems():
+            mailing_list.add_subscribers(Subscriber.objects.filter(email__in=emails))
+
+    def _save_chunk(self, chunk):
+        """
+        Saves the given dict of names, keyed by email address, using bulk
+        queries. Returns the number of subscribers created and updated.
+        """
+        new_subscribers = chunk.copy()
+        existing_subscribers = Subscriber.objects.filter(
+            email__in = chunk.keys(),
+        ).values_list("email", "id", "first_name", "last_name")
+        # Group the name changes for existing subscribers.
+        updates = defaultdict(list)
+        for email, subscriber_id, existing_first_name, existing_last_name in existing_subscribers.iterator():
+            first_name, last_name = new_subscribers.pop(email)
+            first_name = first_name or existing_first_name
+            last_name = last_name or existing_last_name
+            if (first_name, last_name) != (existing_first_name, existing_last_name):
+                updates[(first_name, last_name)].append(subscriber_id)
+        now = datetime.datetime.now()
+        updated_count = 0
+        for (first_name, last_name), subscriber_ids in updates.iteritems():
+            Subscriber.objects.filter(id__in=subscriber_ids).update(
+                first_name = first_name,
+                last_name = last_name,
+                date_modified = now,
+            )
+            updated_count += len(subscriber_ids)
+        # Create the new subscribers.
+        Subscriber.objects.bulk_create([
+            Subscriber(
+                email = email,
+                first_name = first_name,
+                last_name = last_name,
+            )
+            for email, (first_name, last_name) in new_subscribers.iteritems()
+        ])
+        return len(new_subscribers), updated_count
+
+
+class ImportJobImporter(SubscriberImporter):
+
+    """
+    Imports subscribers for an import job, recording the progress of the
+    import on the job.
+    
+    Each chunk is claimed by a conditional update of the job's last line
+    number, which only succeeds if no other process has advanced the job
+    since it was read. If the claim fails, ImportJobClaimed is raised and
+    the chunk is rolled back.
+    """
+
+    def __init__(self, job, chunk_size=IMPORT_CHUNK_SIZE):
+        """Initializes the import job importer."""
+        super(ImportJobImporter, self).__init__(chunk_size, mailing_lists=job.mailing_lists.all())
+        self.stats.invalid_linenos = job.get_invalid_linenos()
+        self._job_id = job.id
+        self.last_lineno = job.last_lineno
+        self._saved_counts = (0, 0, 0, 0)
+
+    def claim_chunk(self, lineno):
+        """Claims the rows up to and including the given line number, or raises ImportJobClaimed."""
+        if not ImportJob.objects.filter(id=self._job_id, status=JOB_STATUS_RUNNING, last_lineno=self.last_lineno).update(last_lineno=lineno):
+            raise ImportJobClaimed("Another process has claimed import job {job_id}.".format(
+                job_id = self._job_id,
+            ))
+        self.last_lineno = lineno
+
+    def save_progress(self, lineno):
+        """Adds the rows imported since the last chunk to the progress of the job."""
+        counts = (self.stats.row_count, self.stats.created_count, self.stats.updated_count, self.stats.invalid_count)
+        row_count, created_count, updated_count, invalid_count = (count - saved_count for count, saved_count in zip(counts, self._saved_counts))
+        ImportJob.objects.filter(id=self._job_id).update(
+            row_count = F("row_count") + row_count,
+            created_count = F("created_count") + created_count,
+            updated_count = F("updated_count") + updated_count,
+            invalid_count = F("invalid_count") + invalid_count,
+            invalid_linenos = u",".join(unicode(lineno) for lineno in self.stats.invalid_linenos),
+        )
+        self._saved_counts = counts
+
+
+def create_import_job(uploaded_file, mailing_lists=()):
+    """
+    Stores the given uploaded CSV file on disk, and creates a job to import
+    it in the background. The stored file is removed once it has been
+    imported by run_import_jobs().
+    """
+    import_dir = get_import_dir()
+    if not os.path.exists(import_dir):
+        os.makedirs(import_dir)
+    fd, path = tempfile.mkstemp(suffix=".csv", dir=import_dir)
+    with os.fdopen(fd, "wb") as handle:
+        for chunk in uploaded_file.chunks():
+            handle.write(chunk)
+    job = ImportJob.objects.create(
+        name = uploaded_file.name[:200],
+        path = path,
+    )
+    job.mailing_lists = mailing_lists
+    return job
+
+
+def run_import_job(job, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Runs the given import job.
+    
+    Each chunk of subscribers is claimed and committed in its own
+    transaction, along with the last imported line number, so an interrupted
+    job will resume from the last committed chunk. Concurrent processes can
+    safely run the same job, as each chunk is claimed by only one of them,
+    and a process that loses a claim leaves the rest of the job to the
+    other.
+    
+    If the CSV file cannot be read, the job is marked as failed, keeping its
+    progress and its file, so it can be resumed by retry_import_jobs().
+    """
+    # Re-read the job, as another process may have advanced it.
+    try:
+        job = ImportJob.objects.get(
+            id = job.id,
+            status__in = (JOB_STATUS_PENDING, JOB_STATUS_RUNNING),
+        )
+    except ImportJob.DoesNotExist:
+        return
+    # Start the job.
+    if job.status == JOB_STATUS_PENDING:
+        if not ImportJob.objects.filter(id=job.id, status=JOB_STATUS_PENDING).update(status=JOB_STATUS_RUNNING):
+            return  # Another process has started the job.
+    importer = ImportJobImporter(job, chunk_size)
+    try:
+        with open(job.path, "rb") as handle:
+            reader = csv.reader(handle)
+            headers = read_csv_headers(reader)
+            importer.import_rows(
+                (lineno, data)
+                for lineno, data in iter_csv_rows(reader, headers)
+                if lineno > job.last_lineno
+            )
+    except ImportJobClaimed:
+        return
+    except (IOError, csv.Error, CsvImportError) as ex:
+        # Fail the job, keeping the file so that the job can be retried.
+        ImportJob.objects.filter(id=job.id, status=JOB_STATUS_RUNNING, last_lineno=importer.last_lineno).update(
+            status = JOB_STATUS_FAILED,
+            status_message = unicode(ex),
+        )
+        return
+    # Finish the job, unless another process has claimed it.
+    if not ImportJob.objects.filter(id=job.id, status=JOB_STATUS_RUNNING, last_lineno=importer.last_lineno).update(
+        status = JOB_STATUS_COMPLETE,
+        status_message = u"",
+        date_completed = datetime.datetime.now(),
+    ):
+        return
+    # Remove uploaded files once they have been imported.
+    if os.path.dirname(os.path.abspath(job.path)) == os.path.abspath(get_import_dir()):
+        try:
+            os.remove(job.path)
+        except OSError:
+            pass
+
+
+def retry_import_jobs(queryset):
+    """
+    Returns the given failed import jobs to running, so they will resume
+    from their last imported line on the next call to run_import_jobs().
+    Returns the number of jobs retried.
+    """
+    return queryset.filter(status=JOB_STATUS_FAILED).update(
+        status = JOB_STATUS_RUNNING,
+        status_message = u"",
+    )
+
+
+def run_import_jobs(chunk_size=IMPORT_CHUNK_SIZE):
+    """Runs all unfinished import jobs, returning the ids of the jobs run."""
+    jobs = list(ImportJob.objects.filter(
+        status__in = (JOB_STATUS_PENDING, JOB_STATUS_RUNNING),
+    ).order_by("id"))
+    for job in jobs:
+        run_import_job(job, chunk_size)
+    return [job.id for job in jobs]
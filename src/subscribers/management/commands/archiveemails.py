@@ -0,0 +1,44 @@
+"""Archives finished emails."""
+
+import datetime
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from subscribers.models import ArchivedEmail
+
+
+# The number of emails archived per transaction.
+ARCHIVE_CHUNK_SIZE = 1000
+
+
+class Command(NoArgsCommand):
+
+    option_list = NoArgsCommand.option_list + (
+        make_option(
+            "--days",
+            default = 30,
+            dest = "days",
+            type = "int",
+            help = "Archives emails that finished more than this number of days ago. Defaults to 30.",
+        ),
+        make_option(
+            "--chunk-size",
+            default = ARCHIVE_CHUNK_SIZE,
+            dest = "chunk_size",
+            type = "int",
+            help = "Specifies the number of emails to archive per transaction.",
+        ),
+    )
+
+    help = "Moves sent, cancelled, unsubscribed and failed emails out of the dispatched email table and into the archive. Intended for inclusion in a crontab."
+
+    def handle_noargs(self, **kwargs):
+        verbosity = int(kwargs.get("verbosity"))
+        date_sent_before = datetime.datetime.now() - datetime.timedelta(days=kwargs["days"])
+        archived_count = ArchivedEmail.objects.archive(date_sent_before, kwargs["chunk_size"])
+        # Report on the results.
+        if verbosity >= 1:
+            self.stdout.write("Archived {count} emails\n".format(
+                count = archived_count,
+            ))
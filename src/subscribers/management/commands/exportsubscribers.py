@@ -0,0 +1,48 @@
+"""Exports subscribers to a CSV file."""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from subscribers.exporter import EXPORT_CHUNK_SIZE, export_subscribers
+from subscribers.models import Subscriber
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "--mailing-list",
+            action = "append",
+            default = [],
+            dest = "mailing_lists",
+            type = "int",
+            help = "Only exports members of the mailing list with the given id. Can be given more than once.",
+        ),
+        make_option(
+            "--chunk-size",
+            default = EXPORT_CHUNK_SIZE,
+            dest = "chunk_size",
+            type = "int",
+            help = "Specifies the number of subscribers to load per query.",
+        ),
+    )
+
+    args = "<path.csv>"
+
+    help = "Exports subscribers to the given CSV file, in the same format as the admin export action."
+
+    def handle(self, *args, **kwargs):
+        verbosity = int(kwargs.get("verbosity"))
+        if len(args) != 1:
+            raise CommandError("Please specify the CSV file to export to.")
+        qs = Subscriber.objects.all()
+        if kwargs["mailing_lists"]:
+            qs = qs.filter(mailing_lists__in=kwargs["mailing_lists"]).distinct()
+        with open(args[0], "wb") as handle:
+            count = export_subscribers(qs, handle, kwargs["chunk_size"])
+        # Report on the results.
+        if verbosity >= 1:
+            self.stdout.write("Exported {count} subscribers\n".format(
+                count = count,
+            ))
@@ -0,0 +1,77 @@
+"""Imports subscribers from CSV files."""
+
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from subscribers.importer import IMPORT_CHUNK_SIZE, run_import_job, run_import_jobs
+from subscribers.models import MailingList, ImportJob
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "--mailing-list",
+            action = "append",
+            default = [],
+            dest = "mailing_lists",
+            type = "int",
+            help = "Adds the imported subscribers to the mailing list with the given id. Can be given more than once.",
+        ),
+        make_option(
+            "--chunk-size",
+            default = IMPORT_CHUNK_SIZE,
+            dest = "chunk_size",
+            type = "int",
+            help = "Specifies the number of subscribers to import per transaction.",
+        ),
+    )
+
+    args = "[path.csv]"
+
+    help = "Imports subscribers from the given CSV file. If no file is given, runs any unfinished imports uploaded via the admin site. Intended for inclusion in a crontab."
+
+    def handle(self, *args, **kwargs):
+        verbosity = int(kwargs.get("verbosity"))
+        if len(args) > 1:
+            raise CommandError("Only one CSV file can be imported at a time.")
+        if args:
+            path = os.path.abspath(args[0])
+            if not os.path.exists(path):
+                raise CommandError("Could not find the CSV file {path}.".format(
+                    path = path,
+                ))
+            mailing_lists = list(MailingList.objects.filter(id__in=kwargs["mailing_lists"]))
+            if len(mailing_lists) != len(set(kwargs["mailing_lists"])):
+                raise CommandError("Could not find all of the mailing lists {ids}.".format(
+                    ids = ", ".join(str(mailing_list_id) for mailing_list_id in kwargs["mailing_lists"]),
+                ))
+            job = ImportJob.objects.create(
+                name = os.path.basename(path)[:200],
+                path = path,
+            )
+            job.mailing_lists = mailing_lists
+            run_import_job(job, kwargs["chunk_size"])
+            jobs = [ImportJob.objects.get(id=job.id)]
+        else:
+            if kwargs["mailing_lists"]:
+                raise CommandError("Mailing lists can only be given when importing a CSV file.")
+            job_ids = run_import_jobs(kwargs["chunk_size"])
+            jobs = ImportJob.objects.filter(id__in=job_ids)
+        # Report on the results.
+        if verbosity >= 1:
+            for job in jobs:
+                self.stdout.write(u"{name}: imported {row_count} subscribers ({created_count} created, {updated_count} updated), with {invalid_count} errors\n".format(
+                    name = job.name,
+                    row_count = job.row_count,
+                    created_count = job.created_count,
+                    updated_count = job.updated_count,
+                    invalid_count = job.invalid_count,
+                ))
+                if job.status_message:
+                    self.stdout.write(u"{name}: {status_message}\n".format(
+                        name = job.name,
+                        status_message = job.status_message,
+                    ))
@@ -0,0 +1,57 @@
+"""Rebuilds the sent counts from the history of sent emails."""
+
+from collections import defaultdict
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from subscribers.models import STATUS_SENT, DispatchedEmail, ArchivedEmail, SentCount
+
+
+# The number of sent emails to read per query.
+REBUILD_CHUNK_SIZE = 10000
+
+
+def count_sent_emails(model, counts):
+    """Adds the sent emails in the given email model to the counts, reading the history in chunks."""
+    last_id = 0
+    while True:
+        chunk = list(model.objects.filter(
+            id__gt = last_id,
+            status = STATUS_SENT,
+            date_sent__isnull = False,
+        ).order_by("id").values_list("id", "manager_slug", "date_sent")[:REBUILD_CHUNK_SIZE])
+        if not chunk:
+            break
+        for _, manager_slug, date_sent in chunk:
+            counts[(manager_slug, date_sent.date(), date_sent.hour)] += 1
+        last_id = chunk[-1][0]
+
+
+class Command(NoArgsCommand):
+
+    help = "Rebuilds the sent counts used to enforce sending limits from the history of sent emails, including archived emails. Intended to be run while no emails are being sent or archived."
+
+    def handle_noargs(self, **kwargs):
+        verbosity = int(kwargs.get("verbosity"))
+        # Count the sent emails, including those that have been archived.
+        counts = defaultdict(int)
+        count_sent_emails(DispatchedEmail, counts)
+        count_sent_emails(ArchivedEmail, counts)
+        # Replace the sent counts.
+        with transaction.commit_on_success():
+            SentCount.objects.all().delete()
+            SentCount.objects.bulk_create([
+                SentCount(
+                    manager_slug = manager_slug,
+                    date = date,
+                    hour = hour,
+                    count = count,
+                )
+                for (manager_slug, date, hour), count in counts.iteritems()
+            ], batch_size=REBUILD_CHUNK_SIZE)
+        # Report on the results.
+        if verbosity >= 1:
+            self.stdout.write("Rebuilt {count} sent counts\n".format(
+                count = len(counts),
+            ))
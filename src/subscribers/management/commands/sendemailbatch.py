@@ -1,6 +1,6 @@
 """Sends a batch of emails."""
 
-import datetime
+import datetime, signal, time
 from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
@@ -8,10 +8,28 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib import admin
 
 from subscribers.registration import default_email_manager
-from subscribers.models import STATUS_SENT, STATUS_CANCELLED, STATUS_UNSUBSCRIBED, STATUS_ERROR, DispatchedEmail
+from subscribers.transport import TRANSPORT_THREADED, TRANSPORT_ASYNC, get_transport
+from subscribers.pipeline import PipelineStats
+from subscribers.models import STATUS_PENDING, STATUS_SENT, STATUS_CANCELLED, STATUS_UNSUBSCRIBED, STATUS_ERROR, SentCount
 
 
-admin.autodiscover()
+# The number of dispatch job chunks processed before each batch, so large jobs don't delay sending.
+BATCH_DISPATCH_JOB_CHUNKS = 10
+
+# The number of dispatch job chunks processed before each batch in daemon mode.
+DAEMON_DISPATCH_JOB_CHUNKS = 1
+
+# The number of emails claimed per batch in daemon mode, if no batch size is given.
+DAEMON_BATCH_SIZE = 100
+
+# The shortest number of seconds to sleep between polls in daemon mode.
+DAEMON_MIN_POLL_INTERVAL = 0.1
+
+# The longest number of seconds to sleep between polls in daemon mode.
+DAEMON_MAX_POLL_INTERVAL = 1.0
+
+# The number of seconds that a daemon can be idle before its connections are closed.
+DAEMON_IDLE_TIMEOUT = 30
 
 
 class Command(BaseCommand):
@@ -24,13 +42,211 @@ class Command(BaseCommand):
             type = "int",
             help = "Specifies the maximum number of emails to send per day.",
         ),
+        make_option(
+            "--hourly-limit",
+            default = None,
+            dest = "hourly_limit",
+            type = "int",
+            help = "Specifies the maximum number of emails to send per hour.",
+        ),
+        make_option(
+            "--concurrency",
+            default = 1,
+            dest = "concurrency",
+            type = "int",
+            help = "Specifies the number of connections to send emails over concurrently.",
+        ),
+        make_option(
+            "--render-concurrency",
+            default = 1,
+            dest = "render_concurrency",
+            type = "int",
+            help = "Specifies the number of threads to render emails in, overlapping rendering with sending.",
+        ),
+        make_option(
+            "--transport",
+            default = TRANSPORT_THREADED,
+            dest = "transport",
+            type = "choice",
+            choices = (TRANSPORT_THREADED, TRANSPORT_ASYNC,),
+            help = "Specifies how concurrent connections are managed, either 'threaded' or 'async'.",
+        ),
+        make_option(
+            "--daemon",
+            action = "store_true",
+            default = False,
+            dest = "daemon",
+            help = "Keeps running, sending emails as soon as they are due, until stopped by SIGTERM or SIGINT.",
+        ),
     )
 
     args = "<batch_size>"
 
-    help = "Sends a batch of emails. Intended for inclusion in a crontab."
+    help = "Sends a batch of emails. Intended for inclusion in a crontab, or for running as a daemon with --daemon."
+    
+    def log(self, message, **kwargs):
+        """Writes a timestamped message to stdout."""
+        self.stdout.write("{timestamp} {message}\n".format(
+            timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            message = message.format(**kwargs),
+        ))
+    
+    def get_quota_remaining(self, daily_limit, hourly_limit):
+        """Returns the number of emails that can be sent now under the daily and hourly limits, or None if unlimited."""
+        now = datetime.datetime.now()
+        quotas_remaining = []
+        if daily_limit is not None:
+            sent_today_count = SentCount.objects.get_count(default_email_manager._manager_slug, now.date())
+            quotas_remaining.append(max(0, daily_limit - sent_today_count))
+        if hourly_limit is not None:
+            sent_this_hour_count = SentCount.objects.get_count(default_email_manager._manager_slug, now.date(), now.hour)
+            quotas_remaining.append(max(0, hourly_limit - sent_this_hour_count))
+        if quotas_remaining:
+            return min(quotas_remaining)
+        return None
+        
+    def get_batch_size(self, batch_size, daily_limit, hourly_limit):
+        """Limits the batch size based on the daily and hourly limits."""
+        quota_remaining = self.get_quota_remaining(daily_limit, hourly_limit)
+        if quota_remaining is None:
+            return batch_size
+        if batch_size is None:
+            return quota_remaining
+        return min(batch_size, quota_remaining)
+    
+    def run_dispatch_jobs(self, verbosity, max_chunks):
+        """Runs the next few chunks of any background dispatch jobs."""
+        job_dispatched_count = default_email_manager.run_dispatch_jobs(max_chunks=max_chunks)
+        if job_dispatched_count and verbosity >= 1:
+            self.log("dispatched {count} emails from background jobs", count=job_dispatched_count)
+    
+    def send_batch(self, batch_size, verbosity, report_empty=True, **kwargs):
+        """Sends a batch of emails, returning the number of emails processed."""
+        dispatched_count = 0
+        sent_count = 0
+        cancelled_count = 0
+        unsubscribed_count = 0
+        error_count = 0
+        retry_count = 0
+        stats = PipelineStats()
+        for dispatched_email in default_email_manager.send_email_batch_iter(batch_size, stats=stats, **kwargs):
+            dispatched_count += 1
+            log_params = {
+                "subscriber": dispatched_email.subscriber,
+                "model": ContentType.objects.get_for_id(dispatched_email.content_type_id).model_class().__name__,
+                "pk": dispatched_email.object_id,
+            }
+            if dispatched_email.status == STATUS_SENT:
+                sent_count += 1
+                if verbosity >= 3:
+                    self.stdout.write("  {subscriber} {model} #{pk} - Success\n".format(**log_params))
+            if dispatched_email.status == STATUS_CANCELLED:
+                cancelled_count += 1
+                if verbosity >= 3:
+                    self.stdout.write("  {subscriber} {model} #{pk} - Cancelled\n".format(**log_params))
+            if dispatched_email.status == STATUS_UNSUBSCRIBED:
+                unsubscribed_count += 1
+                if verbosity >= 3:
+                    self.stdout.write("  {subscriber} {model} #{pk} - Unsubscribed\n".format(**log_params))
+            if dispatched_email.status == STATUS_ERROR:
+                error_count += 1
+                if verbosity >= 3:
+                    self.stdout.write("  {subscriber} {model} #{pk} - Error\n".format(**log_params))
+            if dispatched_email.status == STATUS_PENDING:
+                retry_count += 1
+                if verbosity >= 3:
+                    self.stdout.write("  {subscriber} {model} #{pk} - Retrying\n".format(**log_params))
+        # Report on the results.
+        if not dispatched_count and not report_empty:
+            return dispatched_count
+        if verbosity >= 1:
+            self.stdout.write("Processed {count} emails\n".format(
+                count = dispatched_count,
+            ))
+        if verbosity >= 2:
+            self.stdout.write("  {count} successful\n".format(
+                count = sent_count,
+            ))
+            self.stdout.write("  {count} cancelled\n".format(
+                count = cancelled_count,
+            ))
+            self.stdout.write("  {count} unsubscribed\n".format(
+                count = unsubscribed_count,
+            ))
+            self.stdout.write("  {count} error\n".format(
+                count = error_count,
+            ))
+            self.stdout.write("  {count} retrying\n".format(
+                count = retry_count,
+            ))
+            self.stdout.write("  timings - {stats}\n".format(
+                stats = unicode(stats),
+            ))
+        return dispatched_count
+    
+    def handle_stop_signal(self, signum, frame):
+        """Stops the daemon once any in-flight emails have been sent."""
+        self.stopping = True
+    
+    def is_stopping(self):
+        """Whether the daemon has been asked to stop."""
+        return self.stopping
+    
+    def sleep(self, seconds):
+        """Sleeps for the given number of seconds, waking early if the daemon is stopping."""
+        wake_time = time.time() + seconds
+        while not self.stopping and time.time() < wake_time:
+            time.sleep(min(0.1, max(0, wake_time - time.time())))
+    
+    def run_daemon(self, batch_size, daily_limit, hourly_limit, verbosity, concurrency, transport, render_concurrency):
+        """Sends emails as soon as they are due, until stopped by a signal."""
+        self.stopping = False
+        previous_handlers = dict(
+            (signum, signal.signal(signum, self.handle_stop_signal))
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        )
+        if verbosity >= 1:
+            self.log("starting email daemon...")
+        try:
+            poll_interval = DAEMON_MIN_POLL_INTERVAL
+            email_transport = None
+            last_active = time.time()
+            try:
+                while not self.stopping:
+                    self.run_dispatch_jobs(verbosity, DAEMON_DISPATCH_JOB_CHUNKS)
+                    daemon_batch_size = self.get_batch_size(batch_size or DAEMON_BATCH_SIZE, daily_limit, hourly_limit)
+                    dispatched_count = 0
+                    if daemon_batch_size > 0:
+                        # Keep the connections open between batches.
+                        if email_transport is None:
+                            email_transport = get_transport(concurrency, transport)
+                        # Stop claiming emails as soon as the daemon is stopping, releasing any that are still unsent.
+                        dispatched_count = self.send_batch(daemon_batch_size, verbosity, report_empty=False, transport=email_transport, render_concurrency=render_concurrency, should_stop=self.is_stopping)
+                    # Adapt the poll interval to the amount of work available, backing off fully while over quota.
+                    if daemon_batch_size <= 0:
+                        poll_interval = DAEMON_MAX_POLL_INTERVAL
+                    elif dispatched_count:
+                        poll_interval = DAEMON_MIN_POLL_INTERVAL
+                        last_active = time.time()
+                    else:
+                        poll_interval = min(poll_interval * 2, DAEMON_MAX_POLL_INTERVAL)
+                    if not dispatched_count and email_transport is not None and time.time() - last_active > DAEMON_IDLE_TIMEOUT:
+                        email_transport.close()
+                        email_transport = None
+                    if not dispatched_count or dispatched_count < daemon_batch_size:
+                        self.sleep(poll_interval)
+            finally:
+                if email_transport is not None:
+                    email_transport.close()
+        finally:
+            for signum, handler in previous_handlers.iteritems():
+                signal.signal(signum, handler)
+        if verbosity >= 1:
+            self.log("stopped email daemon.")
     
     def handle(self, *args, **kwargs):
+        # Register any email admins, so their email managers are populated.
+        admin.autodiscover()
         # Parse the batch size.
         if len(args) == 1:
             batch_size = int(args[0])
@@ -38,82 +254,26 @@ class Command(BaseCommand):
             batch_size = None
         else:
             raise CommandError("This command accepts zero or one arguments.")
-        # Limit the batch size based on daily limit.
         daily_limit = kwargs["daily_limit"]
-        if daily_limit is not None:
-            today = datetime.datetime.now().date()
-            day_start = datetime.datetime(today.year, today.month, today.day, 0, 0, 0)
-            day_end = datetime.datetime(today.year, today.month, today.day, 23, 59, 59)
-            sent_today_count = DispatchedEmail.objects.filter(
-                manager_slug = default_email_manager._manager_slug,
-                status = STATUS_SENT,
-                date_sent__gte = day_start,
-                date_sent__lte = day_end,
-            ).count()
-            quota_remaining = max(0, daily_limit - sent_today_count)
-            if batch_size is None:
-                batch_size = quota_remaining
-            else:
-                batch_size = min(batch_size, quota_remaining)
+        hourly_limit = kwargs["hourly_limit"]
         # Parse the verbosity.
         verbosity = int(kwargs.get("verbosity"))
+        # Run as a daemon.
+        if kwargs["daemon"]:
+            self.run_daemon(batch_size, daily_limit, hourly_limit, verbosity, kwargs["concurrency"], kwargs["transport"], kwargs["render_concurrency"])
+            return
+        # Limit the batch size based on the daily and hourly limits.
+        batch_size = self.get_batch_size(batch_size, daily_limit, hourly_limit)
+        # Run any background dispatch jobs.
+        self.run_dispatch_jobs(verbosity, BATCH_DISPATCH_JOB_CHUNKS)
         # Send the emails.
         if batch_size is None or batch_size > 0:
             # Log an initial message.
             if verbosity >= 1:
-                self.stdout.write("{timestamp} sending email batch...\n".format(
-                    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                ))
+                self.log("sending email batch...")
             # Send the email chunk.
-            dispatched_count = 0
-            sent_count = 0
-            cancelled_count = 0
-            unsubscribed_count = 0
-            error_count = 0
-            for dispatched_email in default_email_manager.send_email_batch_iter(batch_size):
-                dispatched_count += 1
-                log_params = {
-                    "subscriber": dispatched_email.subscriber,
-                    "model": ContentType.objects.get_for_id(dispatched_email.content_type_id).model_class().__name__,
-                    "pk": dispatched_email.object_id,
-                }
-                if dispatched_email.status == STATUS_SENT:
-                    sent_count += 1
-                    if verbosity >= 3:
-                        self.stdout.write("  {subscriber} {model} #{pk} - Success\n".format(**log_params))
-                if dispatched_email.status == STATUS_CANCELLED:
-                    cancelled_count += 1
-                    if verbosity >= 3:
-                        self.stdout.write("  {subscriber} {model} #{pk} - Cancelled\n".format(**log_params))
-                if dispatched_email.status == STATUS_UNSUBSCRIBED:
-                    unsubscribed_count += 1
-                    if verbosity >= 3:
-                        self.stdout.write("  {subscriber} {model} #{pk} - Unsubscribed\n".format(**log_params))
-                if dispatched_email.status == STATUS_ERROR:
-                    error_count += 1
-                    if verbosity >= 3:
-                        self.stdout.write("  {subscriber} {model} #{pk} - Error\n".format(**log_params))
-            # Report on the results.
-            if verbosity >= 1:
-                self.stdout.write("Processed {count} emails\n".format(
-                    count = dispatched_count,
-                ))
-            if verbosity >= 2:
-                self.stdout.write("  {count} successful\n".format(
-                    count = sent_count,
-                ))
-                self.stdout.write("  {count} cancelled\n".format(
-                    count = cancelled_count,
-                ))
-                self.stdout.write("  {count} unsubscribed\n".format(
-                    count = unsubscribed_count,
-                ))
-                self.stdout.write("  {count} error\n".format(
-                    count = error_count,
-                ))
+            self.send_batch(batch_size, verbosity, concurrency=kwargs["concurrency"], transport=kwargs["transport"], render_concurrency=kwargs["render_concurrency"])
         else:
             # Log the quota expired message.
             if verbosity >= 1:
-                self.stdout.write("{timestamp} daily limit exceeded.\n".format(
-                    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                ))
\ No newline at end of file
+                self.log("sending limit exceeded.")
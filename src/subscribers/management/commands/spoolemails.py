@@ -0,0 +1,57 @@
+"""Renders pending emails ahead of time."""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib import admin
+
+from subscribers.registration import default_email_manager
+from subscribers.pipeline import PipelineStats
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "--ahead",
+            default = None,
+            dest = "ahead",
+            type = "int",
+            help = "Only renders emails that are due to be sent within this number of seconds.",
+        ),
+        make_option(
+            "--render-concurrency",
+            default = 1,
+            dest = "render_concurrency",
+            type = "int",
+            help = "Specifies the number of threads to render emails in.",
+        ),
+    )
+
+    args = "<batch_size>"
+
+    help = "Renders pending emails ahead of time, so sendemailbatch can send them without rendering. Intended to be run in its own process, alongside sendemailbatch."
+
+    def handle(self, *args, **kwargs):
+        # Register any email admins, so their email managers are populated.
+        admin.autodiscover()
+        # Parse the batch size.
+        if len(args) == 1:
+            batch_size = int(args[0])
+        elif len(args) == 0:
+            batch_size = None
+        else:
+            raise CommandError("This command accepts zero or one arguments.")
+        verbosity = int(kwargs.get("verbosity"))
+        # Spool the emails.
+        stats = PipelineStats()
+        spooled_count = default_email_manager.spool_emails(batch_size, spool_ahead=kwargs["ahead"], render_concurrency=kwargs["render_concurrency"], stats=stats)
+        # Report on the results.
+        if verbosity >= 1:
+            self.stdout.write("Spooled {count} emails\n".format(
+                count = spooled_count,
+            ))
+        if verbosity >= 2:
+            self.stdout.write("  timings - {stats}\n".format(
+                stats = unicode(stats),
+            ))
@@ -1,11 +1,21 @@
 """Models used by django-subscribers."""
 
-import hashlib
+import hashlib, zlib
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
-from django.db import models
+from django.db import models, connections, router, transaction, IntegrityError
+from django.db.models import F, Sum
+from django.db.models.query import EmptyQuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+
+
+# Database backends that can insert rows using a single INSERT ... SELECT.
+INSERT_SELECT_VENDORS = ("postgresql", "sqlite", "mysql",)
+
+# The number of rows to insert per query on other database backends.
+MEMBERSHIP_CHUNK_SIZE = 1000
 
 
 def has_int_pk(model):
@@ -32,6 +42,97 @@ class MailingList(models.Model):
         max_length = 200,
     )
     
+    def _get_subscriber_ids_sql(self, subscribers, connection):
+        """Returns the SQL and params that select the ids of the given queryset of subscribers."""
+        subscriber_ids = subscribers.order_by().values_list("pk", flat=True)
+        return subscriber_ids.query.get_compiler(connection=connection).as_sql()
+    
+    def add_subscribers(self, subscribers):
+        """
+        Adds every subscriber in the given queryset to this mailing list,
+        skipping existing members. Returns the number of subscribers added.
+        
+        On databases that support it, the memberships are added using a single
+        INSERT ... SELECT statement, otherwise they are inserted in chunks of
+        MEMBERSHIP_CHUNK_SIZE rows. No m2m_changed signals are sent.
+        """
+        if isinstance(subscribers, EmptyQuerySet):
+            return 0
+        Membership = Subscriber.mailing_lists.through
+        db = router.db_for_write(Membership)
+        connection = connections[db]
+        # Use a set-based insert, if available.
+        if connection.vendor in INSERT_SELECT_VENDORS:
+            qn = connection.ops.quote_name
+            try:
+                subquery_sql, subquery_params = self._get_subscriber_ids_sql(subscribers, connection)
+            except EmptyResultSet:
+                return 0
+            sql = u"INSERT INTO {table} ({subscriber_column}, {mailing_list_column}) SELECT {subscriber_table}.{subscriber_pk}, %s FROM {subscriber_table} WHERE {subscriber_table}.{subscriber_pk} IN ({subquery}) AND NOT EXISTS (SELECT 1 FROM {table} WHERE {table}.{subscriber_column} = {subscriber_table}.{subscriber_pk} AND {table}.{mailing_list_column} = %s)".format(
+                table = qn(Membership._meta.db_table),
+                subscriber_column = qn(Membership._meta.get_field("subscriber").column),
+                mailing_list_column = qn(Membership._meta.get_field("mailinglist").column),
+                subscriber_table = qn(Subscriber._meta.db_table),
+                subscriber_pk = qn(Subscriber._meta.pk.column),
+                subquery = subquery_sql,
+            )
+            cursor = connection.cursor()
+            cursor.execute(sql, [self.pk] + list(subquery_params) + [self.pk])
+            transaction.commit_unless_managed(using=db)
+            return cursor.rowcount
+        # Insert the memberships in chunks.
+        count = 0
+        subscriber_ids = subscribers.order_by().values_list("pk", flat=True).iterator()
+        while True:
+            chunk = []
+            for subscriber_id in subscriber_ids:
+                chunk.append(subscriber_id)
+                if len(chunk) >= MEMBERSHIP_CHUNK_SIZE:
+                    break
+            if not chunk:
+                break
+            existing_subscriber_ids = set(Membership.objects.using(db).filter(
+                mailinglist = self,
+                subscriber__in = chunk,
+            ).values_list("subscriber_id", flat=True))
+            new_memberships = [
+                Membership(subscriber_id=subscriber_id, mailinglist_id=self.pk)
+                for subscriber_id in chunk
+                if subscriber_id not in existing_subscriber_ids
+            ]
+            Membership.objects.using(db).bulk_create(new_memberships)
+            count += len(new_memberships)
+        return count
+    
+    def remove_subscribers(self, subscribers):
+        """
+        Removes every subscriber in the given queryset from this mailing list,
+        using a single DELETE statement. Returns the number of subscribers
+        removed. No m2m_changed signals are sent.
+        """
+        if isinstance(subscribers, EmptyQuerySet):
+            return 0
+        Membership = Subscriber.mailing_lists.through
+        db = router.db_for_write(Membership)
+        connection = connections[db]
+        qn = connection.ops.quote_name
+        try:
+            subquery_sql, subquery_params = self._get_subscriber_ids_sql(subscribers, connection)
+        except EmptyResultSet:
+            return 0
+        # The subquery is wrapped in a derived table, as MySQL cannot delete from a table that the subquery selects from.
+        sql = u"DELETE FROM {table} WHERE {table}.{mailing_list_column} = %s AND {table}.{subscriber_column} IN (SELECT subscriber_ids.{subscriber_pk} FROM ({subquery}) subscriber_ids)".format(
+            table = qn(Membership._meta.db_table),
+            subscriber_column = qn(Membership._meta.get_field("subscriber").column),
+            mailing_list_column = qn(Membership._meta.get_field("mailinglist").column),
+            subscriber_pk = qn(Subscriber._meta.pk.column),
+            subquery = subquery_sql,
+        )
+        cursor = connection.cursor()
+        cursor.execute(sql, [self.pk] + list(subquery_params))
+        transaction.commit_unless_managed(using=db)
+        return cursor.rowcount
+    
     def __unicode__(self):
         """Returns the name of the mailing list."""
         return self.name
@@ -149,6 +250,7 @@ STATUS_SENT = 1
 STATUS_CANCELLED = 2
 STATUS_UNSUBSCRIBED = 3
 STATUS_ERROR = 4
+STATUS_SENDING = 5
 
 STATUS_CHOICES = (
     (STATUS_PENDING, "Pending"),
@@ -156,6 +258,18 @@ STATUS_CHOICES = (
     (STATUS_CANCELLED, "Cancelled"),
     (STATUS_UNSUBSCRIBED, "Unsubscribed"),
     (STATUS_ERROR, "Error"),
+    (STATUS_SENDING, "Sending"),
+)
+
+
+PRIORITY_LOW = -1
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 1
+
+PRIORITY_CHOICES = (
+    (PRIORITY_LOW, "Low"),
+    (PRIORITY_NORMAL, "Normal"),
+    (PRIORITY_HIGH, "High"),
 )
 
 
@@ -174,9 +288,40 @@ def get_secure_hash(obj, subscriber):
     ).hexdigest()
 
 
+def get_object_id_hash(object_id):
+    """Returns a short integer hash of the given object id, used to index non-integer object ids."""
+    return zlib.crc32(unicode(object_id).encode("utf-8")) & 0x7fffffff
+
+
+class DispatchedEmailManager(models.Manager):
+
+    """Manager for the dispatched and archived email models."""
+    
+    def for_object(self, obj):
+        """
+        Returns the emails dispatched for the given object.
+        
+        Integer object ids are looked up using the indexed object_id_int
+        column, and other object ids using the indexed object_id_hash column.
+        """
+        emails = self.filter(
+            content_type = ContentType.objects.get_for_model(obj),
+        )
+        if has_int_pk(obj.__class__):
+            return emails.filter(
+                object_id_int = obj.pk,
+            )
+        return emails.filter(
+            object_id_hash = get_object_id_hash(obj.pk),
+            object_id = unicode(obj.pk),
+        )
+
+
 class DispatchedEmail(models.Model):
 
     """A batch mailing task."""
+    
+    objects = DispatchedEmailManager()
 
     date_created = models.DateTimeField(
         auto_now_add = True,
@@ -209,6 +354,12 @@ class DispatchedEmail(models.Model):
         null = True,
     )
     
+    # Non-integer object ids are looked up using a composite index on (content_type, object_id_hash).
+    object_id_hash = models.IntegerField(
+        blank = True,
+        null = True,
+    )
+    
     object = generic.GenericForeignKey()
     
     subscriber = models.ForeignKey(
@@ -225,9 +376,389 @@ class DispatchedEmail(models.Model):
         blank = True,
     )
     
+    # Pending emails are claimed using a composite index on (manager_slug, status, priority, id),
+    # and on PostgreSQL, a partial index on (manager_slug, priority, id) covering only unsent emails.
+    priority = models.IntegerField(
+        default = PRIORITY_NORMAL,
+        choices = PRIORITY_CHOICES,
+        help_text = "Emails are sent from each priority in proportion to the SUBSCRIBERS_PRIORITY_WEIGHTS setting.",
+    )
+    
+    worker_id = models.CharField(
+        max_length = 200,
+        blank = True,
+        help_text = "The sending worker that has claimed this email.",
+    )
+    
+    lease_expires = models.DateTimeField(
+        db_index = True,
+        blank = True,
+        null = True,
+        help_text = "If the email is still being sent after this time, it may be claimed by another worker.",
+    )
+    
+    attempt_count = models.IntegerField(
+        default = 0,
+        help_text = "The number of attempts made to send this email.",
+    )
+    
+    date_next_attempt = models.DateTimeField(
+        db_index = True,
+        blank = True,
+        null = True,
+        help_text = "If the email failed to send with a transient error, it will be retried after this time.",
+    )
+    
     def __unicode__(self):
         """Returns a unicode representation."""
         return unicode(self.object)
         
     class Meta:
-        ordering = ("id",)
\ No newline at end of file
+        ordering = ("id",)
+
+
+# The statuses of emails that have finished, and can be archived.
+ARCHIVABLE_STATUSES = (STATUS_SENT, STATUS_CANCELLED, STATUS_UNSUBSCRIBED, STATUS_ERROR,)
+
+
+class ArchivedEmailManager(DispatchedEmailManager):
+
+    """Manager for the archived email model."""
+    
+    def archive(self, date_sent_before, chunk_size=1000):
+        """
+        Moves finished emails sent before the given date from the dispatched
+        email table to the archive. Returns the number of emails archived.
+        
+        The emails are moved in chunks of chunk_size emails, in id order, with
+        each chunk moved in its own short transaction.
+        """
+        archived_count = 0
+        last_id = 0
+        while True:
+            with transaction.commit_on_success():
+                dispatched_emails = list(DispatchedEmail.objects.filter(
+                    id__gt = last_id,
+                    status__in = ARCHIVABLE_STATUSES,
+                    date_sent__lt = date_sent_before,
+                ).order_by("id").values_list("id", "manager_slug", "content_type_id", "object_id", "object_id_int", "object_id_hash", "subscriber_id", "status", "date_sent")[:chunk_size])
+                if not dispatched_emails:
+                    break
+                ids = [dispatched_email[0] for dispatched_email in dispatched_emails]
+                self.bulk_create([
+                    ArchivedEmail(
+                        manager_slug = manager_slug,
+                        content_type_id = content_type_id,
+                        object_id = object_id,
+                        object_id_int = object_id_int,
+                        object_id_hash = object_id_hash,
+                        subscriber_id = subscriber_id,
+                        status = status,
+                        date_sent = date_sent,
+                    )
+                    for _, manager_slug, content_type_id, object_id, object_id_int, object_id_hash, subscriber_id, status, date_sent
+                    in dispatched_emails
+                ])
+                DispatchedEmail.objects.filter(id__in=ids).delete()
+            archived_count += len(dispatched_emails)
+            last_id = ids[-1]
+        return archived_count
+
+
+class ArchivedEmail(models.Model):
+
+    """
+    A finished email that has been moved out of the dispatched email table.
+    
+    Only the fields needed to tell whether a subscriber has received an
+    email, and to rebuild the sent counts, are kept.
+    """
+    
+    objects = ArchivedEmailManager()
+    
+    manager_slug = models.CharField(
+        max_length = 200,
+    )
+    
+    content_type = models.ForeignKey(
+        ContentType,
+    )
+    
+    object_id = models.TextField()
+    
+    object_id_int = models.IntegerField(
+        blank = True,
+        null = True,
+    )
+    
+    # Object ids are looked up using composite indexes on (content_type, object_id_int) and (content_type, object_id_hash).
+    object_id_hash = models.IntegerField(
+        blank = True,
+        null = True,
+    )
+    
+    object = generic.GenericForeignKey()
+    
+    subscriber = models.ForeignKey(
+        Subscriber,
+    )
+    
+    status = models.IntegerField(
+        choices = STATUS_CHOICES,
+    )
+    
+    date_sent = models.DateTimeField(
+        blank = True,
+        null = True,
+    )
+    
+    def __unicode__(self):
+        """Returns a unicode representation."""
+        return unicode(self.object)
+        
+    class Meta:
+        ordering = ("id",)
+
+
+class SpooledMessage(models.Model):
+
+    """A pre-rendered message for a dispatched email, ready to be sent without rendering."""
+    
+    dispatched_email = models.OneToOneField(
+        DispatchedEmail,
+        primary_key = True,
+    )
+    
+    date_created = models.DateTimeField(
+        auto_now_add = True,
+    )
+    
+    data = models.TextField(
+        help_text = "The compressed message, as serialized by subscribers.spool.serialize_email().",
+    )
+    
+    def __unicode__(self):
+        """Returns a unicode representation."""
+        return unicode(self.dispatched_email)
+
+
+JOB_STATUS_PENDING = 0
+JOB_STATUS_RUNNING = 1
+JOB_STATUS_COMPLETE = 2
+JOB_STATUS_FAILED = 3
+
+JOB_STATUS_CHOICES = (
+    (JOB_STATUS_PENDING, "Pending"),
+    (JOB_STATUS_RUNNING, "Running"),
+    (JOB_STATUS_COMPLETE, "Complete"),
+    (JOB_STATUS_FAILED, "Failed"),
+)
+
+
+class DispatchJob(models.Model):
+
+    """A background task that dispatches an email to a list of subscribers."""
+    
+    date_created = models.DateTimeField(
+        auto_now_add = True,
+    )
+    
+    date_completed = models.DateTimeField(
+        blank = True,
+        null = True,
+    )
+    
+    manager_slug = models.CharField(
+        db_index = True,
+        max_length = 200,
+    )
+    
+    content_type = models.ForeignKey(
+        ContentType,
+    )
+    
+    object_id = models.TextField()
+    
+    object_id_int = models.IntegerField(
+        db_index = True,
+        blank = True,
+        null = True,
+    )
+    
+    object = generic.GenericForeignKey()
+    
+    mailing_list = models.ForeignKey(
+        MailingList,
+        blank = True,
+        null = True,
+        help_text = "If empty, the email will be sent to all subscribers.",
+    )
+    
+    date_to_send = models.DateTimeField()
+    
+    status = models.IntegerField(
+        default = JOB_STATUS_PENDING,
+        choices = JOB_STATUS_CHOICES,
+        db_index = True,
+    )
+    
+    subscriber_count = models.IntegerField(
+        default = 0,
+    )
+    
+    dispatched_count = models.IntegerField(
+        default = 0,
+    )
+    
+    last_subscriber_id = models.IntegerField(
+        default = 0,
+    )
+    
+    def __unicode__(self):
+        """Returns a unicode representation."""
+        return unicode(self.object)
+        
+    class Meta:
+        ordering = ("id",)
+
+
+class ImportJob(models.Model):
+
+    """A background task that imports subscribers from a CSV file."""
+    
+    date_created = models.DateTimeField(
+        auto_now_add = True,
+    )
+    
+    date_completed = models.DateTimeField(
+        blank = True,
+        null = True,
+    )
+    
+    name = models.CharField(
+        max_length = 200,
+        help_text = "The name of the imported file.",
+    )
+    
+    path = models.CharField(
+        max_length = 1000,
+        help_text = "The location of the CSV file on disk.",
+    )
+    
+    mailing_lists = models.ManyToManyField(
+        MailingList,
+        blank = True,
+        help_text = "The imported subscribers will be added to these mailing lists.",
+    )
+    
+    status = models.IntegerField(
+        default = JOB_STATUS_PENDING,
+        choices = JOB_STATUS_CHOICES,
+        db_index = True,
+    )
+    
+    status_message = models.TextField(
+        blank = True,
+    )
+    
+    last_lineno = models.IntegerField(
+        default = 0,
+        help_text = "The last line of the CSV file that has been imported.",
+    )
+    
+    row_count = models.IntegerField(
+        default = 0,
+    )
+    
+    created_count = models.IntegerField(
+        default = 0,
+    )
+    
+    updated_count = models.IntegerField(
+        default = 0,
+    )
+    
+    invalid_count = models.IntegerField(
+        default = 0,
+    )
+    
+    invalid_linenos = models.TextField(
+        blank = True,
+        help_text = "The line numbers of the first few invalid rows, separated by commas.",
+    )
+    
+    def get_invalid_linenos(self):
+        """Returns the line numbers of the first few invalid rows."""
+        return [int(lineno) for lineno in self.invalid_linenos.split(",") if lineno]
+    
+    def __unicode__(self):
+        """Returns a unicode representation."""
+        return self.name
+        
+    class Meta:
+        ordering = ("-id",)
+
+
+class SentCountManager(models.Manager):
+
+    """Manager for the sent count model."""
+    
+    def increment(self, manager_slug, date_sent, count=1):
+        """Adds the given number of emails to the sent count for the hour of date_sent."""
+        lookup = {
+            "manager_slug": manager_slug,
+            "date": date_sent.date(),
+            "hour": date_sent.hour,
+        }
+        if self.filter(**lookup).update(count=F("count") + count):
+            return
+        # Create the sent count, allowing for another worker creating it first.
+        sid = transaction.savepoint()
+        try:
+            self.create(count=count, **lookup)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            self.filter(**lookup).update(count=F("count") + count)
+        else:
+            transaction.savepoint_commit(sid)
+    
+    def get_count(self, manager_slug, date, hour=None):
+        """Returns the number of emails sent on the given date, or during the given hour of that date."""
+        sent_counts = self.filter(
+            manager_slug = manager_slug,
+            date = date,
+        )
+        if hour is not None:
+            sent_counts = sent_counts.filter(hour=hour)
+        return sent_counts.aggregate(count=Sum("count"))["count"] or 0
+
+
+class SentCount(models.Model):
+
+    """The number of emails sent by an email manager during an hour."""
+    
+    objects = SentCountManager()
+    
+    manager_slug = models.CharField(
+        max_length = 200,
+    )
+    
+    date = models.DateField()
+    
+    hour = models.IntegerField()
+    
+    count = models.IntegerField(
+        default = 0,
+    )
+    
+    def __unicode__(self):
+        """Returns a unicode representation."""
+        return u"{manager_slug} {date} {hour:02d}:00".format(
+            manager_slug = self.manager_slug,
+            date = self.date,
+            hour = self.hour,
+        )
+        
+    class Meta:
+        unique_together = (("manager_slug", "date", "hour",),)
+        ordering = ("date", "hour",)
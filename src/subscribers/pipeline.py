@@ -0,0 +1,214 @@
+"""Pipeline stages used to overlap the work of sending a batch of emails."""
+
+import sys, threading, time
+from Queue import Queue, Empty
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import connections
+
+
+# The pipeline stages that are timed.
+STAGE_FETCH = "fetch"
+STAGE_RENDER = "render"
+STAGE_TRANSPORT = "transport"
+STAGE_WRITE = "write"
+
+PIPELINE_STAGES = (STAGE_FETCH, STAGE_RENDER, STAGE_TRANSPORT, STAGE_WRITE,)
+
+# The number of seconds to wait for a rendered email when no email is ready to render.
+RENDER_IDLE_WAIT = 0.05
+
+
+class PipelineStats(object):
+
+    """
+    Timings for each stage of sending a batch of emails.
+
+    For each stage, count is the number of times the stage ran, and seconds
+    is the total time spent in the stage. Stages that run in worker threads
+    can spend more seconds than the batch took to send.
+    """
+
+    def __init__(self):
+        """Initializes the pipeline stats."""
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.counts = defaultdict(int)
+        self.seconds = defaultdict(float)
+
+    def add(self, stage, seconds, count=1):
+        """Records time spent in the given stage."""
+        with self._lock:
+            self.counts[stage] += count
+            self.seconds[stage] += seconds
+        self._local.seconds = self.get_thread_seconds() + seconds
+
+    def get_thread_seconds(self):
+        """Returns the total time recorded against all stages by the current thread."""
+        return getattr(self._local, "seconds", 0.0)
+
+    def time_iter(self, stage, iterable):
+        """
+        Iterates over the given iterable, recording the time spent waiting for
+        each item against the given stage, less any time recorded against other
+        stages by the current thread while waiting.
+        """
+        iterator = iter(iterable)
+        while True:
+            start_time = time.time()
+            start_thread_seconds = self.get_thread_seconds()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(stage, time.time() - start_time - (self.get_thread_seconds() - start_thread_seconds))
+            yield item
+
+    @contextmanager
+    def time(self, stage, count=1):
+        """Records the time spent in the managed block against the given stage."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start_time, count)
+
+    def __unicode__(self):
+        """Returns a summary of the stage timings."""
+        return u", ".join(
+            u"{stage}: {count} in {seconds:.2f}s".format(
+                stage = stage,
+                count = self.counts[stage],
+                seconds = self.seconds[stage],
+            )
+            for stage in PIPELINE_STAGES
+        )
+
+
+def render_iter(jobs, stats):
+    """
+    Renders the given iterable of (key, render, args) jobs on the calling
+    thread, returning an iterator of (key, email) pairs. Any None jobs are
+    passed on.
+    """
+    for job in jobs:
+        if job is None:
+            yield None
+            continue
+        key, render, args = job
+        with stats.time(STAGE_RENDER):
+            email = render(*args)
+        yield key, email
+
+
+class RenderPool(object):
+
+    """
+    Renders emails in a pool of worker threads, so rendering overlaps with
+    fetching emails from the database and sending them.
+
+    Only rendering happens in the worker threads. The emails to render are
+    read, their template params prepared, and the rendered emails returned,
+    on the calling thread. Any database connections opened by a worker
+    thread, such as by a template that queries the database, are closed
+    when the worker finishes.
+    """
+
+    def __init__(self, concurrency, queue_size, stats):
+        """Initializes the render pool."""
+        self._queue_size = queue_size
+        self._stats = stats
+        self._job_queue = Queue(queue_size)
+        self._result_queue = Queue()
+        self._threads = [
+            threading.Thread(
+                target = self._render_worker,
+                name = "subscribers-renderer-{index}".format(index=index),
+            )
+            for index in xrange(concurrency)
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _render_worker(self):
+        """Renders emails from the job queue until a None sentinel is received."""
+        try:
+            while True:
+                job = self._job_queue.get()
+                if job is None:
+                    break
+                key, render, args = job
+                try:
+                    with self._stats.time(STAGE_RENDER):
+                        email = render(*args)
+                except Exception:
+                    self._result_queue.put((key, None, sys.exc_info()))
+                else:
+                    self._result_queue.put((key, email, None))
+        finally:
+            # Database connections are per thread, so would otherwise be left open.
+            for connection in connections.all():
+                connection.close()
+
+    def _get_result(self, timeout=None):
+        """Waits for a rendered email, re-raising any rendering error on the calling thread."""
+        key, email, exc_info = self._result_queue.get(timeout=timeout)
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return key, email
+
+    def render_iter(self, jobs):
+        """
+        Renders the given iterable of (key, render, args) jobs.
+
+        Returns an iterator of (key, email) pairs, in the order that the
+        emails finished rendering. The iterable may yield None when no job
+        is ready, which is passed on if no rendered email is ready either.
+        """
+        in_flight_count = 0
+        for job in jobs:
+            if job is None:
+                # Wait for an in-flight email to finish rendering.
+                if in_flight_count:
+                    try:
+                        result = self._get_result(timeout=RENDER_IDLE_WAIT)
+                    except Empty:
+                        yield None
+                    else:
+                        in_flight_count -= 1
+                        yield result
+                else:
+                    yield None
+                continue
+            # Wait for space in the render queue.
+            while in_flight_count >= self._queue_size:
+                in_flight_count -= 1
+                yield self._get_result()
+            self._job_queue.put(job)
+            in_flight_count += 1
+            # Return any rendered emails.
+            while True:
+                try:
+                    result = self._get_result(timeout=0)
+                except Empty:
+                    break
+                in_flight_count -= 1
+                yield result
+        # Wait for the remaining emails.
+        while in_flight_count:
+            in_flight_count -= 1
+            yield self._get_result()
+
+    def close(self):
+        """Closes the render pool, waiting for all worker threads to finish."""
+        while True:
+            try:
+                self._job_queue.get_nowait()
+            except Empty:
+                break
+        for thread in self._threads:
+            self._job_queue.put(None)
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,249 @@
+"""Rate limiting for sending emails."""
+
+import datetime, math, time
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+
+
+# The length of each rate limit period, in seconds.
+RATE_LIMIT_PERIODS = {
+    "second": 1,
+    "minute": 60,
+    "hour": 60 * 60,
+    "day": 60 * 60 * 24,
+}
+
+# Periods short enough that sends should be spaced evenly within them, rather than sent in bursts.
+PACED_PERIODS = ("second", "minute",)
+
+# The maximum number of seconds to wait for the rate limit before giving up on a batch.
+RATE_LIMIT_MAX_WAIT = 60
+
+# The number of seconds to wait before trying again when another worker is restarting the send schedule.
+RATE_LIMIT_RETRY_WAIT = 0.05
+
+# The number of seconds that an unused send schedule is kept in the cache.
+SCHEDULE_TIMEOUT = 60 * 60
+
+
+def get_rate_limit_cache():
+    """Returns the cache used to share rate limits between workers."""
+    return get_cache(getattr(settings, "SUBSCRIBERS_RATE_LIMIT_CACHE", "default"))
+
+
+class RateLimiter(object):
+
+    """
+    Limits the rate of sending emails to a number of emails per second,
+    minute, hour and day.
+
+    The limits are shared by all workers using the same cache. The
+    per-second and per-minute limits are honoured by spacing sends evenly,
+    with each send reserving the next free send time in a schedule stored in
+    the cache, so concurrent workers take turns rather than each sending at
+    the full rate. The hourly and daily limits are honoured by counting
+    sends in windows starting on the hour and at midnight local time, the
+    same windows as the sent counts used by the sendemailbatch command.
+    """
+
+    def __init__(self, limits, key_prefix, cache=None):
+        """Initializes the rate limiter."""
+        for period in limits:
+            if period not in RATE_LIMIT_PERIODS:
+                raise ImproperlyConfigured("Unknown rate limit period {period!r}. Valid periods are {periods}.".format(
+                    period = period,
+                    periods = ", ".join(sorted(RATE_LIMIT_PERIODS)),
+                ))
+        self._counted_limits = [
+            (period, limit)
+            for period, limit in sorted(limits.iteritems())
+            if period not in PACED_PERIODS
+        ]
+        self._key_prefix = key_prefix
+        self._cache = cache or get_rate_limit_cache()
+        # The schedule is kept in whole milliseconds, so it can be updated with cache.incr().
+        self._interval = int(math.ceil(max([0] + [
+            1000.0 * RATE_LIMIT_PERIODS[period] / limit
+            for period, limit in limits.iteritems()
+            if period in PACED_PERIODS
+        ])))
+        self.retry_after = 0
+        self._last_reserved_keys = None
+
+    def _get_key(self, name):
+        """Returns the cache key used to store the named rate limit state."""
+        return "{prefix}:{name}".format(
+            prefix = self._key_prefix,
+            name = name,
+        )
+
+    def _get_window(self, period, now):
+        """Returns the name and end time of the current window for the given counted period, in local time."""
+        local_now = datetime.datetime.fromtimestamp(now)
+        if period == "hour":
+            start = local_now.replace(minute=0, second=0, microsecond=0)
+            end = start + datetime.timedelta(hours=1)
+        else:
+            start = local_now.replace(hour=0, minute=0, second=0, microsecond=0)
+            end = start + datetime.timedelta(days=1)
+        return start.strftime("%Y%m%d%H"), time.mktime(end.timetuple())
+
+    def _reserve_count(self, now):
+        """
+        Attempts to reserve a send in every counted window.
+
+        Returns the cache keys of the reserved windows, or None if a window
+        is full, setting retry_after to the number of seconds until it ends.
+        """
+        reserved_keys = []
+        for period, limit in self._counted_limits:
+            window, window_end = self._get_window(period, now)
+            key = self._get_key(u"{period}:{window}".format(
+                period = period,
+                window = window,
+            ))
+            timeout = int(window_end - now) + RATE_LIMIT_PERIODS[period]
+            self._cache.add(key, 0, timeout)
+            try:
+                count = self._cache.incr(key)
+            except ValueError:
+                # The key has expired from the cache.
+                self._cache.add(key, 1, timeout)
+                count = 1
+            reserved_keys.append(key)
+            if count > limit:
+                # Release the reservation, and wait for the next window.
+                self._release_count(reserved_keys)
+                self.retry_after = window_end - now
+                return None
+        return reserved_keys
+
+    def _release_count(self, keys):
+        """Releases a send reserved in the given counted windows."""
+        for key in keys:
+            try:
+                self._cache.decr(key)
+            except ValueError:
+                pass
+
+    def _reserve_send_time(self, now, max_delay):
+        """
+        Reserves the next free send time in the shared schedule.
+
+        Returns the number of seconds until the reserved send time, or None
+        if the next free send time is more than max_delay seconds away, or
+        the schedule is being restarted, setting retry_after to the number of
+        seconds to wait before trying again.
+        """
+        key = self._get_key("schedule")
+        now_ms = int(now * 1000)
+        next_send = self._cache.get(key)
+        if next_send is not None and next_send - now_ms > max_delay * 1000:
+            self.retry_after = (next_send - now_ms) / 1000.0
+            return None
+        self._cache.add(key, now_ms, SCHEDULE_TIMEOUT)
+        try:
+            send_time = self._cache.incr(key, self._interval) - self._interval
+        except ValueError:
+            # The key has expired from the cache.
+            self.retry_after = RATE_LIMIT_RETRY_WAIT
+            return None
+        if send_time >= now_ms - self._interval:
+            return max(0, send_time - now_ms) / 1000.0
+        # Nothing has been sent for a while, so the schedule has fallen behind.
+        # Only one worker restarts the schedule from now, and the rest try
+        # again, rather than all sending at once at the stale send times.
+        if self._cache.add(self._get_key("restart"), 1, 1):
+            self._cache.set(key, now_ms + self._interval, SCHEDULE_TIMEOUT)
+            return 0
+        self.retry_after = RATE_LIMIT_RETRY_WAIT
+        return None
+
+    def reserve(self, max_delay=0):
+        """
+        Reserves a send without waiting.
+
+        Returns the number of seconds to wait before sending, or None if the
+        rate limits would not allow a send within max_delay seconds. If None,
+        retry_after is set to the number of seconds until a send may be
+        allowed.
+        """
+        now = time.time()
+        self._last_reserved_keys = None
+        reserved_keys = self._reserve_count(now)
+        if reserved_keys is None:
+            return None
+        if not self._interval:
+            self._last_reserved_keys = reserved_keys
+            return 0
+        wait = self._reserve_send_time(now, max_delay)
+        if wait is None:
+            self._release_count(reserved_keys)
+        else:
+            self._last_reserved_keys = reserved_keys
+        return wait
+
+    def release(self):
+        """
+        Releases the last send reserved by this rate limiter, for when the
+        email will not be sent after all.
+        """
+        if self._last_reserved_keys is None:
+            return
+        self._release_count(self._last_reserved_keys)
+        self._last_reserved_keys = None
+        # Hand back the reserved send time, moving later sends forward.
+        if self._interval:
+            try:
+                self._cache.decr(self._get_key("schedule"), self._interval)
+            except ValueError:
+                pass
+
+    def acquire_iter(self, max_wait=RATE_LIMIT_MAX_WAIT):
+        """
+        Waits until an email can be sent without breaking the rate limits,
+        without blocking.
+
+        Returns an iterator that yields None while waiting, so the caller can
+        do other work between each item, then yields True once the email can
+        be sent, or False if the rate limits would not allow it within
+        max_wait seconds.
+        """
+        deadline = time.time() + max_wait
+        while True:
+            now = time.time()
+            wait = self.reserve(max(0, deadline - now))
+            if wait is None:
+                if now + self.retry_after > deadline:
+                    yield False
+                    return
+                wake_time = now + self.retry_after
+            else:
+                wake_time = now + wait
+            while time.time() < wake_time:
+                yield None
+            if wait is not None:
+                yield True
+                return
+
+
+def get_rate_limiter(manager_slug):
+    """
+    Returns a rate limiter for the given email manager, or None if sending
+    is not rate limited.
+
+    The rate limits are configured using the SUBSCRIBERS_RATE_LIMITS
+    setting, a dict mapping periods of "second", "minute", "hour" or "day"
+    to the maximum number of emails to send in that period.
+    """
+    limits = getattr(settings, "SUBSCRIBERS_RATE_LIMITS", None)
+    if not limits:
+        return None
+    return RateLimiter(
+        limits = limits,
+        key_prefix = "subscribers:ratelimit:{manager_slug}".format(
+            manager_slug = manager_slug,
+        ),
+    )
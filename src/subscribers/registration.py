@@ -1,23 +1,163 @@
 """Adapters for registering models with django-subscribers."""
 
-import datetime
+import datetime, math, operator, os, random, re, socket, threading, time, uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
 from weakref import WeakValueDictionary
-from contextlib import closing
 
 from django import template
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.contrib.sites.models import Site
-from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail import EmailMultiAlternatives
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Q, F
+from django.db.models.query import EmptyQuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.encoding import force_unicode
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
 
-from subscribers.models import has_int_pk, get_secure_hash, DispatchedEmail, STATUS_PENDING, STATUS_SENT, STATUS_CANCELLED, STATUS_UNSUBSCRIBED, STATUS_ERROR
+from subscribers.models import INSERT_SELECT_VENDORS, has_int_pk, get_secure_hash, get_object_id_hash, Subscriber, DispatchedEmail, ArchivedEmail, STATUS_PENDING, STATUS_SENT, STATUS_CANCELLED, STATUS_UNSUBSCRIBED, STATUS_ERROR, STATUS_SENDING, PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH, DispatchJob, JOB_STATUS_PENDING, JOB_STATUS_RUNNING, JOB_STATUS_COMPLETE, SentCount, SpooledMessage
+from subscribers.transport import TRANSPORT_THREADED, get_transport, is_transient_error
+from subscribers.ratelimit import get_rate_limiter
+from subscribers.scheduler import DomainScheduler
+from subscribers.pipeline import STAGE_FETCH, STAGE_RENDER, STAGE_TRANSPORT, STAGE_WRITE, PipelineStats, RenderPool, render_iter
+from subscribers.spool import serialize_email, deserialize_email
+
+
+# The number of rows to insert per query on other database backends.
+DISPATCH_CHUNK_SIZE = 1000
+
+# The number of subscribers processed per transaction by a dispatch job.
+DISPATCH_JOB_CHUNK_SIZE = 10000
+
+# Database backends that can claim emails using SELECT ... FOR UPDATE SKIP LOCKED.
+SKIP_LOCKED_VENDORS = ("postgresql",)
+
+# The number of emails updated per query, keeping within the query parameter limits of all database backends.
+UPDATE_CHUNK_SIZE = 500
+
+# The number of email statuses written per query. Each email can add a parameter for its id and for each
+# of PER_EMAIL_STATUS_FIELDS, so this is kept well within the query parameter limits of all database backends.
+STATUS_UPDATE_CHUNK_SIZE = 100
+
+# The status fields that are written separately for each email when flushing statuses.
+PER_EMAIL_STATUS_FIELDS = ("status_message", "date_sent", "date_next_attempt",)
+
+# The default maximum number of attempts to send an email that fails with a transient error.
+DEFAULT_MAX_SEND_ATTEMPTS = 5
+
+# The number of seconds to wait before retrying an email the first time. The delay doubles with each attempt.
+RETRY_BASE_DELAY = 60
+
+# The maximum number of seconds to wait before retrying an email.
+RETRY_MAX_DELAY = 60 * 60 * 6
+
+# The default number of email statuses buffered by a status writer before they are written to the database.
+DEFAULT_STATUS_FLUSH_SIZE = 500
+
+# The default number of seconds that a status writer may buffer an email status before it is written to the database.
+DEFAULT_STATUS_FLUSH_INTERVAL = 5
+
+# The number of emails claimed and loaded into memory at a time while sending a batch.
+SEND_PAGE_SIZE = 500
+
+# The number of seconds that a worker may spend sending a batch before its emails can be claimed by another worker.
+DEFAULT_LEASE_DURATION = 60 * 60
+
+# The default share of each batch claimed from each priority, used for any priority not in the SUBSCRIBERS_PRIORITY_WEIGHTS setting.
+# Emails can only be dispatched with a priority that has a weight.
+DEFAULT_PRIORITY_WEIGHTS = {
+    PRIORITY_HIGH: 10,
+    PRIORITY_NORMAL: 3,
+    PRIORITY_LOW: 1,
+}
+
+
+def get_worker_id():
+    """Generates a worker id that is unique to this process and call."""
+    return u"{hostname}:{pid}:{uid}".format(
+        hostname = socket.gethostname(),
+        pid = os.getpid(),
+        uid = uuid.uuid4().hex[:8],
+    )
+
+
+class TemplatePlaceholder(object):
+
+    """
+    Stands in for a subscriber template param when rendering an email
+    template once for many subscribers.
+    """
+    
+    def __init__(self, nonce, name):
+        """Initializes the template placeholder."""
+        self._nonce = nonce
+        self._name = name
+        
+    def __getattr__(self, name):
+        """Returns a placeholder for an attribute of the template param."""
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return TemplatePlaceholder(self._nonce, u"{name}.{attr}".format(
+            name = self._name,
+            attr = name,
+        ))
+        
+    def __unicode__(self):
+        """Returns the placeholder text to substitute the template param into."""
+        return mark_safe(u"[[{nonce}:{name}]]".format(
+            nonce = self._nonce,
+            name = self._name,
+        ))
+
+
+# The template params of the email renderer running in the current thread.
+_renderer_state = threading.local()
+
+
+@contextmanager
+def renderer_template_params(adapter, obj, object_params, subscriber_params=None, memo=None):
+    """
+    Makes the given object template params, and optionally the given
+    subscriber template params, available to the adapter's
+    get_template_params() while rendering an email for the given object in
+    the current thread.
+    
+    If given, memo is a dict owned by the email renderer, used to calculate
+    values that are the same for every subscriber only once per object.
+    """
+    previous_params = getattr(_renderer_state, "params", None)
+    _renderer_state.params = (adapter, obj, object_params, subscriber_params, memo)
+    try:
+        yield
+    finally:
+        _renderer_state.params = previous_params
+
+
+def is_overridden(adapter, name):
+    """Whether the given adapter overrides the named EmailAdapter method."""
+    return getattr(adapter.__class__, name).im_func is not getattr(EmailAdapter, name).im_func
 
 
 class EmailAdapter(object):
 
     """An adapter for generating an email from a model."""
+    
+    # If True, the email templates for each object are rendered only once,
+    # with placeholders standing in for the subscriber template params. The
+    # escaped subscriber params are then substituted into the rendered
+    # content for each email. Only enable this if your templates output the
+    # subscriber params directly, without using them in tags or filters.
+    render_once = False
+    
+    # The priority of emails dispatched for this model, unless given when
+    # dispatching. Use a higher priority for transactional emails, so they
+    # are not held up behind a bulk mailing.
+    priority = PRIORITY_NORMAL
         
     def __init__(self, model):
         """Initializes the email adapter."""
@@ -96,22 +236,60 @@ class EmailAdapter(object):
         except NoReverseMatch:
             return None
         
-    def get_template_params(self, obj, subscriber):
-        """Returns the template params for the email this object represents."""
-        # Get the base params.
-        params = {
+    def get_object_template_params(self, obj):
+        """
+        Returns the template params that are shared by every subscriber to
+        the email this object represents.
+        
+        When sending a batch of emails, these params are calculated once per
+        object, rather than once per email, so override this method to add
+        any params that are expensive to calculate.
+        """
+        return {
             "obj": obj,
-            "subject": self.get_subject(obj, subscriber),
-            "subscriber": subscriber,
             "MEDIA_URL": settings.MEDIA_URL,
             "STATIC_URL": settings.STATIC_URL,
         }
+        
+    def _get_renderer_params(self, obj):
+        """
+        Returns the (object_params, subscriber_params, memo) of the email
+        renderer for the given object running in the current thread, or None.
+        """
+        renderer_params = getattr(_renderer_state, "params", None)
+        if renderer_params is not None and renderer_params[0] is self and renderer_params[1] is obj:
+            return renderer_params[2:]
+        return None
+    
+    def _get_domain_and_host(self, obj, subscriber):
+        """
+        Returns the domain and host for the given subscriber.
+        
+        Unless get_domain() or get_host() are overridden, these are the same
+        for every subscriber, so are calculated once per email renderer.
+        """
+        renderer_params = self._get_renderer_params(obj)
+        if renderer_params is None or renderer_params[2] is None or is_overridden(self, "get_domain") or is_overridden(self, "get_host"):
+            return self.get_domain(obj, subscriber), self.get_host(obj, subscriber)
+        memo = renderer_params[2]
+        if "domain_and_host" not in memo:
+            memo["domain_and_host"] = (self.get_domain(obj, subscriber), self.get_host(obj, subscriber))
+        return memo["domain_and_host"]
+        
+    def get_subscriber_template_params(self, obj, subscriber):
+        """
+        Returns the template params that are specific to the given subscriber
+        of the email this object represents.
+        """
+        params = {
+            "subject": self.get_subject(obj, subscriber),
+            "subscriber": subscriber,
+        }
+        domain, host = self._get_domain_and_host(obj, subscriber)
         # Add in the domain, if available.
-        domain = self.get_domain(obj, subscriber)
         if domain:
             params["domain"] = domain
         # Add in the host, if available.
-        host = self.get_host(obj, subscriber)
         if host:
             params["host"] = host
         # Add in the unsubscribe url.
@@ -124,6 +302,23 @@ class EmailAdapter(object):
             params["view_url"] = view_url
         # All done.
         return params
+        
+    def get_template_params(self, obj, subscriber):
+        """
+        Returns the template params for the email this object represents.
+        
+        When rendering a batch of emails, the object template params are
+        those calculated once by the email renderer, and the subscriber
+        template params are those calculated once per email.
+        """
+        renderer_params = self._get_renderer_params(obj)
+        if renderer_params is not None:
+            object_params, subscriber_params = renderer_params[:2]
+        else:
+            object_params, subscriber_params = self.get_object_template_params(obj), None
+        params = object_params.copy()
+        params.update(subscriber_params or self.get_subscriber_template_params(obj, subscriber))
+        return params
     
     def get_content(self, obj, subscriber):
         """Returns the plain text content of the email that this object represents."""
@@ -160,17 +355,15 @@ class EmailAdapter(object):
             headers["Reply-To"] = unicode(reply_to_email)
         return headers
         
-    def render_email(self, obj, subscriber):
-        """Renders this object to an email."""
-        # Create the email.
+    def create_email(self, obj, subscriber, subject, content, content_html):
+        """Creates an email for the given subscriber from the rendered content."""
         email = EmailMultiAlternatives(
-            subject = self.get_subject(obj, subscriber),
-            body = self.get_content(obj, subscriber),
+            subject = subject,
+            body = content,
             to = (unicode(subscriber),),
             from_email = self.get_from_email(obj, subscriber),
         )
         # Add the HTML alternative.
-        content_html = self.get_content_html(obj, subscriber)
         if content_html:
             email.attach_alternative(content_html, "text/html")
         # Add the headers.
@@ -178,6 +371,301 @@ class EmailAdapter(object):
             email.headers[name] = value
         # All done.
         return email
+    
+    def render_email(self, obj, subscriber):
+        """Renders this object to an email."""
+        # Use the subject already calculated by the email renderer, if any.
+        renderer_params = self._get_renderer_params(obj)
+        if renderer_params is not None and renderer_params[1] is not None and "subject" in renderer_params[1]:
+            subject = renderer_params[1]["subject"]
+        else:
+            subject = self.get_subject(obj, subscriber)
+        return self.create_email(
+            obj,
+            subscriber,
+            subject,
+            self.get_content(obj, subscriber),
+            self.get_content_html(obj, subscriber),
+        )
+        
+    def get_email_renderer(self, obj):
+        """
+        Returns a function that renders this object to an email for a given
+        subscriber, used to render a batch of emails for the same object.
+        
+        The object template params are calculated only once. If render_once
+        is True, then the email templates are also rendered only once.
+        """
+        object_params = self.get_object_template_params(obj)
+        if self.render_once:
+            return PersonalizedEmailRenderer(self, obj, object_params)
+        return EmailRenderer(self, obj, object_params)
+
+
+class EmailRenderer(object):
+
+    """
+    Renders emails for an object, sharing the object template params between
+    them. The subscriber template params are calculated once per email.
+    """
+    
+    def __init__(self, adapter, obj, object_params):
+        """Initializes the email renderer."""
+        self._adapter = adapter
+        self._obj = obj
+        self._object_params = object_params
+        self._memo = {}
+    
+    def get_subscriber_params(self, subscriber):
+        """
+        Returns the subscriber template params for the given subscriber.
+        
+        These may need database access, so when emails are rendered in a
+        render pool they are calculated on the calling thread.
+        """
+        with renderer_template_params(self._adapter, self._obj, self._object_params, memo=self._memo):
+            return self._adapter.get_subscriber_template_params(self._obj, subscriber)
+        
+    def __call__(self, subscriber, subscriber_params=None):
+        """Renders the email for the given subscriber."""
+        if subscriber_params is None:
+            subscriber_params = self.get_subscriber_params(subscriber)
+        with renderer_template_params(self._adapter, self._obj, self._object_params, subscriber_params, self._memo):
+            return self._adapter.render_email(self._obj, subscriber)
+
+
+class PersonalizedEmailRenderer(object):
+
+    """
+    Renders the email templates for an object once, substituting in the
+    subscriber template params for each email.
+    """
+    
+    def __init__(self, adapter, obj, object_params):
+        """Initializes the personalized email renderer."""
+        self._adapter = adapter
+        self._obj = obj
+        self._object_params = object_params
+        self._nonce = uuid.uuid4().hex
+        self._placeholder_re = re.compile(u"\\[\\[{nonce}:([^\\]]+)\\]\\]".format(
+            nonce = self._nonce,
+        ))
+        self._memo = {}
+        self._rendered = False
+        self._render_lock = threading.Lock()
+    
+    def _render_templates(self, subscriber_params):
+        """Renders the email templates, with placeholders for the subscriber params."""
+        placeholder_params = dict(
+            (name, TemplatePlaceholder(self._nonce, name))
+            for name in subscriber_params
+        )
+        subscriber = placeholder_params["subscriber"]
+        with renderer_template_params(self._adapter, self._obj, self._object_params, placeholder_params, self._memo):
+            self._content = self._adapter.get_content(self._obj, subscriber)
+            self._content_html = self._adapter.get_content_html(self._obj, subscriber)
+        self._rendered = True
+        
+    def _resolve_placeholder(self, subscriber_params, name):
+        """Returns the escaped value of the named subscriber param."""
+        bits = name.split(".")
+        value = subscriber_params.get(bits[0], u"")
+        for bit in bits[1:]:
+            value = getattr(value, bit, u"")
+            if callable(value):
+                value = value()
+        return conditional_escape(force_unicode(value))
+    
+    def _substitute(self, content, subscriber_params):
+        """Substitutes the subscriber params into the rendered content."""
+        if content is None:
+            return None
+        return self._placeholder_re.sub(lambda match: self._resolve_placeholder(subscriber_params, match.group(1)), content)
+    
+    def get_subscriber_params(self, subscriber):
+        """Returns the subscriber template params for the given subscriber."""
+        with renderer_template_params(self._adapter, self._obj, self._object_params, memo=self._memo):
+            return self._adapter.get_subscriber_template_params(self._obj, subscriber)
+        
+    def __call__(self, subscriber, subscriber_params=None):
+        """Renders the email for the given subscriber."""
+        if subscriber_params is None:
+            subscriber_params = self.get_subscriber_params(subscriber)
+        if not self._rendered:
+            with self._render_lock:
+                if not self._rendered:
+                    self._render_templates(subscriber_params)
+        return self._adapter.create_email(
+            self._obj,
+            subscriber,
+            subscriber_params["subject"] if "subject" in subscriber_params else self._adapter.get_subject(self._obj, subscriber),
+            self._substitute(self._content, subscriber_params),
+            self._substitute(self._content_html, subscriber_params),
+        )
+
+
+def get_max_send_attempts():
+    """Returns the maximum number of attempts to send an email that fails with a transient error."""
+    return getattr(settings, "SUBSCRIBERS_MAX_SEND_ATTEMPTS", DEFAULT_MAX_SEND_ATTEMPTS)
+
+
+def get_retry_delay(attempt_count):
+    """Returns the jittered number of seconds to wait before retrying an email after the given number of attempts."""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt_count - 1))
+    return random.uniform(delay / 2.0, delay)
+
+
+def get_priority_weights():
+    """Returns the share of each batch to claim from each priority, keyed by priority."""
+    weights = DEFAULT_PRIORITY_WEIGHTS.copy()
+    weights.update(getattr(settings, "SUBSCRIBERS_PRIORITY_WEIGHTS", {}))
+    return weights
+
+
+def get_status_flush_size():
+    """Returns the maximum number of email statuses to buffer before writing them to the database."""
+    return getattr(settings, "SUBSCRIBERS_STATUS_FLUSH_SIZE", DEFAULT_STATUS_FLUSH_SIZE)
+
+
+def get_status_flush_interval():
+    """Returns the maximum number of seconds to buffer an email status before writing it to the database."""
+    return getattr(settings, "SUBSCRIBERS_STATUS_FLUSH_INTERVAL", DEFAULT_STATUS_FLUSH_INTERVAL)
+
+
+class StatusWriter(object):
+
+    """
+    Buffers the statuses of sent emails, writing them to the database in
+    bulk UPDATEs grouped by status. The sent counts used to enforce sending
+    limits are updated in the same transaction.
+    
+    The buffer is flushed whenever it holds flush_size statuses, or when
+    it is more than flush_interval seconds since the last flush. Stale
+    statuses are only flushed when a status is written or flush_if_stale()
+    is called, so the sending loop calls it whenever it is idle. If the
+    sending process crashes, the buffered statuses are lost,
+    and those emails will be sent again once their lease expires. At most
+    one flush window of emails, set by the SUBSCRIBERS_STATUS_FLUSH_SIZE
+    and SUBSCRIBERS_STATUS_FLUSH_INTERVAL settings, can be resent this way.
+    """
+
+    def __init__(self, flush_size=None, flush_interval=None, stats=None):
+        """Initializes the status writer."""
+        self._stats = stats or PipelineStats()
+        self._flush_size = flush_size or get_status_flush_size()
+        self._flush_interval = get_status_flush_interval() if flush_interval is None else flush_interval
+        self._pending = []
+        self._last_flushed = time.time()
+
+    def write(self, dispatched_email, attempted=False):
+        """
+        Buffers the status of the given dispatched email, flushing the buffer
+        if it is full or stale.
+        
+        If attempted is True, the attempt count of the email is incremented.
+        """
+        self._pending.append((dispatched_email, attempted))
+        if len(self._pending) >= self._flush_size:
+            self.flush()
+        else:
+            self.flush_if_stale()
+
+    def flush_if_stale(self):
+        """Writes all buffered statuses to the database if the last flush was more than flush_interval seconds ago."""
+        if self._pending and time.time() - self._last_flushed >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered statuses to the database."""
+        self._last_flushed = time.time()
+        if not self._pending:
+            return
+        with self._stats.time(STAGE_WRITE):
+            self._write_pending()
+        self._pending = []
+    
+    def _write_pending(self):
+        """Writes the buffered statuses in a single transaction."""
+        # Group the emails by status.
+        groups = defaultdict(list)
+        for dispatched_email, attempted in self._pending:
+            groups[(dispatched_email.status, attempted)].append(dispatched_email)
+        # Write the statuses.
+        with transaction.commit_on_success():
+            for (status, attempted), dispatched_emails in groups.iteritems():
+                for chunk_start in xrange(0, len(dispatched_emails), STATUS_UPDATE_CHUNK_SIZE):
+                    self._write_chunk(status, attempted, dispatched_emails[chunk_start:chunk_start+STATUS_UPDATE_CHUNK_SIZE])
+                # Update the sent counts, in the hour that each email was sent.
+                if status == STATUS_SENT:
+                    hour_counts = defaultdict(int)
+                    hour_dates = {}
+                    for dispatched_email in dispatched_emails:
+                        key = (dispatched_email.manager_slug, dispatched_email.date_sent.date(), dispatched_email.date_sent.hour)
+                        hour_counts[key] += 1
+                        hour_dates.setdefault(key, dispatched_email.date_sent)
+                    for key, count in hour_counts.iteritems():
+                        SentCount.objects.increment(key[0], hour_dates[key], count)
+
+    def _write_chunk(self, status, attempted, dispatched_emails):
+        """
+        Writes the statuses of the given emails, which share a status, in a
+        single UPDATE.
+        
+        Each email keeps its own status message, send time and next attempt
+        time, which are written using a CASE expression when they differ
+        between the emails.
+        """
+        values = {
+            "status": status,
+            "lease_expires": None,
+        }
+        row_values = {}
+        for name in PER_EMAIL_STATUS_FIELDS:
+            email_values = [getattr(dispatched_email, name) for dispatched_email in dispatched_emails]
+            if len(set(email_values)) == 1:
+                values[name] = email_values[0]
+            else:
+                row_values[name] = email_values
+        ids = [dispatched_email.id for dispatched_email in dispatched_emails]
+        # Use a plain update if the emails share all their values.
+        if not row_values:
+            if attempted:
+                values["attempt_count"] = F("attempt_count") + 1
+            DispatchedEmail.objects.filter(id__in=ids).update(**values)
+            return
+        db = router.db_for_write(DispatchedEmail)
+        connection = connections[db]
+        qn = connection.ops.quote_name
+        pk = DispatchedEmail._meta.pk
+        assignments = []
+        params = []
+        for name, value in sorted(values.iteritems()):
+            field = DispatchedEmail._meta.get_field(name)
+            assignments.append(u"{column} = %s".format(column=qn(field.column)))
+            params.append(field.get_db_prep_save(value, connection=connection))
+        for name, email_values in sorted(row_values.iteritems()):
+            field = DispatchedEmail._meta.get_field(name)
+            assignments.append(u"{column} = CASE {pk} {cases} END".format(
+                column = qn(field.column),
+                pk = qn(pk.column),
+                cases = u" ".join([u"WHEN %s THEN %s"] * len(ids)),
+            ))
+            for id, value in zip(ids, email_values):
+                params.append(pk.get_db_prep_value(id, connection=connection))
+                params.append(field.get_db_prep_save(value, connection=connection))
+        if attempted:
+            column = qn(DispatchedEmail._meta.get_field("attempt_count").column)
+            assignments.append(u"{column} = {column} + 1".format(column=column))
+        sql = u"UPDATE {table} SET {assignments} WHERE {pk} IN ({ids})".format(
+            table = qn(DispatchedEmail._meta.db_table),
+            assignments = u", ".join(assignments),
+            pk = qn(pk.column),
+            ids = u", ".join([u"%s"] * len(ids)),
+        )
+        params.extend(pk.get_db_prep_value(id, connection=connection) for id in ids)
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        transaction.commit_unless_managed(using=db)
 
 
 class EmailManagerError(Exception):
@@ -277,81 +765,736 @@ class EmailManager(object):
         
     # Dispatching email.
     
-    def dispatch_email(self, obj, subscriber, date_to_send=None):
-        """Sends an email to the given subscriber."""
-        self._assert_registered(obj.__class__)
-        date_to_send = date_to_send or datetime.datetime.now()
+    def _get_dispatch_params(self, obj, date_to_send):
+        """Returns the dispatched email field values for the given object."""
         # Determine the integer object id.
         if has_int_pk(obj):
             object_id_int = int(obj.pk)
         else:
             object_id_int = None
+        return {
+            "manager_slug": self._manager_slug,
+            "content_type": ContentType.objects.get_for_model(obj),
+            "object_id": unicode(obj.pk),
+            "object_id_int": object_id_int,
+            "date_to_send": date_to_send,
+        }
+    
+    def _get_priority(self, obj, priority):
+        """
+        Returns the priority to dispatch emails for the given object with,
+        using the default priority of the adapter if priority is None.
+        
+        Only priorities with a weight in the SUBSCRIBERS_PRIORITY_WEIGHTS
+        setting are claimed for sending, so any other priority raises a
+        ValueError, rather than leaving the emails pending forever.
+        """
+        if priority is None:
+            priority = self.get_adapter(obj.__class__).priority
+        if priority not in get_priority_weights():
+            raise ValueError("Emails cannot be dispatched with priority {priority!r}, as it has no weight in the SUBSCRIBERS_PRIORITY_WEIGHTS setting.".format(
+                priority = priority,
+            ))
+        return priority
+    
+    def _get_dispatched_email_params(self, obj, date_to_send, priority):
+        """
+        Returns the dispatched email field values for the given object, using
+        the default priority of the adapter if priority is None.
+        """
+        params = self._get_dispatch_params(obj, date_to_send)
+        params["priority"] = self._get_priority(obj, priority)
+        # Index non-integer object ids using a hash.
+        if params["object_id_int"] is None:
+            params["object_id_hash"] = get_object_id_hash(obj.pk)
+        return params
+    
+    def dispatch_email(self, obj, subscriber, date_to_send=None, priority=None):
+        """
+        Sends an email to the given subscriber.
+        
+        If priority is not given, the priority of the adapter is used.
+        """
+        self._assert_registered(obj.__class__)
+        date_to_send = date_to_send or datetime.datetime.now()
         # Save the dispatched email.
         return DispatchedEmail.objects.create(
-            manager_slug = self._manager_slug,
-            content_type = ContentType.objects.get_for_model(obj),
-            object_id = unicode(obj.pk),
-            object_id_int = object_id_int,
             subscriber = subscriber,
-            date_to_send = date_to_send,
+            **self._get_dispatched_email_params(obj, date_to_send, priority)
+        )
+        
+    def dispatch_email_bulk(self, obj, subscribers, date_to_send=None, priority=None):
+        """
+        Sends an email to every subscriber in the given queryset.
+        
+        On databases that support it, the emails are dispatched using a single
+        INSERT ... SELECT statement, otherwise they are inserted in chunks of
+        DISPATCH_CHUNK_SIZE rows. Returns the number of emails dispatched.
+        
+        If priority is not given, the priority of the adapter is used.
+        """
+        self._assert_registered(obj.__class__)
+        if isinstance(subscribers, EmptyQuerySet):
+            return 0
+        date_to_send = date_to_send or datetime.datetime.now()
+        dispatch_params = self._get_dispatched_email_params(obj, date_to_send, priority)
+        subscriber_ids = subscribers.order_by().values_list("pk", flat=True)
+        db = router.db_for_write(DispatchedEmail)
+        connection = connections[db]
+        # Use a set-based insert, if available.
+        if connection.vendor in INSERT_SELECT_VENDORS:
+            qn = connection.ops.quote_name
+            fields = [
+                field
+                for field in DispatchedEmail._meta.local_fields
+                if not field.primary_key and field.name != "subscriber"
+            ]
+            try:
+                subquery_sql, subquery_params = subscriber_ids.query.get_compiler(connection=connection).as_sql()
+            except EmptyResultSet:
+                return 0
+            sql = u"INSERT INTO {table} ({columns}, {subscriber_column}) SELECT {placeholders}, {subscriber_table}.{subscriber_pk} FROM {subscriber_table} WHERE {subscriber_table}.{subscriber_pk} IN ({subquery})".format(
+                table = qn(DispatchedEmail._meta.db_table),
+                columns = u", ".join(qn(field.column) for field in fields),
+                subscriber_column = qn(DispatchedEmail._meta.get_field("subscriber").column),
+                placeholders = u", ".join(u"%s" for field in fields),
+                subscriber_table = qn(Subscriber._meta.db_table),
+                subscriber_pk = qn(Subscriber._meta.pk.column),
+                subquery = subquery_sql,
+            )
+            template_email = DispatchedEmail(**dispatch_params)
+            params = [
+                field.get_db_prep_save(field.pre_save(template_email, True), connection=connection)
+                for field in fields
+            ]
+            cursor = connection.cursor()
+            cursor.execute(sql, params + list(subquery_params))
+            transaction.commit_unless_managed(using=db)
+            return cursor.rowcount
+        # Insert the emails in chunks.
+        count = 0
+        chunk = []
+        for subscriber_id in subscriber_ids.iterator():
+            chunk.append(DispatchedEmail(subscriber_id=subscriber_id, **dispatch_params))
+            if len(chunk) >= DISPATCH_CHUNK_SIZE:
+                DispatchedEmail.objects.using(db).bulk_create(chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            DispatchedEmail.objects.using(db).bulk_create(chunk)
+            count += len(chunk)
+        return count
+        
+    def get_subscribers_to_send(self, obj, mailing_list=None):
+        """
+        Returns a queryset of subscribers who should receive the given object.
+        
+        This is all subscribed subscribers, optionally limited to those on the
+        given mailing list, who have not already been sent the email,
+        including any archived emails.
+        """
+        subscribers = Subscriber.objects.filter(
+            is_subscribed = True,
+        )
+        # Try filtering by mailing list.
+        if mailing_list is not None:
+            subscribers = subscribers.filter(mailing_lists=mailing_list)
+        # Exclude subscribers who have already received the email.
+        subscribers = subscribers.exclude(
+            id__in = DispatchedEmail.objects.for_object(obj).values("subscriber"),
+        ).exclude(
+            id__in = ArchivedEmail.objects.for_object(obj).values("subscriber"),
+        )
+        return subscribers.distinct()
+    
+    def dispatch_email_job(self, obj, mailing_list=None, date_to_send=None):
+        """
+        Creates a background job that sends an email to all subscribers, or to
+        the subscribers of the given mailing list.
+        
+        The emails are dispatched by the next call to run_dispatch_jobs().
+        """
+        self._assert_registered(obj.__class__)
+        # Check the priority of the adapter now, rather than failing every chunk of the job.
+        self._get_priority(obj, None)
+        date_to_send = date_to_send or datetime.datetime.now()
+        return DispatchJob.objects.create(
+            mailing_list = mailing_list,
+            **self._get_dispatch_params(obj, date_to_send)
+        )
+        
+    def _run_dispatch_job_chunk(self, job_id, chunk_size):
+        """
+        Claims and dispatches the next chunk of the given dispatch job, in the
+        current transaction.
+        
+        The chunk is claimed by a conditional update of the job's progress,
+        which only succeeds if no other worker has advanced the job since it
+        was read. Returns a tuple of (dispatched_count, is_finished).
+        """
+        try:
+            job = DispatchJob.objects.select_related("mailing_list").get(
+                id = job_id,
+                status__in = (JOB_STATUS_PENDING, JOB_STATUS_RUNNING),
+            )
+        except DispatchJob.DoesNotExist:
+            return 0, True
+        now = datetime.datetime.now()
+        unchanged_jobs = DispatchJob.objects.filter(
+            id = job.id,
+            status = job.status,
+            last_subscriber_id = job.last_subscriber_id,
+        )
+        # Cancel jobs for deleted objects.
+        obj = job.object
+        if obj is None:
+            unchanged_jobs.update(
+                status = JOB_STATUS_COMPLETE,
+                date_completed = now,
+            )
+            return 0, True
+        subscribers = self.get_subscribers_to_send(obj, job.mailing_list)
+        # Start the job.
+        if job.status == JOB_STATUS_PENDING:
+            if not unchanged_jobs.update(status=JOB_STATUS_RUNNING, subscriber_count=subscribers.count()):
+                return 0, False  # Another worker has started the job.
+            unchanged_jobs = DispatchJob.objects.filter(
+                id = job.id,
+                status = JOB_STATUS_RUNNING,
+                last_subscriber_id = job.last_subscriber_id,
+            )
+        # Claim the next chunk.
+        remaining_subscribers = subscribers.filter(id__gt=job.last_subscriber_id)
+        last_subscriber_ids = list(remaining_subscribers.order_by("id").values_list("id", flat=True)[chunk_size-1:chunk_size])
+        if last_subscriber_ids:
+            claimed_count = unchanged_jobs.update(last_subscriber_id=last_subscriber_ids[0])
+            chunk_subscribers = remaining_subscribers.filter(id__lte=last_subscriber_ids[0])
+        else:
+            claimed_count = unchanged_jobs.update(status=JOB_STATUS_COMPLETE, date_completed=now)
+            chunk_subscribers = remaining_subscribers
+        if not claimed_count:
+            return 0, False  # Another worker has claimed the chunk.
+        # Dispatch the chunk.
+        dispatched_count = self.dispatch_email_bulk(obj, chunk_subscribers, job.date_to_send)
+        DispatchJob.objects.filter(id=job.id).update(dispatched_count=F("dispatched_count") + dispatched_count)
+        return dispatched_count, not last_subscriber_ids
+    
+    def run_dispatch_jobs(self, chunk_size=DISPATCH_JOB_CHUNK_SIZE, max_chunks=None):
+        """
+        Runs unfinished dispatch jobs.
+        
+        Subscribers are processed in order of id, with each chunk committed
+        in its own transaction, so an interrupted job will resume from the
+        last committed chunk. Concurrent workers can safely run the same jobs,
+        as each chunk is claimed by only one of them.
+        
+        If max_chunks is given, at most that many chunks are processed, so
+        large jobs can be interleaved with sending. Returns the number of
+        emails dispatched.
+        """
+        dispatched_count = 0
+        chunk_count = 0
+        job_ids = DispatchJob.objects.filter(
+            manager_slug = self._manager_slug,
+            status__in = (JOB_STATUS_PENDING, JOB_STATUS_RUNNING),
+        ).order_by("id").values_list("id", flat=True)
+        for job_id in list(job_ids):
+            is_finished = False
+            while not is_finished:
+                if max_chunks is not None and chunk_count >= max_chunks:
+                    return dispatched_count
+                with transaction.commit_on_success():
+                    chunk_dispatched_count, is_finished = self._run_dispatch_job_chunk(job_id, chunk_size)
+                dispatched_count += chunk_dispatched_count
+                chunk_count += 1
+        return dispatched_count
+    
+    def _get_dispatched_objects(self, dispatched_emails):
+        """
+        Loads the objects referred to by the given dispatched emails, using a
+        single query per content type.
+        
+        Returns a dict of objects, keyed by (content_type_id, object_id).
+        """
+        object_ids = defaultdict(set)
+        for dispatched_email in dispatched_emails:
+            object_ids[dispatched_email.content_type_id].add(dispatched_email.object_id)
+        objects = {}
+        for content_type_id, content_type_object_ids in object_ids.iteritems():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            if model is None:
+                continue
+            for obj in model._default_manager.in_bulk(list(content_type_object_ids)).itervalues():
+                objects[(content_type_id, unicode(obj.pk))] = obj
+        return objects
+    
+    def _claim_email_batch(self, batch_size, worker_id, lease_duration, after_id=0, priority=None):
+        """
+        Claims a batch of emails that are due to be sent on behalf of the given worker,
+        starting after the given email id, optionally limited to the given priority.
+        
+        Pending emails, and emails whose lease has expired, are marked as sending and
+        leased to the worker. Returns the number of emails claimed.
+        """
+        now = datetime.datetime.now()
+        lease_expires = now + datetime.timedelta(seconds=lease_duration)
+        claimable_emails = DispatchedEmail.objects.filter(
+            Q(status=STATUS_PENDING) | Q(status=STATUS_SENDING, lease_expires__lt=now),
+            Q(date_next_attempt__isnull=True) | Q(date_next_attempt__lte=now),
+            manager_slug = self._manager_slug,
+            date_to_send__lte = now,
+            id__gt = after_id,
         )
+        if priority is not None:
+            claimable_emails = claimable_emails.filter(priority=priority)
+        claimable_ids = claimable_emails.order_by("id").values_list("id", flat=True)
+        if batch_size is not None:
+            claimable_ids = claimable_ids[:batch_size]
+        db = router.db_for_write(DispatchedEmail)
+        connection = connections[db]
+        # Claim the emails with a single statement, skipping any rows locked by other workers.
+        if connection.vendor in SKIP_LOCKED_VENDORS:
+            qn = connection.ops.quote_name
+            fields = [DispatchedEmail._meta.get_field(name) for name in ("status", "worker_id", "lease_expires")]
+            subquery_sql, subquery_params = claimable_ids.query.get_compiler(connection=connection).as_sql()
+            sql = u"UPDATE {table} SET {assignments} WHERE {pk} IN ({subquery} FOR UPDATE SKIP LOCKED)".format(
+                table = qn(DispatchedEmail._meta.db_table),
+                assignments = u", ".join(u"{column} = %s".format(column=qn(field.column)) for field in fields),
+                pk = qn(DispatchedEmail._meta.pk.column),
+                subquery = subquery_sql,
+            )
+            params = [
+                field.get_db_prep_save(value, connection=connection)
+                for field, value in zip(fields, (STATUS_SENDING, worker_id, lease_expires))
+            ]
+            cursor = connection.cursor()
+            cursor.execute(sql, params + list(subquery_params))
+            transaction.commit_unless_managed(using=db)
+            return cursor.rowcount
+        # Claim the emails using a conditional update, so only one worker can claim each email.
+        claimable_ids = list(claimable_ids)
+        claimed_count = 0
+        for chunk_start in xrange(0, len(claimable_ids), UPDATE_CHUNK_SIZE):
+            claimed_count += claimable_emails.filter(
+                id__in = claimable_ids[chunk_start:chunk_start+UPDATE_CHUNK_SIZE],
+            ).update(
+                status = STATUS_SENDING,
+                worker_id = worker_id,
+                lease_expires = lease_expires,
+            )
+        transaction.commit_unless_managed(using=db)
+        return claimed_count
+    
+    def _claim_email_page(self, page_size, worker_id, lease_duration, last_ids):
+        """
+        Claims a page of emails on behalf of the given worker, sharing the page
+        between the priorities in proportion to their weights.
+        
+        The emails for each priority are claimed after the id given for that
+        priority in last_ids. Any share of the page that is not used by a
+        priority is claimed from the other priorities, highest first. Returns
+        the number of emails claimed.
+        """
+        weights = get_priority_weights()
+        priorities = sorted(weights, reverse=True)
+        remaining_weight = sum(weights.itervalues())
+        claimed_count = 0
+        full_priorities = []
+        for priority in priorities:
+            share = int(math.ceil((page_size - claimed_count) * weights[priority] / float(remaining_weight or 1)))
+            remaining_weight -= weights[priority]
+            if share <= 0:
+                full_priorities.append(priority)
+                continue
+            priority_count = self._claim_email_batch(share, worker_id, lease_duration, last_ids.get(priority, 0), priority)
+            claimed_count += priority_count
+            if priority_count >= share:
+                full_priorities.append(priority)
+        # Give any unused share of the page to the priorities that could use more.
+        for priority in full_priorities:
+            if claimed_count >= page_size:
+                break
+            claimed_count += self._claim_email_batch(page_size - claimed_count, worker_id, lease_duration, last_ids.get(priority, 0), priority)
+        return claimed_count
+    
+    def _release_emails(self, dispatched_emails, worker_id):
+        """Releases the given claimed emails, so they can be claimed by another batch."""
+        ids = [dispatched_email.id for dispatched_email in dispatched_emails]
+        for chunk_start in xrange(0, len(ids), UPDATE_CHUNK_SIZE):
+            DispatchedEmail.objects.filter(
+                id__in = ids[chunk_start:chunk_start+UPDATE_CHUNK_SIZE],
+                status = STATUS_SENDING,
+                worker_id = worker_id,
+            ).update(
+                status = STATUS_PENDING,
+                worker_id = "",
+                lease_expires = None,
+            )
+    
+    def spool_emails(self, batch_size=None, spool_ahead=None, render_concurrency=1, page_size=SEND_PAGE_SIZE, stats=None):
+        """
+        Renders pending emails ahead of time, storing the rendered messages so
+        that they can be sent without any template rendering.
+        
+        Pending emails that have not yet been spooled are rendered in pages of
+        page_size emails, in id order. If spool_ahead is given, only emails
+        due to be sent within spool_ahead seconds are rendered. If
+        render_concurrency is greater than one, the emails are rendered by a
+        pool of worker threads. Returns the number of emails spooled.
         
-    def send_email_batch_iter(self, batch_size=None):
+        Spooled emails are sent exactly as they were rendered, so changes made
+        to an object after its emails have been spooled will not be sent. Only
+        one process should spool emails for an email manager at a time.
+        """
+        stats = stats or PipelineStats()
+        # Remove any spooled messages for emails that were finished without using them.
+        SpooledMessage.objects.filter(
+            dispatched_email__manager_slug = self._manager_slug,
+        ).exclude(
+            dispatched_email__status__in = (STATUS_PENDING, STATUS_SENDING),
+        ).delete()
+        # Find the emails to spool.
+        spoolable_emails = DispatchedEmail.objects.filter(
+            manager_slug = self._manager_slug,
+            status = STATUS_PENDING,
+            spooledmessage__isnull = True,
+            subscriber__is_subscribed = True,
+        )
+        if spool_ahead is not None:
+            spoolable_emails = spoolable_emails.filter(
+                date_to_send__lte = datetime.datetime.now() + datetime.timedelta(seconds=spool_ahead),
+            )
+        if render_concurrency > 1:
+            render_pool = RenderPool(render_concurrency, render_concurrency * 2, stats)
+            render = render_pool.render_iter
+        else:
+            render_pool = None
+            render = lambda jobs: render_iter(jobs, stats)
+        objects = {}
+        renderers = {}
+        spooled_count = 0
+        last_id = 0
+        try:
+            while batch_size is None or spooled_count < batch_size:
+                # Load the next page of emails.
+                page_emails = spoolable_emails.filter(id__gt=last_id).select_related("subscriber").order_by("id")
+                if batch_size is not None:
+                    page_emails = page_emails[:min(page_size, batch_size - spooled_count)]
+                with stats.time(STAGE_FETCH):
+                    dispatched_emails = list(page_emails)
+                    if not dispatched_emails:
+                        break
+                    last_id = dispatched_emails[-1].id
+                    objects.update(self._get_dispatched_objects([
+                        dispatched_email
+                        for dispatched_email in dispatched_emails
+                        if (dispatched_email.content_type_id, dispatched_email.object_id) not in objects
+                    ]))
+                # Render the emails, skipping any whose objects have been deleted.
+                def render_jobs():
+                    for dispatched_email in dispatched_emails:
+                        object_key = (dispatched_email.content_type_id, dispatched_email.object_id)
+                        if object_key not in objects:
+                            continue
+                        if object_key not in renderers:
+                            obj = objects[object_key]
+                            renderers[object_key] = self.get_adapter(obj.__class__).get_email_renderer(obj)
+                        renderer = renderers[object_key]
+                        with stats.time(STAGE_RENDER):
+                            subscriber_params = renderer.get_subscriber_params(dispatched_email.subscriber)
+                        yield dispatched_email.id, renderer, (dispatched_email.subscriber, subscriber_params)
+                spooled_messages = [
+                    SpooledMessage(
+                        dispatched_email_id = dispatched_email_id,
+                        data = serialize_email(email),
+                    )
+                    for dispatched_email_id, email in render(render_jobs())
+                ]
+                # Store the rendered emails.
+                with stats.time(STAGE_WRITE):
+                    with transaction.commit_on_success():
+                        SpooledMessage.objects.bulk_create(spooled_messages)
+                spooled_count += len(spooled_messages)
+        finally:
+            if render_pool is not None:
+                render_pool.close()
+        return spooled_count
+    
+    def send_email_batch_iter(self, batch_size=None, concurrency=1, worker_id=None, lease_duration=DEFAULT_LEASE_DURATION, transport=TRANSPORT_THREADED, page_size=SEND_PAGE_SIZE, render_concurrency=1, render_queue_size=None, stats=None, should_stop=None):
         """
         Sends a batch of emails.
         
         Returns an iterator of dispatched emails, some or all of which will
         be flagged as sent.
+        
+        If concurrency is greater than one, the emails are sent by a pool of
+        worker threads, each with its own connection. If transport is "async",
+        the emails are instead sent over concurrency non-blocking SMTP
+        sessions, driven by an event loop on the calling thread. An open
+        transport may also be given, in which case concurrency is ignored
+        and the transport is left open so its connections can be reused.
+        
+        If render_concurrency is greater than one, the emails are rendered by a
+        pool of worker threads, with up to render_queue_size emails waiting to
+        be rendered, so rendering overlaps with fetching and sending. The
+        email renderers and subscriber template params are prepared on the
+        calling thread, so only the email templates are rendered in the pool.
+        Templates and adapter hooks that query the database from the pool use
+        a connection per worker thread, which is closed when the pool closes.
+        
+        Emails that have been rendered ahead of time by spool_emails() are
+        sent exactly as they were spooled, with no rendering. Spooled messages
+        are removed once they have been loaded for sending.
+        
+        If given, stats should be a PipelineStats, which will be updated with
+        the time spent in each stage of sending the batch.
+        
+        The emails are sent to each recipient domain in turn. Domains that
+        have reached the limits in the SUBSCRIBERS_DOMAIN_LIMITS setting are
+        skipped until they can accept more emails, and any emails to domains
+        that stay throttled are released for a later batch.
+        
+        If the SUBSCRIBERS_RATE_LIMITS setting is configured, sending is paced
+        to stay within the rate limits, which are shared by all workers. The
+        transport keeps running while waiting for the rate limits. If the
+        rate limits will not allow the batch to finish, the remaining emails
+        are released for a later batch.
+        
+        Emails that fail with a transient error, such as a 4xx SMTP reply or a
+        dropped connection, are returned to pending and retried with jittered
+        exponential backoff, up to the SUBSCRIBERS_MAX_SEND_ATTEMPTS setting.
+        Other errors are permanent.
+        
+        The statuses of sent emails are written to the database in batches,
+        so may lag behind the emails yielded by this iterator by up to one
+        flush window. See StatusWriter for details.
+        
+        The emails are claimed and loaded in pages of page_size emails, in id
+        order, so sending starts straight away and memory use does not grow
+        with the size of the batch.
+        
+        Each page is shared between the email priorities in proportion to the
+        SUBSCRIBERS_PRIORITY_WEIGHTS setting, and higher priority emails in a
+        page are sent first, so high priority emails are not held up by more
+        than a page of a large mailing.
+        
+        The emails are claimed for the given worker id before sending, so many
+        workers can safely send emails in parallel. Emails that are not sent
+        within lease_duration seconds, such as when a worker has crashed, will
+        be reclaimed by the next worker.
+        
+        If given, should_stop is called before each email is scheduled. Once
+        it returns True, no more emails are claimed or scheduled, the emails
+        already handed to the transport finish sending, and the remaining
+        claimed emails are released for a later batch.
         """
-        # Look up the emails to send.
-        dispatched_emails = DispatchedEmail.objects.filter(
-            manager_slug = self._manager_slug,
-            date_to_send__lte = datetime.datetime.now(),
-            status = STATUS_PENDING,
-        ).select_related("subscriber")
-        if batch_size is not None:
-            dispatched_emails = dispatched_emails[:batch_size]
-        # Aquire a connection.
-        if dispatched_emails:
-            with closing(get_connection()) as connection:
-                connection.open()
-                # Send the emails.
-                for dispatched_email in dispatched_emails:
-                    if dispatched_email.subscriber.is_subscribed:
-                        content_type = ContentType.objects.get_for_id(dispatched_email.content_type_id)
-                        model = content_type.model_class()
-                        try:
-                            obj = model._default_manager.get(pk=dispatched_email.object_id)
-                        except model.DoesNotExist:
-                            dispatched_email.status = STATUS_CANCELLED
-                        else:
-                            adapter = self.get_adapter(model)
-                            # Generate the email.
-                            email = adapter.render_email(obj, dispatched_email.subscriber)
-                            email.connection = connection
-                            # Try to send the email.
-                            try:
-                                email.send()
-                            except Exception as ex:
-                                dispatched_email.status = STATUS_ERROR
-                                dispatched_email.status_message = str(ex)
-                            else:
-                                dispatched_email.status = STATUS_SENT
-                    else:
-                        dispatched_email.status = STATUS_UNSUBSCRIBED
-                    # Save the result.
+        worker_id = worker_id or get_worker_id()
+        stats = stats or PipelineStats()
+        status_writer = StatusWriter(stats=stats)
+        scheduler = DomainScheduler(self._manager_slug)
+        rate_limiter = get_rate_limiter(self._manager_slug)
+        objects = {}
+        spooled_data = {}
+        finished_emails = deque()
+        page = {"claimed_count": 0, "last_ids": {}}
+        def fetch_page():
+            """Claims and schedules the next page of emails, returning the number of emails claimed."""
+            if should_stop is not None and should_stop():
+                return 0
+            claim_size = page_size
+            if batch_size is not None:
+                claim_size = min(claim_size, batch_size - page["claimed_count"])
+                if claim_size <= 0:
+                    return 0
+            if not self._claim_email_page(claim_size, worker_id, lease_duration, page["last_ids"]):
+                return 0
+            claimed_emails = DispatchedEmail.objects.filter(
+                reduce(operator.or_, (
+                    Q(priority=priority, id__gt=page["last_ids"].get(priority, 0))
+                    for priority in get_priority_weights()
+                )),
+                manager_slug = self._manager_slug,
+                status = STATUS_SENDING,
+                worker_id = worker_id,
+            )
+            try:
+                return load_page(claimed_emails)
+            except:
+                # Release the page, so it is not stranded until its lease expires.
+                claimed_emails.update(
+                    status = STATUS_PENDING,
+                    worker_id = "",
+                    lease_expires = None,
+                )
+                raise
+        def load_page(claimed_emails):
+            """Loads and schedules the given claimed emails, returning the number of emails loaded."""
+            dispatched_emails = list(claimed_emails.select_related("subscriber").order_by("-priority", "id"))
+            page["claimed_count"] += len(dispatched_emails)
+            for dispatched_email in dispatched_emails:
+                page["last_ids"][dispatched_email.priority] = max(dispatched_email.id, page["last_ids"].get(dispatched_email.priority, 0))
+            # Load any pre-rendered messages, removing them from the spool.
+            spooled_messages = SpooledMessage.objects.filter(
+                dispatched_email__in = [dispatched_email.id for dispatched_email in dispatched_emails],
+            )
+            page_spooled_data = dict(spooled_messages.values_list("dispatched_email", "data"))
+            if page_spooled_data:
+                spooled_data.update(page_spooled_data)
+                spooled_messages.delete()
+            # Load the objects to send, and cancel any emails whose objects have been deleted.
+            objects.update(self._get_dispatched_objects([
+                dispatched_email
+                for dispatched_email in dispatched_emails
+                if (dispatched_email.content_type_id, dispatched_email.object_id) not in objects
+            ]))
+            now = datetime.datetime.now()
+            for content_type_id, object_id in set((dispatched_email.content_type_id, dispatched_email.object_id) for dispatched_email in dispatched_emails):
+                if (content_type_id, object_id) not in objects:
+                    claimed_emails.filter(
+                        content_type = content_type_id,
+                        object_id = object_id,
+                    ).update(
+                        status = STATUS_CANCELLED,
+                        date_sent = now,
+                        lease_expires = None,
+                    )
+            # Finish any emails that do not need sending.
+            sendable_emails = []
+            for dispatched_email in dispatched_emails:
+                if (dispatched_email.content_type_id, dispatched_email.object_id) not in objects:
+                    dispatched_email.status = STATUS_CANCELLED
+                    dispatched_email.date_sent = now
+                    dispatched_email.lease_expires = None
+                    finished_emails.append(dispatched_email)
+                elif not dispatched_email.subscriber.is_subscribed:
+                    dispatched_email.status = STATUS_UNSUBSCRIBED
+                    dispatched_email.date_sent = datetime.datetime.now()
+                    dispatched_email.lease_expires = None
+                    status_writer.write(dispatched_email)
+                    finished_emails.append(dispatched_email)
+                else:
+                    sendable_emails.append(dispatched_email)
+            scheduler.add(sendable_emails)
+            return len(dispatched_emails)
+        def claim_page():
+            """Claims and schedules the next page of emails, timing the fetch."""
+            with stats.time(STAGE_FETCH):
+                return fetch_page()
+        # Schedule the emails, taking each recipient domain in turn, and sharing the email renderers between all emails for an object.
+        def schedule_emails():
+            renderers = {}
+            for dispatched_email in scheduler.iter_emails(refill=claim_page, max_queued=page_size):
+                # Release any emails to throttled domains.
+                deferred_emails = scheduler.pop_deferred()
+                if deferred_emails:
+                    self._release_emails(deferred_emails, worker_id)
+                # Release the remaining emails if sending is stopping.
+                if should_stop is not None and should_stop():
+                    if dispatched_email is not None:
+                        scheduler.cancel(dispatched_email)
+                        self._release_emails([dispatched_email], worker_id)
+                    break
+                if dispatched_email is None:
+                    status_writer.flush_if_stale()
+                    yield None
+                    continue
+                # Wait for the rate limit, releasing the remaining emails if it will not allow sending soon.
+                if rate_limiter is not None:
+                    acquired = False
+                    for acquired in rate_limiter.acquire_iter():
+                        if acquired is not None or (should_stop is not None and should_stop()):
+                            break
+                        # Keep the transport running while waiting.
+                        status_writer.flush_if_stale()
+                        yield None
+                    if not acquired:
+                        scheduler.cancel(dispatched_email)
+                        self._release_emails([dispatched_email] + scheduler.remaining, worker_id)
+                        return
+                # Send any pre-rendered message.
+                if dispatched_email.id in spooled_data:
+                    yield dispatched_email, deserialize_email, (spooled_data.pop(dispatched_email.id),)
+                    continue
+                object_key = (dispatched_email.content_type_id, dispatched_email.object_id)
+                if object_key not in renderers:
+                    obj = objects[object_key]
+                    renderers[object_key] = self.get_adapter(obj.__class__).get_email_renderer(obj)
+                renderer = renderers[object_key]
+                with stats.time(STAGE_RENDER):
+                    subscriber_params = renderer.get_subscriber_params(dispatched_email.subscriber)
+                yield dispatched_email, renderer, (dispatched_email.subscriber, subscriber_params)
+            # Release any emails that could not be scheduled.
+            self._release_emails(scheduler.remaining, worker_id)
+        # Open the transport before claiming any emails, so a transport that cannot be opened leaves no emails claimed.
+        if isinstance(transport, basestring):
+            email_transport = get_transport(concurrency, transport)
+            close_transport = True
+        else:
+            email_transport = transport
+            close_transport = False
+        render_pool = None
+        try:
+            # Claim the first page of emails to send.
+            if not claim_page():
+                return
+            # Render the emails.
+            if render_concurrency > 1:
+                render_pool = RenderPool(render_concurrency, render_queue_size or render_concurrency * 2, stats)
+                rendered_emails = render_pool.render_iter(schedule_emails())
+            else:
+                rendered_emails = render_iter(schedule_emails(), stats)
+            # Send the emails.
+            max_send_attempts = get_max_send_attempts()
+            # Return any emails that finished without sending.
+            while finished_emails:
+                yield finished_emails.popleft()
+            for dispatched_email, ex in stats.time_iter(STAGE_TRANSPORT, email_transport.send_iter(rendered_emails, on_idle=status_writer.flush_if_stale)):
+                scheduler.finish(dispatched_email)
+                dispatched_email.attempt_count += 1
+                dispatched_email.lease_expires = None
+                if ex is None:
+                    dispatched_email.status = STATUS_SENT
+                    dispatched_email.date_sent = datetime.datetime.now()
+                    dispatched_email.date_next_attempt = None
+                elif is_transient_error(ex) and dispatched_email.attempt_count < max_send_attempts:
+                    # Retry the email later.
+                    dispatched_email.status = STATUS_PENDING
+                    dispatched_email.status_message = str(ex)
+                    dispatched_email.date_next_attempt = datetime.datetime.now() + datetime.timedelta(seconds=get_retry_delay(dispatched_email.attempt_count))
+                else:
+                    dispatched_email.status = STATUS_ERROR
+                    dispatched_email.status_message = str(ex)
                     dispatched_email.date_sent = datetime.datetime.now()
-                    dispatched_email.save()
-                    yield dispatched_email
+                    dispatched_email.date_next_attempt = None
+                # Save the result.
+                status_writer.write(dispatched_email, attempted=True)
+                # Return any emails that finished without sending.
+                while finished_emails:
+                    yield finished_emails.popleft()
+                yield dispatched_email
+            while finished_emails:
+                yield finished_emails.popleft()
+        finally:
+            try:
+                if close_transport:
+                    email_transport.close()
+                if render_pool is not None:
+                    render_pool.close()
+            finally:
+                try:
+                    status_writer.flush()
+                finally:
+                    # Release any claimed emails that were never scheduled, such as when sending fails.
+                    self._release_emails(scheduler.remaining, worker_id)
     
-    def send_email_batch(self, batch_size=None):
+    def send_email_batch(self, *args, **kwargs):
         """
         Sends a batch of emails.
         
         Returns an iterator of dispatched emails, some or all of which will
         be flagged as is_sent.
         """
-        return list(self.send_email_batch_iter(batch_size))
+        return list(self.send_email_batch_iter(*args, **kwargs))
 
 
 # The default email manager.
@@ -0,0 +1,169 @@
+"""Scheduling of emails across recipient domains."""
+
+import time
+from collections import defaultdict, deque
+
+from django.conf import settings
+
+from subscribers.ratelimit import RateLimiter, RATE_LIMIT_MAX_WAIT
+
+
+def get_email_domain(email):
+    """Returns the domain of the given email address."""
+    return email.rsplit("@", 1)[-1].lower()
+
+
+def get_domain_limits():
+    """
+    Returns the sending limits for each recipient domain.
+
+    The limits are configured using the SUBSCRIBERS_DOMAIN_LIMITS setting,
+    a dict mapping domains to a dict of limits. The "concurrency" limit is
+    the maximum number of emails to send to the domain at once, and the
+    "rate_limits" limit is a dict of rate limits, as used by the
+    SUBSCRIBERS_RATE_LIMITS setting. The "*" domain sets the limits for
+    all other domains.
+    """
+    return getattr(settings, "SUBSCRIBERS_DOMAIN_LIMITS", {})
+
+
+class DomainScheduler(object):
+
+    """
+    Schedules a batch of emails, taking each recipient domain in turn so
+    that no domain can stall the rest of the batch.
+
+    Domains that have reached their concurrency or rate limits are skipped
+    until they can accept more emails. Domains that will stay throttled for
+    too long are deferred, and their emails returned by pop_deferred().
+    """
+
+    def __init__(self, manager_slug, dispatched_emails=()):
+        """Initializes the domain scheduler."""
+        self._manager_slug = manager_slug
+        self._domain_limits = get_domain_limits()
+        self._queues = defaultdict(deque)
+        self._domains = deque()
+        self._deferred_domains = set()
+        self._deferred = []
+        self._in_flight = defaultdict(int)
+        self._concurrency = {}
+        self._rate_limiters = {}
+        self.add(dispatched_emails)
+
+    def _add_domain(self, domain):
+        """Starts scheduling emails to the given domain."""
+        self._domains.append(domain)
+        if domain in self._concurrency:
+            return
+        limits = self._domain_limits.get(domain, self._domain_limits.get("*", {}))
+        self._concurrency[domain] = limits.get("concurrency")
+        if limits.get("rate_limits"):
+            self._rate_limiters[domain] = RateLimiter(
+                limits = limits["rate_limits"],
+                key_prefix = "subscribers:ratelimit:{manager_slug}:domain:{domain}".format(
+                    manager_slug = self._manager_slug,
+                    domain = domain,
+                ),
+            )
+
+    def add(self, dispatched_emails):
+        """Adds the given emails to the schedule."""
+        for dispatched_email in dispatched_emails:
+            domain = get_email_domain(dispatched_email.subscriber.email)
+            if domain in self._deferred_domains:
+                self._deferred.append(dispatched_email)
+                continue
+            if not self._queues[domain]:
+                self._add_domain(domain)
+            self._queues[domain].append(dispatched_email)
+
+    @property
+    def remaining(self):
+        """The emails that have not yet been scheduled, including any deferred emails."""
+        return self._deferred + [
+            dispatched_email
+            for domain in self._domains
+            for dispatched_email in self._queues[domain]
+        ]
+
+    def pop_deferred(self):
+        """Returns and forgets any emails to deferred domains."""
+        deferred = self._deferred
+        self._deferred = []
+        return deferred
+
+    def _is_available(self, domain, max_wait):
+        """
+        Whether the given domain can accept another email now.
+
+        Domains that will not accept another email within max_wait seconds
+        are deferred, and take no further part in the batch.
+        """
+        concurrency = self._concurrency[domain]
+        if concurrency is not None and self._in_flight[domain] >= concurrency:
+            return False
+        rate_limiter = self._rate_limiters.get(domain)
+        if rate_limiter is not None and rate_limiter.reserve() is None:
+            if rate_limiter.retry_after > max_wait:
+                self._domains.remove(domain)
+                self._deferred_domains.add(domain)
+                self._deferred.extend(self._queues.pop(domain))
+            return False
+        return True
+
+    def iter_emails(self, refill=None, max_queued=None, max_wait=RATE_LIMIT_MAX_WAIT):
+        """
+        Returns an iterator of scheduled emails.
+
+        If given, refill is called to add more emails to the schedule when
+        no queued email can be scheduled and fewer than max_queued emails are
+        queued. It should return zero once there are no more emails to add.
+
+        The iterator yields None when every queued domain is at its limits,
+        and stops early if no email could be scheduled for max_wait seconds.
+        """
+        last_scheduled = time.time()
+        exhausted = refill is None
+        while True:
+            # Take one email from each available domain in turn.
+            scheduled = False
+            for _ in xrange(len(self._domains)):
+                domain = self._domains[0]
+                self._domains.rotate(-1)
+                if self._is_available(domain, max_wait):
+                    dispatched_email = self._queues[domain].popleft()
+                    if not self._queues[domain]:
+                        self._domains.remove(domain)
+                    self._in_flight[domain] += 1
+                    scheduled = True
+                    yield dispatched_email
+            if scheduled:
+                last_scheduled = time.time()
+                continue
+            # Add more emails to the schedule.
+            if not exhausted and (max_queued is None or sum(len(self._queues[domain]) for domain in self._domains) < max_queued):
+                if refill():
+                    continue
+                exhausted = True
+            # Wait for a domain to become available.
+            if not self._domains or time.time() - last_scheduled > max_wait:
+                break
+            yield None
+
+    def finish(self, dispatched_email):
+        """Records that the given email has finished sending."""
+        self._in_flight[get_email_domain(dispatched_email.subscriber.email)] -= 1
+
+    def cancel(self, dispatched_email):
+        """
+        Records that the given email, which must be the last email scheduled,
+        will not be sent after all, such as when the global rate limits will
+        not allow it. The send reserved in its domain's rate limits is
+        released, so it is not lost.
+        """
+        domain = get_email_domain(dispatched_email.subscriber.email)
+        self._in_flight[domain] -= 1
+        rate_limiter = self._rate_limiters.get(domain)
+        if rate_limiter is not None:
+            rate_limiter.release()
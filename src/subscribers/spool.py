@@ -0,0 +1,64 @@
+"""Serialization of pre-rendered emails, so they can be sent without rendering."""
+
+import base64, json, zlib
+from email.message import Message
+
+from django.core.mail import EmailMessage
+
+
+class SpooledMIMEMessage(Message):
+
+    """A MIME message that has already been rendered to a string."""
+
+    def __init__(self, data):
+        """Initializes the spooled MIME message."""
+        Message.__init__(self)
+        self._data = data
+
+    def as_string(self, unixfrom=False):
+        """Returns the rendered message, exactly as it was spooled."""
+        return self._data
+
+
+class SpooledEmail(EmailMessage):
+
+    """
+    An email that was rendered ahead of time.
+
+    The subject and recipients are kept for reporting, but the message is
+    sent exactly as it was rendered.
+    """
+
+    def __init__(self, subject, from_email, to, data):
+        """Initializes the spooled email."""
+        super(SpooledEmail, self).__init__(
+            subject = subject,
+            from_email = from_email,
+            to = to,
+        )
+        self._data = data
+
+    def message(self):
+        """Returns the rendered MIME message."""
+        return SpooledMIMEMessage(self._data)
+
+
+def serialize_email(email):
+    """Serializes the given rendered email to a compact, compressed string."""
+    return base64.b64encode(zlib.compress(json.dumps({
+        "subject": email.subject,
+        "from_email": email.from_email,
+        "to": email.recipients(),
+        "data": email.message().as_string(),
+    })))
+
+
+def deserialize_email(data):
+    """Deserializes an email that was serialized by serialize_email()."""
+    params = json.loads(zlib.decompress(base64.b64decode(data)))
+    return SpooledEmail(
+        subject = params["subject"],
+        from_email = params["from_email"],
+        to = params["to"],
+        data = params["data"].encode("utf-8"),
+    )
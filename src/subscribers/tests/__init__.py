@@ -1,21 +1,33 @@
 """Tests for the django-subscribers application."""
 
-import datetime, cStringIO, os.path
+import asyncore, csv, datetime, cStringIO, os, os.path, signal, smtpd, tempfile, threading, time
 
 from django.db import models		
 from django.test import TestCase
 from django.conf.urls.defaults import *
 from django.contrib import admin
 from django.contrib.auth.models import User
+from django.conf import settings
 from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import cache
 from django.core.management import call_command
 from django import template
 from django.http import HttpResponseNotFound, HttpResponseServerError
+from django.utils.importlib import import_module
+
+from south.orm import FakeORM
 
 import subscribers
-from subscribers.admin import SubscriberAdmin, MailingListAdmin
-from subscribers.models import Subscriber, MailingList, DispatchedEmail, STATUS_SENT, STATUS_UNSUBSCRIBED
-from subscribers.registration import RegistrationError
+from subscribers.admin import SubscriberAdmin, MailingListAdmin, DispatchJobAdmin, ImportJobAdmin
+from subscribers.models import Subscriber, MailingList, DispatchedEmail, ArchivedEmail, DispatchJob, ImportJob, SentCount, STATUS_PENDING, STATUS_SENT, STATUS_CANCELLED, STATUS_UNSUBSCRIBED, STATUS_ERROR, STATUS_SENDING, JOB_STATUS_RUNNING, JOB_STATUS_COMPLETE, JOB_STATUS_FAILED, SpooledMessage, PRIORITY_HIGH
+from subscribers.registration import RegistrationError, StatusWriter, default_email_manager
+from subscribers.scheduler import DomainScheduler
+from subscribers.pipeline import PipelineStats
+from subscribers.transport import SerialTransport, AsyncTransport
+from subscribers.ratelimit import RateLimiter
+from subscribers.importer import SubscriberImporter, ImportJobImporter, ImportJobClaimed, get_import_dir, read_csv_headers, iter_csv_rows, retry_import_jobs
+from subscribers.management.commands import sendemailbatch
 
 
 class TestModelBase(models.Model):
@@ -120,6 +132,145 @@ class SubscriberTest(TestCase):
             # Delete the subscriber (cleanup).
             subscriber.delete()
             
+    def testImportSubscribers(self):
+        Subscriber.objects.subscribe(email="foo1@bar.com", first_name="Foo", is_subscribed=False)
+        stats = SubscriberImporter(chunk_size=2).import_rows([
+            (2, {"email": "FOO1@bar.com", "last_name": "Bar"}),
+            (3, {"email": "foo2@bar.com", "name": "Foo2 Bar"}),
+            (4, {"email": "invalid"}),
+            (5, {"email": "foo3@bar.com"}),
+            (6, {"email": "foo3@bar.com", "first_name": "Foo3"}),
+        ])
+        self.assertEqual(stats.row_count, 4)
+        self.assertEqual(stats.invalid_count, 1)
+        self.assertEqual(stats.invalid_linenos, [4])
+        self.assertEqual(stats.created_count, 2)
+        self.assertEqual(stats.updated_count, 1)
+        # Existing subscribers keep their subscription status and names.
+        self.assertEqual(list(Subscriber.objects.values_list("email", "first_name", "last_name", "is_subscribed")), [
+            ("foo1@bar.com", "Foo", "Bar", False),
+            ("foo2@bar.com", "Foo2", "Bar", True),
+            ("foo3@bar.com", "Foo3", "", True),
+        ])
+        
+    def testImportSubscribersToMailingLists(self):
+        mailing_list1 = MailingList.objects.create(name="Foo list")
+        mailing_list2 = MailingList.objects.create(name="Bar list")
+        Subscriber.objects.subscribe(email="foo1@bar.com").mailing_lists.add(mailing_list1)
+        stats = SubscriberImporter(chunk_size=2, mailing_lists=[mailing_list1]).import_rows([
+            (2, {"email": "foo1@bar.com"}),
+            (3, {"email": "foo2@bar.com", "mailing_list": "bar LIST"}),
+            (4, {"email": "foo3@bar.com", "mailing_list": "Baz list"}),
+            (5, {"email": "foo4@bar.com", "mailing_list": "Bar list"}),
+        ])
+        self.assertEqual(stats.row_count, 3)
+        self.assertEqual(stats.invalid_linenos, [4])
+        self.assertEqual(list(mailing_list1.subscriber_set.values_list("email", flat=True)), ["foo1@bar.com", "foo2@bar.com", "foo4@bar.com"])
+        self.assertEqual(list(mailing_list2.subscriber_set.values_list("email", flat=True)), ["foo2@bar.com", "foo4@bar.com"])
+        
+    def testMailingListAddRemoveSubscribers(self):
+        mailing_list = MailingList.objects.create(name="Foo list")
+        for email in ("foo1@bar.com", "foo2@bar.com", "foo3@bar.com"):
+            Subscriber.objects.subscribe(email=email)
+        Subscriber.objects.get(email="foo1@bar.com").mailing_lists.add(mailing_list)
+        # Existing members are skipped.
+        self.assertEqual(mailing_list.add_subscribers(Subscriber.objects.all()), 2)
+        self.assertEqual(mailing_list.add_subscribers(Subscriber.objects.all()), 0)
+        self.assertEqual(mailing_list.add_subscribers(Subscriber.objects.none()), 0)
+        self.assertEqual(mailing_list.subscriber_set.count(), 3)
+        # Remove some members, including via a queryset that joins the memberships.
+        self.assertEqual(mailing_list.remove_subscribers(Subscriber.objects.filter(mailing_lists=mailing_list, email="foo1@bar.com")), 1)
+        self.assertEqual(mailing_list.remove_subscribers(Subscriber.objects.filter(email="foo1@bar.com")), 0)
+        self.assertEqual(list(mailing_list.subscriber_set.values_list("email", flat=True)), ["foo2@bar.com", "foo3@bar.com"])
+        
+    def testImportJobResumes(self):
+        mailing_list = MailingList.objects.create(name="Foo list")
+        # Simulate a job that was interrupted after importing the first row.
+        job = ImportJob.objects.create(
+            name = "import-multi-col.csv",
+            path = os.path.join(TEST_DIR, "import-multi-col.csv"),
+            status = JOB_STATUS_RUNNING,
+            last_lineno = 2,
+            row_count = 1,
+            created_count = 1,
+        )
+        job.mailing_lists.add(mailing_list)
+        call_command("importsubscribers", verbosity=0)
+        job = ImportJob.objects.get(id=job.id)
+        self.assertEqual(job.status, JOB_STATUS_COMPLETE)
+        self.assertEqual(job.last_lineno, 3)
+        self.assertEqual(job.row_count, 2)
+        self.assertEqual(job.created_count, 2)
+        self.assertEqual(list(Subscriber.objects.values_list("email", flat=True)), ["foo4@bar.com"])
+        self.assertEqual(list(mailing_list.subscriber_set.values_list("email", flat=True)), ["foo4@bar.com"])
+        # Files given on the command line are imported straight away.
+        call_command("importsubscribers", os.path.join(TEST_DIR, "import-multi-col.csv"), mailing_lists=[mailing_list.id], verbosity=0)
+        self.assertEqual(list(mailing_list.subscriber_set.values_list("email", flat=True)), ["foo3@bar.com", "foo4@bar.com"])
+        
+    def testImportLineNumbersAllowForMultilineFields(self):
+        reader = csv.reader(cStringIO.StringIO('email,name\r\nfoo1@bar.com,"Foo\r\nBar"\r\nfoo2@bar.com,Baz\r\n'))
+        headers = read_csv_headers(reader)
+        self.assertEqual([lineno for lineno, data in iter_csv_rows(reader, headers)], [2, 4])
+        
+    def testImportJobChunksAreClaimed(self):
+        job = ImportJob.objects.create(
+            name = "import-multi-col.csv",
+            path = os.path.join(TEST_DIR, "import-multi-col.csv"),
+            status = JOB_STATUS_RUNNING,
+        )
+        importer = ImportJobImporter(job, chunk_size=1)
+        # Another process imports the first chunk of the job.
+        ImportJob.objects.filter(id=job.id).update(last_lineno=2)
+        self.assertRaises(ImportJobClaimed, importer.import_rows, [(2, {"email": "foo3@bar.com"})])
+        self.assertEqual(Subscriber.objects.count(), 0)
+        self.assertEqual(ImportJob.objects.get(id=job.id).row_count, 0)
+        
+    def testFailedImportJobCanBeRetried(self):
+        import_dir = get_import_dir()
+        if not os.path.exists(import_dir):
+            os.makedirs(import_dir)
+        fd, path = tempfile.mkstemp(suffix=".csv", dir=import_dir)
+        with os.fdopen(fd, "wb") as handle:
+            handle.write("name\nFoo\n")
+        job = ImportJob.objects.create(name="import.csv", path=path)
+        # Jobs that cannot be read are failed, keeping their file.
+        call_command("importsubscribers", verbosity=0)
+        job = ImportJob.objects.get(id=job.id)
+        self.assertEqual(job.status, JOB_STATUS_FAILED)
+        self.assertTrue("email" in job.status_message)
+        self.assertTrue(os.path.exists(path))
+        call_command("importsubscribers", verbosity=0)
+        self.assertEqual(ImportJob.objects.get(id=job.id).status, JOB_STATUS_FAILED)
+        # Retried jobs are resumed by the next run.
+        with open(path, "wb") as handle:
+            handle.write("email\nfoo1@bar.com\n")
+        self.assertEqual(retry_import_jobs(ImportJob.objects.all()), 1)
+        call_command("importsubscribers", verbosity=0)
+        job = ImportJob.objects.get(id=job.id)
+        self.assertEqual(job.status, JOB_STATUS_COMPLETE)
+        self.assertEqual(job.status_message, "")
+        self.assertEqual(list(Subscriber.objects.values_list("email", flat=True)), ["foo1@bar.com"])
+        self.assertFalse(os.path.exists(path))
+        
+    def testExportSubscribersCommand(self):
+        mailing_list = MailingList.objects.create(name="Foo list")
+        for email in ("foo3@bar.com", "foo1@bar.com", "foo2@bar.com"):
+            Subscriber.objects.subscribe(email=email, first_name="Foo").mailing_lists.add(mailing_list)
+        Subscriber.objects.subscribe(email="foo4@bar.com", is_subscribed=False)
+        fd, path = tempfile.mkstemp(suffix=".csv")
+        os.close(fd)
+        try:
+            # Export all subscribers, in chunks smaller than the number of subscribers.
+            call_command("exportsubscribers", path, chunk_size=2, verbosity=0)
+            with open(path, "rb") as handle:
+                self.assertEqual(handle.read(), "email,first name,last name,subscribed\r\nfoo1@bar.com,Foo,,1\r\nfoo2@bar.com,Foo,,1\r\nfoo3@bar.com,Foo,,1\r\nfoo4@bar.com,,,0\r\n")
+            # Export a mailing list.
+            call_command("exportsubscribers", path, mailing_lists=[mailing_list.id], chunk_size=3, verbosity=0)
+            with open(path, "rb") as handle:
+                self.assertEqual(handle.read(), "email,first name,last name,subscribed\r\nfoo1@bar.com,Foo,,1\r\nfoo2@bar.com,Foo,,1\r\nfoo3@bar.com,Foo,,1\r\n")
+        finally:
+            os.remove(path)
+        
     def testEmailNormalization(self):
         self.assertEqual(Subscriber.objects.count(), 0)
         Subscriber.objects.subscribe(email="foo@bar.com")
@@ -162,6 +313,436 @@ class DispatchedEmailTest(TestCase):
         self.assertEqual(len(sent_emails), 0)
         self.assertEqual(len(mail.outbox), 4)
     
+    def testDispatchEmailBulk(self):
+        subscriber3 = Subscriber.objects.subscribe(email="foo3@bar.com")
+        # Dispatch an email to all subscribers who have not yet received it.
+        for email in (self.email1, self.email2):
+            self.assertEqual(subscribers.dispatch_email_bulk(email, Subscriber.objects.exclude(id=self.subscriber1.id)), 2)
+        self.assertEqual(DispatchedEmail.objects.count(), 8)
+        self.assertEqual(DispatchedEmail.objects.filter(subscriber=subscriber3).count(), 2)
+        self.assertEqual(self.email1.dispatchedemail_set.count(), 4)
+        self.assertEqual(self.email2.dispatchedemail_set.count(), 4)
+        # Send the emails.
+        sent_emails = subscribers.send_email_batch()
+        self.assertEqual(len([email for email in sent_emails if email.status == STATUS_SENT]), 8)
+        self.assertEqual(len(mail.outbox), 8)
+
+    def testDispatchEmailBulkEmpty(self):
+        self.assertEqual(subscribers.dispatch_email_bulk(self.email1, Subscriber.objects.none()), 0)
+        self.assertEqual(subscribers.dispatch_email_bulk(self.email1, Subscriber.objects.filter(id__in=[])), 0)
+        self.assertEqual(DispatchedEmail.objects.count(), 4)
+
+    def testDispatchEmailJob(self):
+        subscriber3 = Subscriber.objects.subscribe(email="foo3@bar.com")
+        subscriber4 = Subscriber.objects.subscribe(email="foo4@bar.com")
+        job = subscribers.dispatch_email_job(self.email1)
+        self.assertEqual(DispatchedEmail.objects.count(), 4)
+        # Run the job.
+        self.assertEqual(subscribers.run_dispatch_jobs(chunk_size=1), 2)
+        job = DispatchJob.objects.get(id=job.id)
+        self.assertEqual(job.status, JOB_STATUS_COMPLETE)
+        self.assertEqual(job.subscriber_count, 2)
+        self.assertEqual(job.dispatched_count, 2)
+        self.assertEqual(job.last_subscriber_id, subscriber4.id)
+        self.assertEqual(self.email1.dispatchedemail_set.filter(subscriber__in=(subscriber3, subscriber4)).count(), 2)
+        # Make sure the job does not run twice.
+        self.assertEqual(subscribers.run_dispatch_jobs(), 0)
+        self.assertEqual(DispatchedEmail.objects.count(), 6)
+        
+    def testDispatchEmailJobResumes(self):
+        subscriber3 = Subscriber.objects.subscribe(email="foo3@bar.com")
+        subscriber4 = Subscriber.objects.subscribe(email="foo4@bar.com")
+        mailing_list = MailingList.objects.create(name="Foo list")
+        mailing_list.subscriber_set.add(self.subscriber1, subscriber3, subscriber4)
+        # Simulate a job that was interrupted after its first chunk.
+        job = subscribers.dispatch_email_job(self.email2, mailing_list)
+        job.status = JOB_STATUS_RUNNING
+        job.last_subscriber_id = subscriber3.id
+        job.save()
+        # Resume the job.
+        self.assertEqual(subscribers.run_dispatch_jobs(), 1)
+        self.assertEqual(list(DispatchedEmail.objects.filter(date_created__gt=job.date_created).values_list("subscriber_id", flat=True)), [subscriber4.id])
+        self.assertEqual(DispatchJob.objects.get(id=job.id).status, JOB_STATUS_COMPLETE)
+
+    def testDispatchEmailJobMaxChunks(self):
+        subscriber3 = Subscriber.objects.subscribe(email="foo3@bar.com")
+        subscriber4 = Subscriber.objects.subscribe(email="foo4@bar.com")
+        job = subscribers.dispatch_email_job(self.email1)
+        # Run one chunk at a time.
+        self.assertEqual(subscribers.run_dispatch_jobs(chunk_size=1, max_chunks=1), 1)
+        job = DispatchJob.objects.get(id=job.id)
+        self.assertEqual(job.status, JOB_STATUS_RUNNING)
+        self.assertEqual(job.last_subscriber_id, subscriber3.id)
+        self.assertEqual(job.dispatched_count, 1)
+        self.assertEqual(subscribers.run_dispatch_jobs(chunk_size=1, max_chunks=1), 1)
+        self.assertEqual(subscribers.run_dispatch_jobs(chunk_size=1, max_chunks=1), 0)
+        job = DispatchJob.objects.get(id=job.id)
+        self.assertEqual(job.status, JOB_STATUS_COMPLETE)
+        self.assertEqual(job.dispatched_count, 2)
+        self.assertEqual(self.email1.dispatchedemail_set.filter(subscriber__in=(subscriber3, subscriber4)).count(), 2)
+        
+    def testObjectTemplateParamsCalculatedOncePerBatch(self):
+        object_params_calls = []
+        class CountingEmailAdapter(subscribers.EmailAdapter):
+            def get_object_template_params(self, obj):
+                object_params_calls.append(obj)
+                return super(CountingEmailAdapter, self).get_object_template_params(obj)
+        subscribers.unregister(SubscribersTestModel1)
+        subscribers.register(SubscribersTestModel1, CountingEmailAdapter)
+        subscribers.send_email_batch()
+        self.assertEqual(object_params_calls, [self.email1])
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(mail.outbox[0].subject, "Foo 1")
+        self.assertEqual(mail.outbox[1].subject, "Foo 1")
+        
+    def testSubscriberTemplateHooks(self):
+        class SubscriberEmailAdapter(subscribers.EmailAdapter):
+            def get_subject(self, obj, subscriber):
+                return u"{obj} for {email}".format(obj=obj, email=subscriber.email)
+            def get_template_params(self, obj, subscriber):
+                params = super(SubscriberEmailAdapter, self).get_template_params(obj, subscriber)
+                params["greeting"] = u"Dear {email}".format(email=subscriber.email)
+                return params
+            def get_content(self, obj, subscriber):
+                return template.Template("{{greeting}}, {{subject}}").render(template.Context(
+                    self.get_template_params(obj, subscriber),
+                ))
+        subscribers.unregister(SubscribersTestModel1)
+        subscribers.register(SubscribersTestModel1, SubscriberEmailAdapter)
+        subscribers.send_email_batch()
+        self.assertEqual([(email.subject, email.body) for email in mail.outbox if email.subject.startswith("Foo 1")], [
+            ("Foo 1 for foo1@bar.com", "Dear foo1@bar.com, Foo 1 for foo1@bar.com"),
+            ("Foo 1 for foo2@bar.com", "Dear foo2@bar.com, Foo 1 for foo2@bar.com"),
+        ])
+        
+    def testHooksCalledOncePerEmail(self):
+        hook_calls = []
+        class CountingEmailAdapter(subscribers.EmailAdapter):
+            def get_subject(self, obj, subscriber):
+                hook_calls.append("subject")
+                return super(CountingEmailAdapter, self).get_subject(obj, subscriber)
+            def get_unsubscribe_url(self, obj, subscriber):
+                hook_calls.append("unsubscribe_url")
+                return super(CountingEmailAdapter, self).get_unsubscribe_url(obj, subscriber)
+            def get_view_url(self, obj, subscriber):
+                hook_calls.append("view_url")
+                return super(CountingEmailAdapter, self).get_view_url(obj, subscriber)
+        subscribers.unregister(SubscribersTestModel1)
+        subscribers.register(SubscribersTestModel1, CountingEmailAdapter)
+        # Count the domain lookups, without overriding get_domain() in the adapter class.
+        adapter = subscribers.get_adapter(SubscribersTestModel1)
+        get_domain = adapter.get_domain
+        def counting_get_domain(obj, subscriber):
+            hook_calls.append("domain")
+            return get_domain(obj, subscriber)
+        adapter.get_domain = counting_get_domain
+        subscribers.send_email_batch()
+        self.assertEqual(len([email for email in mail.outbox if email.subject == "Foo 1"]), 2)
+        # The subscriber hooks are called once per email, and the domain once per object.
+        self.assertEqual(sorted(hook_calls), ["domain", "domain", "subject", "subject", "unsubscribe_url", "unsubscribe_url", "view_url", "view_url"])
+        
+    def testRenderOnce(self):
+        render_calls = []
+        class PersonalizedEmailAdapter(subscribers.EmailAdapter):
+            def get_content(self, obj, subscriber):
+                render_calls.append(obj)
+                return template.Template("Dear {{subscriber.first_name}} <{{subscriber.email}}>, {{obj}} {{unsubscribe_url}}").render(template.Context(
+                    self.get_template_params(obj, subscriber),
+                ))
+        subscribers.unregister(SubscribersTestModel1)
+        subscribers.register(SubscribersTestModel1, PersonalizedEmailAdapter, render_once=True)
+        self.subscriber2.first_name = "O'Foo"
+        self.subscriber2.save()
+        # Render the emails once, and individually.
+        adapter = subscribers.get_adapter(SubscribersTestModel1)
+        renderer = adapter.get_email_renderer(self.email1)
+        for subscriber in (self.subscriber1, self.subscriber2):
+            email = renderer(subscriber)
+            expected_email = adapter.render_email(self.email1, subscriber)
+            self.assertEqual(email.subject, expected_email.subject)
+            self.assertEqual(email.body, expected_email.body)
+            self.assertEqual(email.alternatives, expected_email.alternatives)
+            self.assertEqual(email.to, expected_email.to)
+        self.assertEqual(len(render_calls), 3)
+        self.assertTrue(email.body.startswith("Dear O&#39;Foo <foo2@bar.com>, Foo 1 "))
+        # Send the batch, rendering the template only once.
+        del render_calls[:]
+        subscribers.send_email_batch()
+        self.assertEqual(len(render_calls), 1)
+        self.assertEqual(len(mail.outbox), 4)
+        
+    def testTransportErrorLeavesNoEmailsClaimed(self):
+        settings.EMAIL_USE_TLS = True
+        try:
+            self.assertRaises(ImproperlyConfigured, subscribers.send_email_batch, transport="async")
+        finally:
+            settings.EMAIL_USE_TLS = False
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_SENDING).count(), 0)
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_PENDING).count(), 4)
+        
+    def testPriorityLanes(self):
+        high_priority_email = subscribers.dispatch_email(self.email2, self.subscriber2, priority=PRIORITY_HIGH)
+        # The high priority email is sent in the first page, ahead of the others.
+        sent_emails = subscribers.send_email_batch(page_size=2)
+        self.assertEqual(len(sent_emails), 5)
+        self.assertEqual(sent_emails[0].id, high_priority_email.id)
+        self.assertEqual(sent_emails[1].id, DispatchedEmail.objects.order_by("id")[0].id)
+        # Adapters can set a default priority.
+        subscribers.unregister(SubscribersTestModel2)
+        subscribers.register(SubscribersTestModel2, priority=PRIORITY_HIGH)
+        self.assertEqual(subscribers.dispatch_email(self.email2, self.subscriber1).priority, PRIORITY_HIGH)
+        # Only priorities with a weight can be dispatched, so no email is left unclaimed.
+        self.assertRaises(ValueError, subscribers.dispatch_email, self.email1, self.subscriber1, priority=5)
+        with self.settings(SUBSCRIBERS_PRIORITY_WEIGHTS={5: 1}):
+            custom_priority_email = subscribers.dispatch_email(self.email1, self.subscriber1, priority=5)
+            self.assertTrue(custom_priority_email.id in [email.id for email in subscribers.send_email_batch()])
+        
+    def testDispatchedEmailsForObject(self):
+        subscribers.dispatch_email_bulk(self.email2, Subscriber.objects.filter(id=self.subscriber1.id))
+        for email in (self.email1, self.email2):
+            self.assertEqual(DispatchedEmail.objects.for_object(email).count(), email.dispatchedemail_set.count())
+        self.assertEqual(DispatchedEmail.objects.for_object(self.email2).count(), 3)
+        self.assertEqual(DispatchedEmail.objects.filter(object_id_hash__isnull=True).count(), 2)
+        
+    def testObjectIdHashMigration(self):
+        DispatchedEmail.objects.update(object_id_hash=None)
+        migration = import_module("subscribers.migrations.0009_hash_dispatchedemail_object_ids").Migration
+        migration().forwards(FakeORM(migration, "subscribers"))
+        # The frozen hash in the migration matches the hash used to look up emails.
+        for email in (self.email1, self.email2):
+            self.assertEqual(DispatchedEmail.objects.for_object(email).count(), 2)
+        self.assertEqual(DispatchedEmail.objects.filter(object_id_hash__isnull=True).count(), 2)
+        
+    def testDeletedObjectsAreCancelled(self):
+        self.email2.dispatchedemail_set.update(object_id="deleted")
+        sent_emails = subscribers.send_email_batch()
+        self.assertEqual(len([email for email in sent_emails if email.status == STATUS_SENT]), 2)
+        self.assertEqual(len([email for email in sent_emails if email.status == STATUS_CANCELLED]), 2)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_CANCELLED, object_id="deleted", date_sent__isnull=False).count(), 2)
+        
+    def testParallelWorkersDoNotSendTwice(self):
+        worker1_emails = subscribers.send_email_batch_iter(2, worker_id="worker1")
+        worker1_sent_emails = [next(worker1_emails)]
+        # Another worker can only claim the remaining emails.
+        worker2_sent_emails = subscribers.send_email_batch(worker_id="worker2")
+        self.assertEqual(len(worker2_sent_emails), 2)
+        worker1_sent_emails.extend(worker1_emails)
+        self.assertEqual(len(worker1_sent_emails), 2)
+        self.assertFalse(set(email.id for email in worker1_sent_emails) & set(email.id for email in worker2_sent_emails))
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_SENT).count(), 4)
+        
+    def testExpiredLeasesAreReclaimed(self):
+        # Simulate a worker that has claimed two emails.
+        claimed_ids = list(DispatchedEmail.objects.values_list("id", flat=True)[:2])
+        DispatchedEmail.objects.filter(id__in=claimed_ids).update(
+            status = STATUS_SENDING,
+            worker_id = "crashed-worker",
+            lease_expires = datetime.datetime.now() + datetime.timedelta(hours=1),
+        )
+        sent_emails = subscribers.send_email_batch()
+        self.assertEqual(len(sent_emails), 2)
+        self.assertFalse(set(email.id for email in sent_emails) & set(claimed_ids))
+        # Expire the lease, and the emails will be reclaimed.
+        DispatchedEmail.objects.filter(id__in=claimed_ids).update(
+            lease_expires = datetime.datetime.now() - datetime.timedelta(seconds=1),
+        )
+        sent_emails = subscribers.send_email_batch()
+        self.assertEqual([email.id for email in sent_emails], claimed_ids)
+        self.assertEqual(len(mail.outbox), 4)
+
+    def testEmailsClaimedInPages(self):
+        sent_emails = subscribers.send_email_batch_iter(page_size=1)
+        next(sent_emails)
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_PENDING).count(), 3)
+        self.assertEqual(len(list(sent_emails)), 3)
+        self.assertEqual(len(mail.outbox), 4)
+        
+    def testRenderPipeline(self):
+        stats = PipelineStats()
+        sent_emails = subscribers.send_email_batch(render_concurrency=3, stats=stats)
+        self.assertEqual(len([email for email in sent_emails if email.status == STATUS_SENT]), 4)
+        self.assertEqual(sorted((email.subject, email.to) for email in mail.outbox), [
+            ("Foo 1", [unicode(self.subscriber1)]),
+            ("Foo 1", [unicode(self.subscriber2)]),
+            ("Foo 2", [unicode(self.subscriber1)]),
+            ("Foo 2", [unicode(self.subscriber2)]),
+        ])
+        self.assertEqual(stats.counts["render"], 4)
+        self.assertEqual(stats.counts["transport"], 4)
+        self.assertEqual(stats.counts["fetch"], 2)
+        self.assertEqual(stats.counts["write"], 1)
+        
+    def testRenderPipelinePreparesParamsOnCallingThread(self):
+        param_threads = []
+        class ThreadRecordingEmailAdapter(subscribers.EmailAdapter):
+            def get_subscriber_template_params(self, obj, subscriber):
+                param_threads.append(threading.current_thread())
+                return super(ThreadRecordingEmailAdapter, self).get_subscriber_template_params(obj, subscriber)
+        subscribers.unregister(SubscribersTestModel1)
+        subscribers.register(SubscribersTestModel1, ThreadRecordingEmailAdapter)
+        subscribers.send_email_batch(render_concurrency=3)
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(param_threads, [threading.current_thread()] * 2)
+        
+    def testSendEmailBatchCommandWithRenderConcurrency(self):
+        call_command("sendemailbatch", verbosity=0, render_concurrency=2)
+        self.assertEqual(len(mail.outbox), 4)
+        
+    def testSpooledEmails(self):
+        render_calls = []
+        class CountingEmailAdapter(subscribers.EmailAdapter):
+            def get_content(self, obj, subscriber):
+                render_calls.append(obj)
+                return super(CountingEmailAdapter, self).get_content(obj, subscriber)
+        subscribers.unregister(SubscribersTestModel1)
+        subscribers.register(SubscribersTestModel1, CountingEmailAdapter)
+        self.email2.dispatchedemail_set.update(date_to_send=datetime.datetime.now() + datetime.timedelta(days=1))
+        # Only spool the emails that are due soon.
+        self.assertEqual(subscribers.spool_emails(spool_ahead=60 * 60), 2)
+        self.assertEqual(subscribers.spool_emails(spool_ahead=60 * 60), 0)
+        self.assertEqual(len(render_calls), 2)
+        self.assertEqual(SpooledMessage.objects.count(), 2)
+        # Send the spooled emails, without rendering.
+        del render_calls[:]
+        sent_emails = subscribers.send_email_batch()
+        self.assertEqual(len([email for email in sent_emails if email.status == STATUS_SENT]), 2)
+        self.assertEqual(render_calls, [])
+        self.assertEqual([(email.subject, email.to) for email in mail.outbox], [
+            ("Foo 1", [unicode(self.subscriber1)]),
+            ("Foo 1", [unicode(self.subscriber2)]),
+        ])
+        self.assertTrue("Foo 1" in mail.outbox[0].message().as_string())
+        self.assertEqual(SpooledMessage.objects.count(), 0)
+        
+    def testSpoolEmailsCommand(self):
+        call_command("spoolemails", verbosity=0, render_concurrency=2)
+        self.assertEqual(SpooledMessage.objects.count(), 4)
+        call_command("sendemailbatch", verbosity=0)
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(SpooledMessage.objects.count(), 0)
+        
+    def testStatusesWrittenInBatches(self):
+        with self.settings(SUBSCRIBERS_STATUS_FLUSH_SIZE=3):
+            sent_emails = subscribers.send_email_batch_iter()
+            next(sent_emails)
+            next(sent_emails)
+            self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_SENT).count(), 0)
+            next(sent_emails)
+            self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_SENT).count(), 3)
+            # Remaining statuses are written when the batch finishes.
+            self.assertEqual(len(list(sent_emails)), 1)
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_SENT, date_sent__isnull=False, lease_expires__isnull=True).count(), 4)
+        
+    def testStoppingReleasesUnsentEmails(self):
+        stopping = []
+        sent_emails = subscribers.send_email_batch_iter(transport=SerialTransport(), should_stop=lambda: bool(stopping))
+        self.assertEqual(next(sent_emails).status, STATUS_SENT)
+        stopping.append(True)
+        self.assertEqual(list(sent_emails), [])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_SENT).count(), 1)
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_PENDING, worker_id="", lease_expires__isnull=True).count(), 3)
+        
+    def testStaleStatusesFlushedWhenIdle(self):
+        status_writer = StatusWriter(flush_size=100, flush_interval=0.1)
+        dispatched_email = DispatchedEmail.objects.all()[0]
+        dispatched_email.status = STATUS_SENT
+        dispatched_email.date_sent = datetime.datetime.now()
+        status_writer.write(dispatched_email)
+        status_writer.flush_if_stale()
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_SENT).count(), 0)
+        # An idle tick from the transport flushes the stale status.
+        transport = SerialTransport()
+        time.sleep(0.1)
+        self.assertEqual(list(transport.send_iter([None], on_idle=status_writer.flush_if_stale)), [])
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_SENT).count(), 1)
+        
+    def testStatusesKeepTheirOwnTimes(self):
+        status_writer = StatusWriter(flush_size=100)
+        dispatched_emails = list(DispatchedEmail.objects.all()[:3])
+        date_sent = datetime.datetime.now().replace(minute=59, second=0, microsecond=0)
+        for index, dispatched_email in enumerate(dispatched_emails):
+            dispatched_email.status = STATUS_SENT
+            dispatched_email.date_sent = date_sent + datetime.timedelta(seconds=index * 30)
+            status_writer.write(dispatched_email)
+        status_writer.flush()
+        # Each email keeps its own send time, and is counted in the hour it was sent.
+        for dispatched_email in dispatched_emails:
+            self.assertEqual(DispatchedEmail.objects.get(id=dispatched_email.id).date_sent, dispatched_email.date_sent)
+        manager_slug = dispatched_emails[0].manager_slug
+        later_date_sent = date_sent + datetime.timedelta(minutes=1)
+        self.assertEqual(SentCount.objects.get_count(manager_slug, date_sent.date(), date_sent.hour), 2)
+        self.assertEqual(SentCount.objects.get_count(manager_slug, later_date_sent.date(), later_date_sent.hour), 1)
+        
+    def testRateLimitPacesSending(self):
+        cache.clear()
+        start_time = time.time()
+        with self.settings(SUBSCRIBERS_RATE_LIMITS={"second": 5}):
+            sent_emails = subscribers.send_email_batch()
+        self.assertEqual(len(sent_emails), 4)
+        self.assertTrue(time.time() - start_time >= 0.6)
+        
+    def testRateLimitSharedBetweenWorkers(self):
+        cache.clear()
+        limiters = [RateLimiter({"second": 5, "day": 100}, "test") for _ in xrange(2)]
+        # Workers take turns in the shared schedule, rather than each sending at the full rate.
+        waits = [limiters[index % 2].reserve(1) for index in xrange(4)]
+        for wait, expected_wait in zip(waits, (0, 0.2, 0.4, 0.6)):
+            self.assertTrue(abs(wait - expected_wait) < 0.05)
+        self.assertEqual(limiters[0].reserve(0), None)
+        self.assertTrue(limiters[0].retry_after > 0.6)
+        # Waiting for the rate limit does not block.
+        acquired = list(limiters[1].acquire_iter())
+        self.assertTrue(None in acquired)
+        self.assertEqual(acquired[-1], True)
+        # Daily limits are counted from midnight local time, like the sent counts.
+        self.assertEqual(limiters[0]._get_window("day", time.time())[0], datetime.datetime.now().strftime("%Y%m%d00"))
+        
+    def testRateLimitReleasesRemainingEmails(self):
+        cache.clear()
+        with self.settings(SUBSCRIBERS_RATE_LIMITS={"day": 3}):
+            self.assertEqual(len(subscribers.send_email_batch()), 3)
+            self.assertEqual(len(subscribers.send_email_batch()), 0)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_PENDING, worker_id="", lease_expires__isnull=True).count(), 1)
+        
+    def testEmailsSentToEachDomainInTurn(self):
+        subscriber3 = Subscriber.objects.subscribe(email="foo3@baz.com")
+        subscribers.dispatch_email(self.email1, subscriber3)
+        sent_emails = subscribers.send_email_batch()
+        self.assertEqual([email.subscriber.email for email in sent_emails], ["foo1@bar.com", "foo3@baz.com", "foo2@bar.com", "foo1@bar.com", "foo2@bar.com"])
+        
+    def testThrottledDomainsAreDeferred(self):
+        cache.clear()
+        subscriber3 = Subscriber.objects.subscribe(email="foo3@baz.com")
+        subscribers.dispatch_email(self.email1, subscriber3)
+        with self.settings(SUBSCRIBERS_DOMAIN_LIMITS={"bar.com": {"rate_limits": {"day": 1}}}):
+            sent_emails = subscribers.send_email_batch()
+        self.assertEqual(sorted(email.subscriber.email for email in sent_emails), ["foo1@bar.com", "foo3@baz.com"])
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_PENDING, worker_id="").count(), 3)
+        
+    def testGlobalRateLimitDoesNotUseDomainRateLimit(self):
+        cache.clear()
+        domain_limits = {"bar.com": {"rate_limits": {"day": 3}}}
+        with self.settings(SUBSCRIBERS_RATE_LIMITS={"day": 2}, SUBSCRIBERS_DOMAIN_LIMITS=domain_limits):
+            self.assertEqual(len(subscribers.send_email_batch()), 2)
+        # The email refused by the global rate limits handed back its place in the domain rate limits.
+        with self.settings(SUBSCRIBERS_DOMAIN_LIMITS=domain_limits):
+            self.assertEqual(len(subscribers.send_email_batch()), 1)
+        self.assertEqual(len(mail.outbox), 3)
+        
+    def testDomainConcurrencyLimit(self):
+        with self.settings(SUBSCRIBERS_DOMAIN_LIMITS={"*": {"concurrency": 1}}):
+            scheduler = DomainScheduler("default", DispatchedEmail.objects.select_related("subscriber"))
+        scheduled_emails = scheduler.iter_emails()
+        dispatched_email = next(scheduled_emails)
+        self.assertEqual(next(scheduled_emails), None)
+        scheduler.finish(dispatched_email)
+        self.assertNotEqual(next(scheduled_emails), None)
+        self.assertEqual(len(scheduler.remaining), 2)
+        
     def testSendPartialBatch(self):
         sent_emails = subscribers.send_email_batch(2)
         self.assertEqual(len([email for email in sent_emails if email.status == STATUS_SENT]), 2)
@@ -194,11 +775,228 @@ class DispatchedEmailTest(TestCase):
         call_command("sendemailbatch", "2", verbosity=0)
         self.assertEqual(len(mail.outbox), 2)
         
+    def testSendEmailBatchCommandWithDailyLimit(self):
+        call_command("sendemailbatch", "1", verbosity=0, daily_limit=3)
+        self.assertEqual(SentCount.objects.get_count("default", datetime.date.today()), 1)
+        call_command("sendemailbatch", verbosity=0, daily_limit=3)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(SentCount.objects.get_count("default", datetime.date.today()), 3)
+        self.assertEqual(SentCount.objects.get_count("default", datetime.date.today(), datetime.datetime.now().hour), 3)
+        
+    def testDaemonSleepsWhileOverQuota(self):
+        # Count the daemon polls, stopping the daemon after a couple of poll intervals.
+        poll_times = []
+        get_batch_size = sendemailbatch.Command.get_batch_size
+        def counting_get_batch_size(command, *args):
+            poll_times.append(time.time())
+            return get_batch_size(command, *args)
+        sendemailbatch.Command.get_batch_size = counting_get_batch_size
+        stop_timer = threading.Timer(1.5, os.kill, (os.getpid(), signal.SIGTERM))
+        stop_timer.start()
+        try:
+            call_command("sendemailbatch", verbosity=0, daemon=True, daily_limit=0)
+        finally:
+            sendemailbatch.Command.get_batch_size = get_batch_size
+            stop_timer.join()
+        self.assertEqual(len(mail.outbox), 0)
+        # The daemon backs off to the longest poll interval, rather than spinning.
+        self.assertTrue(1 <= len(poll_times) <= 3)
+        
+    def testArchiveEmails(self):
+        subscribers.send_email_batch(3)
+        # Recently finished emails are not archived.
+        call_command("archiveemails", verbosity=0)
+        self.assertEqual(ArchivedEmail.objects.count(), 0)
+        # Archive the finished emails.
+        DispatchedEmail.objects.filter(status=STATUS_SENT).update(date_sent=datetime.datetime.now() - datetime.timedelta(days=31))
+        call_command("archiveemails", verbosity=0, chunk_size=2)
+        self.assertEqual(ArchivedEmail.objects.count(), 3)
+        self.assertEqual(DispatchedEmail.objects.count(), 1)
+        # Archived emails still count as received.
+        self.assertEqual(ArchivedEmail.objects.for_object(self.email1).count(), 2)
+        self.assertEqual(ArchivedEmail.objects.for_object(self.email2).count(), 1)
+        self.assertEqual(subscribers.dispatch_email_bulk(self.email1, default_email_manager.get_subscribers_to_send(self.email1)), 0)
+        self.assertEqual(subscribers.dispatch_email_bulk(self.email2, default_email_manager.get_subscribers_to_send(self.email2)), 0)
+        
+    def testRebuildSentCounts(self):
+        subscribers.send_email_batch()
+        SentCount.objects.all().delete()
+        SentCount.objects.increment("default", datetime.datetime.now() - datetime.timedelta(days=1), 10)
+        call_command("rebuildsentcounts", verbosity=0)
+        self.assertEqual(SentCount.objects.get_count("default", datetime.date.today()), 4)
+        self.assertEqual(SentCount.objects.get_count("default", datetime.date.today() - datetime.timedelta(days=1)), 0)
+        # Archived emails are still counted.
+        date_archived = datetime.datetime.now() - datetime.timedelta(days=31)
+        DispatchedEmail.objects.filter(id__in=list(DispatchedEmail.objects.order_by("id").values_list("id", flat=True)[:2])).update(date_sent=date_archived)
+        call_command("archiveemails", verbosity=0)
+        self.assertEqual(ArchivedEmail.objects.filter(manager_slug="default").count(), 2)
+        call_command("rebuildsentcounts", verbosity=0)
+        self.assertEqual(SentCount.objects.get_count("default", datetime.date.today()), 2)
+        self.assertEqual(SentCount.objects.get_count("default", date_archived.date()), 2)
+        
     def tearDown(self):
         subscribers.unregister(SubscribersTestModel1)
         subscribers.unregister(SubscribersTestModel2)
 
 
+class DummySMTPServer(smtpd.SMTPServer):
+
+    """A local SMTP server, running in a background thread, that records the messages it receives."""
+
+    def __init__(self):
+        self.socket_map = {}
+        self.messages = []
+        self.rejected_recipients = set()
+        self.rejection = "554 Transaction failed"
+        self.connection_count = 0
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.create_socket(smtpd.socket.AF_INET, smtpd.socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(("127.0.0.1", 0))
+        self.listen(5)
+        self.port = self.socket.getsockname()[1]
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while self._running:
+            asyncore.loop(timeout=0.01, map=self.socket_map, count=1)
+        for channel in self.socket_map.values():
+            channel.close()
+
+    def handle_accept(self):
+        conn, addr = self.accept()
+        self.connection_count += 1
+        channel = smtpd.SMTPChannel(self, conn, addr)
+        # HACK: The Python 2 SMTPChannel always registers itself in the global socket map.
+        del asyncore.socket_map[channel._fileno]
+        channel._map = self.socket_map
+        self.socket_map[channel._fileno] = channel
+        
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.rejected_recipients.intersection(rcpttos):
+            return self.rejection
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+
+class ConcurrentSendingTest(TestCase):
+
+    def setUp(self):
+        subscribers.register(SubscribersTestModel1)
+        self.email = SubscribersTestModel1.objects.create(subject="Foo 1")
+        for index in xrange(10):
+            Subscriber.objects.subscribe(email="foo{index}@bar.com".format(index=index))
+        subscribers.dispatch_email_bulk(self.email, Subscriber.objects.all())
+        self.smtp_server = DummySMTPServer()
+        
+    def smtp_settings(self, **kwargs):
+        return self.settings(
+            EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend",
+            EMAIL_HOST = "127.0.0.1",
+            EMAIL_PORT = self.smtp_server.port,
+            **kwargs
+        )
+        
+    def testConcurrentSending(self):
+        with self.smtp_settings():
+            sent_emails = subscribers.send_email_batch(concurrency=4)
+        self.assertEqual(len([email for email in sent_emails if email.status == STATUS_SENT]), 10)
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_SENT).count(), 10)
+        self.assertEqual(sorted(rcpttos for mailfrom, rcpttos, data in self.smtp_server.messages), [["foo{index}@bar.com".format(index=index)] for index in xrange(10)])
+        self.assertTrue(self.smtp_server.connection_count <= 4)
+        
+    def testMaxMessagesPerConnection(self):
+        with self.smtp_settings(SUBSCRIBERS_MAX_MESSAGES_PER_CONNECTION=2):
+            sent_emails = subscribers.send_email_batch(concurrency=2)
+        self.assertEqual(len([email for email in sent_emails if email.status == STATUS_SENT]), 10)
+        self.assertEqual(len(self.smtp_server.messages), 10)
+        self.assertTrue(self.smtp_server.connection_count >= 5)
+        
+    def testSendEmailBatchCommandWithConcurrency(self):
+        with self.smtp_settings():
+            call_command("sendemailbatch", verbosity=0, concurrency=3)
+        self.assertEqual(len(self.smtp_server.messages), 10)
+        
+    def testSendEmailBatchDaemon(self):
+        # Stop the daemon after it has had time to send the emails.
+        stop_timer = threading.Timer(1, os.kill, (os.getpid(), signal.SIGTERM))
+        stop_timer.start()
+        with self.smtp_settings():
+            call_command("sendemailbatch", "3", verbosity=0, daemon=True)
+        stop_timer.join()
+        self.assertEqual(len(self.smtp_server.messages), 10)
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_SENT).count(), 10)
+        # The connection was kept open between batches.
+        self.assertEqual(self.smtp_server.connection_count, 1)
+        
+    def testAsyncSending(self):
+        self.smtp_server.rejected_recipients.add("foo3@bar.com")
+        with self.smtp_settings(SUBSCRIBERS_MAX_MESSAGES_PER_CONNECTION=3):
+            sent_emails = subscribers.send_email_batch(concurrency=4, transport="async")
+        self.assertEqual(len(sent_emails), 10)
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_SENT).count(), 9)
+        self.assertEqual(DispatchedEmail.objects.get(status=STATUS_ERROR).subscriber.email, "foo3@bar.com")
+        self.assertEqual(sorted(rcpttos for mailfrom, rcpttos, data in self.smtp_server.messages), [["foo{index}@bar.com".format(index=index)] for index in xrange(10) if index != 3])
+        self.assertTrue("Subject: Foo 1" in self.smtp_server.messages[0][2])
+        
+    def testAsyncSendingConnectionRefused(self):
+        self.smtp_server.stop()
+        with self.smtp_settings():
+            sent_emails = subscribers.send_email_batch(concurrency=2, transport="async")
+        self.assertEqual(len(sent_emails), 10)
+        # Connection errors are transient, so the emails will be retried.
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_PENDING, attempt_count=1, date_next_attempt__isnull=False).count(), 10)
+        
+    def testTransientErrorsAreRetried(self):
+        self.smtp_server.rejected_recipients.add("foo3@bar.com")
+        self.smtp_server.rejection = "451 Try again later"
+        with self.smtp_settings():
+            self.assertEqual(len(subscribers.send_email_batch()), 10)
+            # The failed email is not retried until its next attempt is due.
+            self.assertEqual(len(subscribers.send_email_batch()), 0)
+            dispatched_email = DispatchedEmail.objects.get(subscriber__email="foo3@bar.com")
+            self.assertEqual(dispatched_email.status, STATUS_PENDING)
+            self.assertEqual(dispatched_email.attempt_count, 1)
+            self.assertTrue(dispatched_email.date_next_attempt > datetime.datetime.now())
+            self.assertTrue("Try again later" in dispatched_email.status_message)
+            # Retry the email.
+            self.smtp_server.rejected_recipients.clear()
+            DispatchedEmail.objects.filter(id=dispatched_email.id).update(date_next_attempt=datetime.datetime.now())
+            self.assertEqual([email.status for email in subscribers.send_email_batch()], [STATUS_SENT])
+        self.assertEqual(DispatchedEmail.objects.get(id=dispatched_email.id).attempt_count, 2)
+        self.assertEqual(len(self.smtp_server.messages), 10)
+        
+    def testTransientErrorsStopAfterMaxAttempts(self):
+        self.smtp_server.rejected_recipients.add("foo3@bar.com")
+        self.smtp_server.rejection = "451 Try again later"
+        with self.smtp_settings(SUBSCRIBERS_MAX_SEND_ATTEMPTS=1):
+            subscribers.send_email_batch()
+        self.assertEqual(DispatchedEmail.objects.get(subscriber__email="foo3@bar.com").status, STATUS_ERROR)
+        
+    def testAsyncTransportRefusesPlaintextAuth(self):
+        with self.smtp_settings(EMAIL_HOST_USER="foo", EMAIL_HOST_PASSWORD="bar"):
+            self.assertRaises(ImproperlyConfigured, subscribers.send_email_batch, transport="async")
+            with self.settings(SUBSCRIBERS_ASYNC_ALLOW_PLAINTEXT_AUTH=True):
+                self.assertEqual(AsyncTransport(1).username, "foo")
+        self.assertEqual(DispatchedEmail.objects.filter(status=STATUS_PENDING).count(), 10)
+        self.assertEqual(len(self.smtp_server.messages), 0)
+        
+    def testSendEmailBatchCommandWithAsyncTransport(self):
+        with self.smtp_settings():
+            call_command("sendemailbatch", verbosity=0, concurrency=3, transport="async")
+        self.assertEqual(len(self.smtp_server.messages), 10)
+        
+    def tearDown(self):
+        self.smtp_server.stop()
+        subscribers.unregister(SubscribersTestModel1)
+
+
 # Tests that require a url conf.
 
 
@@ -220,6 +1018,8 @@ class SubscribersTestAdminModel2(TestModelBase):
 admin_site = admin.AdminSite()
 admin_site.register(Subscriber, SubscriberAdmin)
 admin_site.register(MailingList, MailingListAdmin)
+admin_site.register(DispatchJob, DispatchJobAdmin)
+admin_site.register(ImportJob, ImportJobAdmin)
 admin_site.register(SubscribersTestAdminModel1, subscribers.EmailAdmin)
 admin_site.register(SubscribersTestAdminModel2, subscribers.EmailAdmin)
 
@@ -287,7 +1087,8 @@ class SubscriberAdminTest(AdminTestBase):
             "_selected_action": self.subscriber.id,
         })
         self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
-        self.assertEqual(response.content, "email,first name,last name,subscribed\r\nfoo@bar.com,,,1\r\n")
+        content = "".join(response.streaming_content) if getattr(response, "streaming", False) else response.content
+        self.assertEqual(content, "email,first name,last name,subscribed\r\nfoo@bar.com,,,1\r\n")
 
     def testSubscribeSelectedAction(self):
         self.subscriber.is_subscribed = False
@@ -334,6 +1135,38 @@ class SubscriberAdminTest(AdminTestBase):
         self.assertRedirects(response, "/admin/subscribers/subscriber/")
         self.assertEqual(list(Subscriber.objects.get(id=self.subscriber.id).mailing_lists.all()), [])
         
+    def testBulkActionsOnAllSubscribers(self):
+        mailing_list = MailingList.objects.create(
+            name = "Foo list",
+        )
+        self.subscriber.mailing_lists.add(mailing_list)
+        for email in ("foo1@bar.com", "foo2@bar.com"):
+            Subscriber.objects.subscribe(email=email)
+        # Add all subscribers to the mailing list, skipping the existing member.
+        response = self.client.post("/admin/subscribers/subscriber/", {
+            "action": "add_selected_to_foo_list_{pk}".format(pk=mailing_list.pk),
+            "_selected_action": self.subscriber.id,
+            "select_across": "1",
+        }, follow=True)
+        self.assertContains(response, "2 subscribers were added to Foo list.")
+        self.assertEqual(mailing_list.subscriber_set.count(), 3)
+        # Unsubscribe all members of the mailing list.
+        response = self.client.post("/admin/subscribers/subscriber/?mailing_lists__id__exact={pk}".format(pk=mailing_list.pk), {
+            "action": "unsubscribe_selected",
+            "_selected_action": self.subscriber.id,
+            "select_across": "1",
+        }, follow=True)
+        self.assertContains(response, "3 subscribers were marked as unsubscribed.")
+        self.assertEqual(Subscriber.objects.filter(is_subscribed=True).count(), 0)
+        # Remove all members of the mailing list.
+        response = self.client.post("/admin/subscribers/subscriber/?mailing_lists__id__exact={pk}".format(pk=mailing_list.pk), {
+            "action": "remove_selected_from_foo_list_{pk}".format(pk=mailing_list.pk),
+            "_selected_action": self.subscriber.id,
+            "select_across": "1",
+        }, follow=True)
+        self.assertContains(response, "3 subscribers were removed from Foo list.")
+        self.assertEqual(mailing_list.subscriber_set.count(), 0)
+        
     def testImportFromCSV(self):
         # Make sure that the form renders.
         response = self.client.get("/admin/subscribers/subscriber/import/")
@@ -344,22 +1177,43 @@ class SubscriberAdminTest(AdminTestBase):
             response = self.client.post("/admin/subscribers/subscriber/import/", {
                 "file": csv_handle,
             })
-        self.assertRedirects(response, "/admin/subscribers/subscriber/")
+        self.assertRedirects(response, "/admin/subscribers/subscriber/import/")
+        self.assertEqual(Subscriber.objects.count(), 1)
+        call_command("importsubscribers", verbosity=0)
         self.assertEqual(Subscriber.objects.count(), 2)
         # Try importing a two-column CSV.
         with open(os.path.join(TEST_DIR, "import-2-col.csv"), "rb") as csv_handle:
             response = self.client.post("/admin/subscribers/subscriber/import/", {
                 "file": csv_handle,
             })
-        self.assertRedirects(response, "/admin/subscribers/subscriber/")
+        self.assertRedirects(response, "/admin/subscribers/subscriber/import/")
+        call_command("importsubscribers", verbosity=0)
         self.assertEqual(Subscriber.objects.count(), 4)
         # Try importing a multi-column CSV.
         with open(os.path.join(TEST_DIR, "import-multi-col.csv"), "rb") as csv_handle:
             response = self.client.post("/admin/subscribers/subscriber/import/", {
                 "file": csv_handle,
             })
-        self.assertRedirects(response, "/admin/subscribers/subscriber/")
+        self.assertRedirects(response, "/admin/subscribers/subscriber/import/")
+        call_command("importsubscribers", verbosity=0)
         self.assertEqual(Subscriber.objects.count(), 6)
+        # The import jobs are shown on the import page.
+        self.assertEqual(ImportJob.objects.filter(status=JOB_STATUS_COMPLETE).count(), 3)
+        response = self.client.get("/admin/subscribers/subscriber/import/")
+        self.assertContains(response, "import-multi-col.csv")
+        self.assertContains(response, "2 subscribers imported, up to line 3")
+        
+    def testImportJobMailingListsAreReadOnly(self):
+        mailing_list1 = MailingList.objects.create(name="Foo list")
+        mailing_list2 = MailingList.objects.create(name="Bar list")
+        job = ImportJob.objects.create(name="import.csv", path="import.csv", status=JOB_STATUS_RUNNING)
+        job.mailing_lists.add(mailing_list1)
+        response = self.client.get("/admin/subscribers/importjob/{id}/".format(id=job.id))
+        self.assertContains(response, "Foo list")
+        self.client.post("/admin/subscribers/importjob/{id}/".format(id=job.id), {
+            "mailing_lists": [mailing_list2.id],
+        })
+        self.assertEqual(list(job.mailing_lists.all()), [mailing_list1])
 
 
 class MailingListAdminTest(AdminTestBase):
@@ -487,6 +1341,7 @@ class EmailAdminTest(AdminTestBase):
             "_send_on_time": "",
         })
         self.assertRedirects(response, change_url)
+        subscribers.run_dispatch_jobs()
         self.assertEqual(len(subscribers.send_email_batch()), 0)
         self.assertEqual(len(mail.outbox), 0)
         # Send to a list with an unsubscribed person.
@@ -498,6 +1353,7 @@ class EmailAdminTest(AdminTestBase):
             "_send_on_time": "",
         })
         self.assertRedirects(response, "/admin/auth/{model_slug}/".format(model_slug=model_slug))
+        subscribers.run_dispatch_jobs()
         self.assertEqual(len(subscribers.send_email_batch()), 0)
         self.assertEqual(len(mail.outbox), 0)
         # Subscribe the person again.
@@ -512,6 +1368,7 @@ class EmailAdminTest(AdminTestBase):
             "_send_on_time": "",
         })
         self.assertRedirects(response, "/admin/auth/{model_slug}/".format(model_slug=model_slug))
+        subscribers.run_dispatch_jobs()
         self.assertEqual(len(subscribers.send_email_batch()), 1)
         self.assertEqual(len(mail.outbox), 1)
         # Send to everyone, minus the people who have received it.
@@ -523,8 +1380,12 @@ class EmailAdminTest(AdminTestBase):
             "_send_on_time": "",
         })
         self.assertRedirects(response, "/admin/auth/{model_slug}/".format(model_slug=model_slug))
+        subscribers.run_dispatch_jobs()
         self.assertEqual(len(subscribers.send_email_batch()), 1)
         self.assertEqual(len(mail.outbox), 2)
+        # Check the progress of the dispatch jobs.
+        response = self.client.get("/admin/subscribers/dispatchjob/")
+        self.assertContains(response, "1 of 1", count=2)
         
     def testSaveAndSend(self):
         self.assertSaveAndSendWorks(SubscribersTestAdminModel1)
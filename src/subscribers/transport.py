@@ -0,0 +1,582 @@
+"""Transports used to send batches of emails."""
+
+import asynchat, asyncore, base64, smtplib, socket, sys, threading, time
+from collections import deque
+from Queue import Queue, Empty
+from contextlib import closing
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import get_connection
+from django.core.mail.message import sanitize_address
+from django.core.mail.utils import DNS_NAME
+
+
+# The available transports.
+TRANSPORT_THREADED = "threaded"
+TRANSPORT_ASYNC = "async"
+
+# The number of seconds that an async SMTP session may wait for a server response.
+ASYNC_SESSION_TIMEOUT = 60
+
+# The number of seconds to wait for in-flight emails when no email is ready to send.
+IDLE_WAIT = 0.05
+
+
+def is_transient_error(ex):
+    """
+    Whether the given sending error is likely to be temporary, so the email
+    should be retried.
+
+    SMTP replies in the 4xx range, dropped connections and network errors are
+    transient. All other errors are permanent.
+    """
+    if isinstance(ex, smtplib.SMTPRecipientsRefused):
+        return bool(ex.recipients) and all(400 <= code < 500 for code, message in ex.recipients.itervalues())
+    if isinstance(ex, smtplib.SMTPResponseException):
+        return 400 <= ex.smtp_code < 500
+    return isinstance(ex, (smtplib.SMTPServerDisconnected, socket.error))
+
+
+def get_max_messages_per_connection():
+    """Returns the number of messages to send over a connection before reconnecting, or None."""
+    return getattr(settings, "SUBSCRIBERS_MAX_MESSAGES_PER_CONNECTION", None)
+
+
+def get_async_allow_plaintext_auth():
+    """Returns whether the async transport may send credentials over an unencrypted connection."""
+    return getattr(settings, "SUBSCRIBERS_ASYNC_ALLOW_PLAINTEXT_AUTH", False)
+
+
+class PooledConnection(object):
+
+    """An email backend connection that reconnects after sending a maximum number of messages."""
+
+    def __init__(self, max_messages=None):
+        """Initializes the pooled connection."""
+        self._max_messages = max_messages
+        self._connection = None
+        self._sent_count = 0
+
+    def send(self, email):
+        """Sends the given email, opening a connection if required."""
+        if self._connection is None:
+            self._connection = get_connection()
+            self._connection.open()
+        try:
+            email.connection = self._connection
+            email.send()
+        except Exception:
+            # The connection may be broken, so reconnect for the next email.
+            self.close()
+            raise
+        self._sent_count += 1
+        if self._max_messages is not None and self._sent_count >= self._max_messages:
+            self.close()
+
+    def close(self):
+        """Closes the underlying connection, if open."""
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            finally:
+                self._connection = None
+                self._sent_count = 0
+
+
+class SerialTransport(object):
+
+    """Sends emails one at a time over a single connection."""
+
+    def __init__(self, max_messages_per_connection=None):
+        """Initializes the serial transport."""
+        self._connection = PooledConnection(max_messages_per_connection)
+
+    def send_iter(self, emails, on_idle=None):
+        """
+        Sends the given iterable of (key, email) pairs.
+
+        Returns an iterator of (key, exception) pairs, in the order that the
+        emails were sent. The exception will be None if the email was sent
+        successfully.
+        
+        The iterable may yield None when no email is ready to send.
+
+        If given, on_idle is called with no arguments whenever the transport
+        waits without a result, so the caller can do other work.
+        """
+        for item in emails:
+            if item is None:
+                time.sleep(IDLE_WAIT)
+                if on_idle is not None:
+                    on_idle()
+                continue
+            key, email = item
+            try:
+                self._connection.send(email)
+            except Exception as ex:
+                yield key, ex
+            else:
+                yield key, None
+
+    def close(self):
+        """Closes the transport."""
+        self._connection.close()
+
+
+class ThreadedTransport(object):
+
+    """
+    Sends emails concurrently using a pool of worker threads, each with its
+    own connection.
+
+    Emails are generated and results are returned on the calling thread, so
+    all database access can stay on the calling thread.
+    """
+
+    def __init__(self, concurrency, max_messages_per_connection=None):
+        """Initializes the threaded transport."""
+        self._email_queue = Queue(concurrency * 2)
+        self._result_queue = Queue()
+        self._threads = [
+            threading.Thread(
+                target = self._send_worker,
+                args = (PooledConnection(max_messages_per_connection),),
+                name = "subscribers-sender-{index}".format(index=index),
+            )
+            for index in xrange(concurrency)
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _send_worker(self, connection):
+        """Sends emails from the email queue until a None sentinel is received."""
+        with closing(connection):
+            while True:
+                item = self._email_queue.get()
+                if item is None:
+                    break
+                key, email = item
+                try:
+                    connection.send(email)
+                except Exception as ex:
+                    self._result_queue.put((key, ex))
+                else:
+                    self._result_queue.put((key, None))
+
+    def send_iter(self, emails, on_idle=None):
+        """
+        Sends the given iterable of (key, email) pairs.
+
+        Returns an iterator of (key, exception) pairs, in the order that the
+        emails finished sending. The exception will be None if the email was
+        sent successfully.
+        
+        The iterable may yield None when no email is ready to send.
+
+        If given, on_idle is called with no arguments whenever the transport
+        waits without a result, so the caller can do other work.
+        """
+        in_flight_count = 0
+        for item in emails:
+            if item is None:
+                # Wait for an in-flight email to finish.
+                if in_flight_count:
+                    try:
+                        result = self._result_queue.get(timeout=IDLE_WAIT)
+                    except Empty:
+                        pass
+                    else:
+                        in_flight_count -= 1
+                        yield result
+                        continue
+                else:
+                    time.sleep(IDLE_WAIT)
+                if on_idle is not None:
+                    on_idle()
+                continue
+            self._email_queue.put(item)
+            in_flight_count += 1
+            # Return any finished results.
+            while True:
+                try:
+                    result = self._result_queue.get_nowait()
+                except Empty:
+                    break
+                in_flight_count -= 1
+                yield result
+        # Wait for the remaining results.
+        while in_flight_count:
+            try:
+                result = self._result_queue.get(timeout=IDLE_WAIT)
+            except Empty:
+                if on_idle is not None:
+                    on_idle()
+                continue
+            in_flight_count -= 1
+            yield result
+
+    def close(self):
+        """
+        Closes the transport, waiting for all worker threads to finish.
+
+        Any emails that are still waiting in the queue will not be sent.
+        """
+        while True:
+            try:
+                self._email_queue.get_nowait()
+            except Empty:
+                break
+        for thread in self._threads:
+            self._email_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class AsyncSMTPSession(asynchat.async_chat):
+
+    """A non-blocking SMTP client session, used by the async transport to send messages one after another."""
+
+    def __init__(self, transport):
+        """Initializes the SMTP session, and starts connecting to the server."""
+        asynchat.async_chat.__init__(self, map=transport.socket_map)
+        self._transport = transport
+        self._buffer = []
+        self._response_lines = []
+        self._state = "greeting"
+        self._message = None
+        self._recipients = []
+        self._refused_recipients = {}
+        self._accepted_count = 0
+        self._sent_count = 0
+        self._ready = False
+        self._failed = False
+        self.last_activity = time.time()
+        self.set_terminator("\r\n")
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((transport.host, transport.port))
+
+    @property
+    def is_busy(self):
+        """Whether the session is currently sending a message."""
+        return self._message is not None
+
+    @property
+    def is_ready(self):
+        """Whether the session is ready to send a message."""
+        return self._ready and self._message is None
+
+    def _command(self, state, command):
+        """Sends an SMTP command to the server."""
+        self._state = state
+        self.push(command + "\r\n")
+
+    def send_message(self, message):
+        """Starts sending the given (key, from_email, recipients, data) message."""
+        self._message = message
+        self._ready = False
+        self._recipients = list(message[2])
+        self._refused_recipients = {}
+        self._accepted_count = 0
+        self.last_activity = time.time()
+        self._command("mail", "MAIL FROM:{address}".format(address=smtplib.quoteaddr(message[1])))
+
+    def _finish_message(self, ex):
+        """Reports the result of the current message to the transport."""
+        key = self._message[0]
+        self._message = None
+        self._sent_count += 1
+        self._transport.finish_message(key, ex)
+
+    def _become_ready(self):
+        """Marks the session as ready, or disconnects it if it has sent enough messages."""
+        max_messages = self._transport.max_messages_per_connection
+        if max_messages is not None and self._sent_count >= max_messages:
+            self.quit()
+        else:
+            self._ready = True
+
+    def _authenticate(self):
+        """Authenticates with the server, if credentials are configured."""
+        if self._transport.username:
+            credentials = "\0{username}\0{password}".format(
+                username = self._transport.username,
+                password = self._transport.password,
+            )
+            self._command("auth", "AUTH PLAIN {credentials}".format(credentials=base64.b64encode(credentials)))
+        else:
+            self._become_ready()
+
+    def quit(self):
+        """Closes the session gracefully."""
+        self._ready = False
+        self._transport.remove_session(self)
+        self._command("quit", "QUIT")
+
+    def fail(self, ex):
+        """Closes the session after an error, failing the current message."""
+        if self._failed:
+            return
+        self._failed = True
+        self._ready = False
+        self._transport.remove_session(self)
+        self.close()
+        if self._message is not None:
+            self._finish_message(ex)
+        elif self._sent_count == 0:
+            self._transport.fail_connection(ex)
+
+    def collect_incoming_data(self, data):
+        """Buffers incoming data from the server."""
+        self._buffer.append(data)
+
+    def found_terminator(self):
+        """Parses a response line from the server."""
+        line = "".join(self._buffer)
+        self._buffer = []
+        self.last_activity = time.time()
+        self._response_lines.append(line[4:])
+        if line[3:4] == "-":
+            return  # A multiline response.
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        response = "\n".join(self._response_lines)
+        self._response_lines = []
+        self._handle_response(code, response)
+
+    def _handle_response(self, code, response):
+        """Advances the SMTP conversation in response to the server."""
+        state = self._state
+        if state == "greeting":
+            if code != 220:
+                self.fail(smtplib.SMTPConnectError(code, response))
+            else:
+                self._command("ehlo", "EHLO {name}".format(name=self._transport.local_hostname))
+        elif state == "ehlo":
+            if code != 250:
+                self._command("helo", "HELO {name}".format(name=self._transport.local_hostname))
+            else:
+                self._authenticate()
+        elif state == "helo":
+            if code != 250:
+                self.fail(smtplib.SMTPHeloError(code, response))
+            else:
+                self._authenticate()
+        elif state == "auth":
+            if code != 235:
+                self.fail(smtplib.SMTPAuthenticationError(code, response))
+            else:
+                self._become_ready()
+        elif state == "mail":
+            if code != 250:
+                self._finish_message(smtplib.SMTPSenderRefused(code, response, self._message[1]))
+                self._command("rset", "RSET")
+            else:
+                self._command("rcpt", "RCPT TO:{address}".format(address=smtplib.quoteaddr(self._recipients[0])))
+        elif state == "rcpt":
+            if code in (250, 251):
+                self._accepted_count += 1
+            else:
+                self._refused_recipients[self._recipients[0]] = (code, response)
+            del self._recipients[0]
+            if self._recipients:
+                self._command("rcpt", "RCPT TO:{address}".format(address=smtplib.quoteaddr(self._recipients[0])))
+            elif self._accepted_count:
+                self._command("data", "DATA")
+            else:
+                self._finish_message(smtplib.SMTPRecipientsRefused(self._refused_recipients))
+                self._command("rset", "RSET")
+        elif state == "data":
+            if code != 354:
+                self._finish_message(smtplib.SMTPDataError(code, response))
+                self._command("rset", "RSET")
+            else:
+                data = smtplib.quotedata(self._message[3])
+                if data[-2:] != "\r\n":
+                    data += "\r\n"
+                self._state = "message"
+                self.push(data + ".\r\n")
+        elif state == "message":
+            if code != 250:
+                self._finish_message(smtplib.SMTPDataError(code, response))
+            else:
+                self._finish_message(None)
+            self._become_ready()
+        elif state == "rset":
+            self._become_ready()
+        elif state == "quit":
+            self.close()
+
+    def handle_connect(self):
+        """Called when the connection to the server is established."""
+
+    def handle_close(self):
+        """Called when the server closes the connection."""
+        if self._state == "quit":
+            self.close()
+        else:
+            self.fail(smtplib.SMTPServerDisconnected("Connection unexpectedly closed"))
+
+    def handle_error(self):
+        """Called when a socket error occurs."""
+        self.fail(sys.exc_info()[1])
+
+
+class AsyncTransport(object):
+
+    """
+    Sends emails concurrently over many non-blocking SMTP sessions, all
+    driven by an event loop on the calling thread.
+
+    Emails are generated on demand, with no more than two emails waiting
+    for each session, so rendering is paced by the speed of the SMTP
+    server. The SMTP server is configured using the standard Django email
+    settings, although EMAIL_USE_TLS is not supported.
+
+    As the connection is never encrypted, EMAIL_HOST_USER and
+    EMAIL_HOST_PASSWORD would be sent in plain text, so authentication is
+    refused unless the SUBSCRIBERS_ASYNC_ALLOW_PLAINTEXT_AUTH setting is
+    True. Only enable this for an SMTP server on a trusted network, such as
+    a local relay.
+    """
+
+    def __init__(self, concurrency, max_messages_per_connection=None):
+        """Initializes the async transport."""
+        if getattr(settings, "EMAIL_USE_TLS", False):
+            raise ImproperlyConfigured("The async email transport does not support EMAIL_USE_TLS.")
+        if settings.EMAIL_HOST_USER and not get_async_allow_plaintext_auth():
+            raise ImproperlyConfigured("The async email transport cannot encrypt the connection, so will not send EMAIL_HOST_USER and EMAIL_HOST_PASSWORD unless SUBSCRIBERS_ASYNC_ALLOW_PLAINTEXT_AUTH is True.")
+        self.host = settings.EMAIL_HOST
+        self.port = settings.EMAIL_PORT
+        self.username = settings.EMAIL_HOST_USER
+        self.password = settings.EMAIL_HOST_PASSWORD
+        self.local_hostname = DNS_NAME.get_fqdn()
+        self.max_messages_per_connection = max_messages_per_connection
+        self.socket_map = {}
+        self._concurrency = concurrency
+        self._window = concurrency * 2
+        self._sessions = set()
+        self._pending_messages = deque()
+        self._results = deque()
+
+    def _serialize(self, email):
+        """Serializes an email to a (from_email, recipients, data) tuple."""
+        return (
+            sanitize_address(email.from_email, email.encoding),
+            [sanitize_address(address, email.encoding) for address in email.recipients()],
+            email.message().as_string(),
+        )
+
+    def finish_message(self, key, ex):
+        """Records the result of sending a message."""
+        self._results.append((key, ex))
+
+    def remove_session(self, session):
+        """Removes a session from the pool of sessions."""
+        self._sessions.discard(session)
+
+    def fail_connection(self, ex):
+        """Fails the next pending message after a connection could not be established, so sending always progresses."""
+        if self._pending_messages:
+            self.finish_message(self._pending_messages.popleft()[0], ex)
+
+    def _get_in_flight_count(self):
+        """Returns the number of messages that are waiting or being sent."""
+        return len(self._pending_messages) + sum(1 for session in self._sessions if session.is_busy)
+
+    def _dispatch_messages(self):
+        """Assigns pending messages to ready sessions, opening new sessions as required."""
+        for session in list(self._sessions):
+            if not self._pending_messages:
+                break
+            if session.is_ready:
+                session.send_message(self._pending_messages.popleft())
+        starting_count = sum(1 for session in self._sessions if not session.is_busy and not session.is_ready)
+        while len(self._sessions) < self._concurrency and len(self._pending_messages) > starting_count:
+            try:
+                self._sessions.add(AsyncSMTPSession(self))
+            except socket.error as ex:
+                self.fail_connection(ex)
+            starting_count += 1
+
+    def _expire_sessions(self):
+        """Fails any sessions that have been waiting too long for a server response."""
+        now = time.time()
+        for session in list(self._sessions):
+            if (session.is_busy or not session.is_ready) and now - session.last_activity > ASYNC_SESSION_TIMEOUT:
+                session.fail(smtplib.SMTPServerDisconnected("Connection timed out"))
+
+    def send_iter(self, emails, on_idle=None):
+        """
+        Sends the given iterable of (key, email) pairs.
+
+        Returns an iterator of (key, exception) pairs, in the order that the
+        emails finished sending. The exception will be None if the email was
+        sent successfully.
+        
+        The iterable may yield None when no email is ready to send.
+
+        If given, on_idle is called with no arguments whenever the transport
+        waits without a result, so the caller can do other work.
+        """
+        emails = iter(emails)
+        emails_exhausted = False
+        while True:
+            # Accept new emails, up to the in-flight window.
+            while not emails_exhausted and self._get_in_flight_count() < self._window:
+                try:
+                    item = next(emails)
+                except StopIteration:
+                    emails_exhausted = True
+                else:
+                    if item is None:
+                        break
+                    key, email = item
+                    if email.recipients():
+                        self._pending_messages.append((key,) + self._serialize(email))
+                    else:
+                        self.finish_message(key, None)
+            self._dispatch_messages()
+            # Return any finished results.
+            if self._results:
+                while self._results:
+                    yield self._results.popleft()
+            elif on_idle is not None:
+                on_idle()
+            if emails_exhausted and not self._get_in_flight_count():
+                break
+            # Process network events.
+            if self.socket_map:
+                asyncore.loop(timeout=IDLE_WAIT, map=self.socket_map, count=1)
+            else:
+                time.sleep(IDLE_WAIT)
+            self._expire_sessions()
+
+    def close(self):
+        """Closes all SMTP sessions."""
+        for session in list(self._sessions):
+            if session.is_ready:
+                session.quit()
+        deadline = time.time() + ASYNC_SESSION_TIMEOUT
+        while self.socket_map and time.time() < deadline:
+            asyncore.loop(timeout=IDLE_WAIT, map=self.socket_map, count=1)
+        for session in self.socket_map.values():
+            session.close()
+        self._sessions.clear()
+
+
+def get_transport(concurrency=1, transport=TRANSPORT_THREADED):
+    """Returns a transport that sends emails using the given number of concurrent connections."""
+    max_messages_per_connection = get_max_messages_per_connection()
+    if transport == TRANSPORT_ASYNC:
+        return AsyncTransport(concurrency, max_messages_per_connection)
+    if transport != TRANSPORT_THREADED:
+        raise ImproperlyConfigured("Unknown email transport {transport!r}.".format(
+            transport = transport,
+        ))
+    if concurrency > 1:
+        return ThreadedTransport(concurrency, max_messages_per_connection)
+    return SerialTransport(max_messages_per_connection)
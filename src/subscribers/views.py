@@ -8,7 +8,7 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.dispatch import Signal
 
 from subscribers.forms import SubscribeForm
-from subscribers.models import Subscriber, STATUS_PENDING
+from subscribers.models import Subscriber, DispatchedEmail, ArchivedEmail, STATUS_PENDING, STATUS_SENDING
 from subscribers.registration import default_email_manager
 
 
@@ -80,7 +80,7 @@ def _protected_view(func):
         model = content_type.model_class()
         obj = get_object_or_404(model, id=object_id)
         # Check that the email being referred to was actually sent.
-        if not obj.dispatchedemail_set.filter(subscriber=subscriber).exclude(status=STATUS_PENDING).exists():
+        if not DispatchedEmail.objects.for_object(obj).filter(subscriber=subscriber).exclude(status__in=(STATUS_PENDING, STATUS_SENDING)).exists() and not ArchivedEmail.objects.for_object(obj).filter(subscriber=subscriber).exists():
             raise Http404("No corresponding email was sent to this subscriber.")
         # Wow, we've actually passed all the validation steps!
         return func(request, content_type, obj, subscriber, secure_hash)